@@ -0,0 +1,118 @@
+import math
+import mmap
+import struct
+from hashlib import blake2b
+from pathlib import Path
+
+import dill as pickle
+
+
+class BloomFilter:
+    """
+    BloomFilter is a probabilistic set of keys kept in a memory mapped file. Negative answers of `in` are exact,
+    positive answers are wrong with probability close to `error_rate` while the number of added keys does not exceed
+    `capacity`. Keys cannot be removed. Meant for internal use.
+    """
+    # capacity, number of bits, number of hashes, number of added keys
+    _header = struct.Struct("<QQQQ")
+
+    def __init__(self, path=None, capacity=100000, error_rate=0.01, read_only=False):
+        """
+        Create a BloomFilter instance. If the file exists, existing filter is loaded and `capacity` and
+        `error_rate` are ignored
+        :param path: Path to the filter file. If not provided, the filter is kept in memory
+        :param capacity: Expected number of keys
+        :param error_rate: Probability of false positive answers when the filter is full
+        :param read_only: Open existing filter for reading only
+        """
+        self.path = None if path is None else Path(path)
+        self._file = None
+
+        if self.path is not None and self.path.is_file():
+            self._file = open(self.path, "rb" if read_only else "r+b")
+            self._mm = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ if read_only else mmap.ACCESS_WRITE
+            )
+            self.capacity, self._n_bits, self._n_hashes, self.count = self._header.unpack_from(self._mm)
+            return
+
+        if read_only and self.path is not None:
+            raise FileNotFoundError(f"Filter does not exist: {self.path}")
+
+        self.capacity = max(capacity, 1)
+        self._n_bits = max(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self._n_hashes = max(round(self._n_bits / self.capacity * math.log(2)), 1)
+        self.count = 0
+        size = self._header.size + (self._n_bits + 7) // 8
+
+        if self.path is None:
+            self._mm = mmap.mmap(-1, size)
+        else:
+            self._file = open(self.path, "w+b")
+            self._file.truncate(size)
+            self._mm = mmap.mmap(self._file.fileno(), 0)
+        self._write_header()
+
+    def _write_header(self):
+        self._header.pack_into(self._mm, 0, self.capacity, self._n_bits, self._n_hashes, self.count)
+
+    @staticmethod
+    def _key_bytes(key):
+        if isinstance(key, int):
+            return b"i" + str(key).encode()
+        if isinstance(key, str):
+            return b"s" + key.encode("utf-8", "surrogatepass")
+        if isinstance(key, bytes):
+            return b"b" + key
+        return b"p" + pickle.dumps(key, protocol=4)
+
+    def _bit_positions(self, key):
+        digest = blake2b(self._key_bytes(key), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self._n_bits for i in range(self._n_hashes)]
+
+    def __contains__(self, key):
+        offset = self._header.size
+        mm = self._mm
+        return all(mm[offset + bit // 8] & (1 << bit % 8) for bit in self._bit_positions(key))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def is_full(self):
+        return self.count >= self.capacity
+
+    def add(self, key):
+        """
+        Add key to the filter
+        :param key: Integer, string, bytes or any picklable object
+        :return:
+        """
+        offset = self._header.size
+        mm = self._mm
+        is_new = False
+        for bit in self._bit_positions(key):
+            byte = mm[offset + bit // 8]
+            if not byte & (1 << bit % 8):
+                mm[offset + bit // 8] = byte | (1 << bit % 8)
+                is_new = True
+        if is_new:
+            self.count += 1
+
+    def save(self):
+        """
+        Write the filter to disk
+        :return:
+        """
+        if self._file is not None and "+" in self._file.mode:
+            self._write_header()
+            self._mm.flush()
+
+    def close(self):
+        if not self._mm.closed:
+            self.save()
+            self._mm.close()
+        if self._file is not None:
+            self._file.close()
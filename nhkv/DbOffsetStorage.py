@@ -1,4 +1,18 @@
+import os
 import sqlite3
+import threading
+import time
+from contextlib import nullcontext
+from hashlib import blake2b
+from pathlib import Path
+
+from nhkv.BloomFilter import BloomFilter
+from nhkv.OffsetCache import create_offset_cache
+
+# connections inherited from the parent process are neither used nor closed in a forked child
+_inherited_connections = []
+# high bits of lengths mark KVStore entries that are not stored as a single record, see `nhkv.KVStore`
+_LENGTH_MASK = (1 << 60) - 1
 
 
 class DbOffsetStorage:
@@ -8,28 +22,232 @@ class DbOffsetStorage:
     """
 
     _is_open = False
+    _pid = None
+    _bloom = None
+    _bloom_capacity = 100000
+    _offset_cache = None
+    _cache_complete = False
+    _table = "offset_storage"
+    _order_by = "key"
+    _key_type = int
 
-    def __init__(self, path):
+    def __init__(
+            self, path, read_only=False, page_size=4096, cache_size=2**26, mmap_size=2**28, batch_size=10000,
+            commit_rows=100000, commit_bytes=None, commit_interval=None, offset_cache=None, cache_entries=2**20,
+            preload=False, thread_safe=False
+    ):
         """
-        Creates a DbOffsetStorage instance
+        Creates a DbOffsetStorage instance. The database uses WAL journal with `synchronous=NORMAL`. New entries are
+        buffered and written in batches. The connection is reopened automatically when the instance is used in a
+        forked process
         :param path: Path to the dataset file. If exists, existing database is loaded
+        :param read_only: Open existing database for reading only
+        :param page_size: Page size of the database in bytes. Applied only when the database is created
+        :param cache_size: Size of sqlite page cache in bytes
+        :param mmap_size: Size of the database that sqlite reads through memory mapping. `0` disables mapping
+        :param batch_size: Number of buffered entries written to the database with a single statement
+        :param commit_rows: Commit after this number of added entries
+        :param commit_bytes: Commit after added entries reference this number of value bytes
+        :param commit_interval: Commit when this number of seconds passed since the last commit
+        :param offset_cache: Keep offsets that were read or written in memory: `dense` caches offsets in an array
+        indexed by key and suits sequential keys, `sparse` caches at most `cache_entries` recently used offsets.
+        The database remains the source of truth
+        :param cache_entries: Maximum number of entries in `sparse` cache
+        :param preload: Fill offset cache with a single scan of the table. When all offsets fit into the cache,
+        reads do not query the database at all
+        :param thread_safe: Allow using the storage from several threads. Writes are serialized through a single
+        connection. Every reading thread runs point queries with its own read-only connection. Such connections see
+        committed entries and the entries that are kept in memory until the commit. Scans (`len`, `keys`, `items`)
+        run on the writer connection and see all entries as well
         """
         self.path = path
+        self._read_only = read_only
+        self._page_size = page_size
+        self._cache_size = cache_size
+        self._mmap_size = mmap_size
+        self._batch_size = batch_size
+        self._commit_rows = commit_rows
+        self._commit_bytes = commit_bytes
+        self._commit_interval = commit_interval
+        self._thread_safe = thread_safe
+        self._write_lock = threading.RLock() if thread_safe else nullcontext()
+
+        self._connect()
+        if not read_only:
+            self._create_table()
+        self._open_bloom()
+        self._offset_cache_options = (offset_cache, cache_entries)
+        if offset_cache is not None:
+            self._offset_cache = create_offset_cache(offset_cache, cache_entries)
+            if preload:
+                self.preload()
+
+        self._is_open = True
+
+    def preload(self):
+        """
+        Fill offset cache with a single sequential scan of the table
+        :return:
+        """
+        if self._offset_cache is None:
+            raise ValueError("Offset cache is not enabled")
+        self._flush_writes()
+        self._cache_complete = True
+        for key, shard, position, bytes_ in self._db.execute(
+                f"SELECT key, shard, position, bytes FROM {self._table} ORDER BY {self._order_by}"
+        ):
+            self._cache_offset(key, (shard, position, bytes_))
+            if not self._cache_complete:
+                break
+
+    def _cache_offset(self, key, value):
+        if self._offset_cache is None:
+            return
+        self._offset_cache[key] = value
+        if self._cache_complete and (self._offset_cache.is_full or self._offset_cache.get(key) is None):
+            # some offsets can be missing from the cache from now on
+            self._cache_complete = False
+
+    def _get_bloom_path(self):
+        return Path(str(self.path) + ".bloom")
+
+    def _open_bloom(self):
+        """
+        Open Bloom filter with keys of the storage. The filter is rebuilt from the database when the file does not
+        exist, e.g. for storages created before filters were introduced
+        :return:
+        """
+        bloom_path = self._get_bloom_path()
+        if bloom_path.is_file():
+            self._bloom = BloomFilter(bloom_path, read_only=self._read_only)
+        else:
+            self._build_bloom(None if self._read_only else bloom_path)
+
+    def _build_bloom(self, bloom_path):
+        self._flush_writes()
+        n_keys = self._db.execute(f"SELECT COUNT() FROM {self._table}").fetchone()[0]
+        capacity = max(self._bloom_capacity, n_keys * 2)
+        if bloom_path is None:
+            bloom = BloomFilter(capacity=capacity)
+        else:
+            temp_path = bloom_path.with_name(bloom_path.name + ".tmp")
+            bloom = BloomFilter(temp_path, capacity=capacity)
+        for (key,) in self._db.execute(f"SELECT key FROM {self._table}"):
+            bloom.add(key)
+
+        if self._bloom is not None:
+            self._bloom.close()
+        if bloom_path is not None:
+            bloom.close()
+            os.replace(temp_path, bloom_path)
+            bloom = BloomFilter(bloom_path)
+        self._bloom = bloom
+
+    def _connect(self):
+        if self._read_only:
+            self._connection = self._connect_read_only()
+        else:
+            self._connection = sqlite3.connect(self.path, check_same_thread=not self._thread_safe)
+        self._cursor = self._connection.cursor()
+        self._pid = os.getpid()
+        self._set_pragmas(self._cursor, self._read_only)
+        self._pending = dict()  # entries that are not written to the database yet, checked first by reads
+        self._flushed = dict()  # written, but not committed entries, kept only in thread-safe mode
+        self._removed = set()  # deleted, but not committed keys, kept only in thread-safe mode
+        self._pending_how = None
+        self._writes = 0
+        self._readers = threading.local()
+        self._reader_connections = []
+        self.requires_commit = False
+        self.added_without_commit = 0
+        self._bytes_without_commit = 0
+        self._last_commit = time.monotonic()
+
+    def _connect_read_only(self):
+        return sqlite3.connect(
+            Path(self.path).absolute().as_uri() + "?mode=ro", uri=True, check_same_thread=not self._thread_safe
+        )
+
+    def _set_pragmas(self, cursor, read_only):
+        pragmas = [f"cache_size = {-(int(self._cache_size) // 1024)}", f"mmap_size = {int(self._mmap_size)}"]
+        if not read_only:
+            # page size cannot be changed after the database is switched to WAL
+            pragmas = [f"page_size = {int(self._page_size)}", "journal_mode = WAL", "synchronous = NORMAL"] + pragmas
+        for pragma in pragmas:
+            # unfinished statements keep WAL files after the connection is closed
+            cursor.execute(f"PRAGMA {pragma}").fetchall()
+
+    def _read_cursor(self):
+        """
+        Get cursor for point queries. In thread-safe mode, every thread has its own read-only connection
+        :return:
+        """
+        if not self._thread_safe:
+            return self._cur
+        self._check_process()
+        cursor = getattr(self._readers, "cursor", None)
+        if cursor is None:
+            connection = self._connect_read_only()
+            cursor = connection.cursor()
+            self._set_pragmas(cursor, read_only=True)
+            with self._write_lock:
+                self._reader_connections.append((connection, cursor))
+            self._readers.cursor = cursor
+        return cursor
+
+    def _scan(self, query, params=()):
+        """
+        Stream rows of a query that scans the table. The query runs on the writer connection after buffered entries
+        are written, so it sees entries that are not committed yet. In thread-safe mode, the write lock is held only
+        while a chunk of rows is fetched
+        :param query: SQL query
+        :param params: Query parameters
+        :return: generator of rows
+        """
+        with self._write_lock:
+            self._flush_writes()
+            cursor = self._db.execute(query, params)
+        try:
+            while True:
+                with self._write_lock:
+                    rows = cursor.fetchmany(self._batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            if self._is_open:
+                cursor.close()
 
-        self._db = sqlite3.connect(path)
-        self._cur = self._db.cursor()
+    def _check_process(self):
+        if self._pid != os.getpid():
+            # uncommitted changes belong to the parent process
+            _inherited_connections.append(self._connection)
+            self._connect()
+            if self._offset_cache is not None:
+                # cached offsets can include entries that the parent did not commit
+                self._offset_cache = create_offset_cache(*self._offset_cache_options)
+                self._cache_complete = False
+
+    @property
+    def _db(self):
+        self._check_process()
+        return self._connection
+
+    @property
+    def _cur(self):
+        self._check_process()
+        return self._cursor
+
+    def _create_table(self):
+        # the key is an alias of rowid, so uniqueness is enforced by the table b-tree without a separate index
         self._cur.execute(
             "CREATE TABLE IF NOT EXISTS offset_storage ("
-            "key INTEGER PRIMARY KEY NOT NULL UNIQUE, "
+            "key INTEGER PRIMARY KEY NOT NULL, "
             "shard INTEGER NOT NULL, "
             "position INTEGER NOT NULL, "
             "bytes INTEGER NOT NULL)"
         )
 
-        self._is_open = True
-        self.requires_commit = False
-        self.added_without_commit = 0
-
     def _add_item(self, key, value, how="REPLACE"):
         """
         Add entry to the database
@@ -37,23 +255,127 @@ class DbOffsetStorage:
         :param value: Value is a tuple (shard_id, seek_position, len_bytes)
         :param how: Specifies how new entries are added. The default value `REPLACE` ensured added key IDs
         are unique. Can use `INSERT` to make insertion faster, but need to guarantee key uniqueness in this case,
-        otherwise an exception is raised by Sqlite. Automatic commits every 100000 records. Otherwise, need to
-        call method `commit` manually
+        otherwise an exception is raised by Sqlite when the batch is written. Commits happen automatically according
+        to `commit_rows`, `commit_bytes` and `commit_interval`. Otherwise, need to call method `save` manually
         :return:
         """
-        if type(key) is not int:
-            raise TypeError("Key type should be int but given: ", type(key))
+        if type(key) is not self._key_type:
+            raise TypeError(f"Key type should be {self._key_type.__name__} but given: ", type(key))
+        self._check_process()
+        with self._write_lock:
+            self._add_to_batch(key, value, how)
+
+    def _add_to_batch(self, key, value, how):
         # noinspection PyShadowingBuiltins
         shard, position, bytes = value
-        self._cur.execute(
-            f"{how} INTO offset_storage (key, shard, position, bytes) VALUES (?,?,?,?)",
-            (key, shard, position, bytes)
-        )
+        self._writes += 1
+        if self._pending_how != how:
+            self._flush_writes()
+            self._pending_how = how
+        if how == "INSERT" and self._key_exists(key):
+            raise sqlite3.IntegrityError(f"UNIQUE constraint failed: {self._table}.key, key: {key!r}")
+        self._pending[key] = (shard, position, bytes)
+        self._removed.discard(key)
+        self._cache_offset(key, (shard, position, bytes))
+        if self._bloom.is_full:
+            # includes the key that was just added
+            self._build_bloom(self._get_bloom_path())
+        else:
+            self._bloom.add(key)
         self.requires_commit = True
         self.added_without_commit += 1
-        if self.added_without_commit > 100000:
+        self._bytes_without_commit += bytes & _LENGTH_MASK
+        if len(self._pending) >= self._batch_size:
+            self._flush_writes()
+        if self._commit_is_due():
             self.save()
 
+    def _key_exists(self, key):
+        """
+        Check whether the key is buffered or written to the database. Most new keys are rejected by the Bloom filter
+        without querying the database
+        :param key:
+        :return:
+        """
+        if key in self._pending or key in self._flushed:
+            return True
+        if key in self._removed:
+            return False
+        return key in self._bloom and self._select(key) is not None
+
+    def _commit_is_due(self):
+        return (
+            self.added_without_commit >= self._commit_rows or
+            self._commit_bytes is not None and self._bytes_without_commit >= self._commit_bytes or
+            self._commit_interval is not None and time.monotonic() - self._last_commit >= self._commit_interval
+        )
+
+    def _flush_writes(self):
+        """
+        Write buffered entries to the database without committing. Uncommitted entries are visible to reads with
+        the same connection, so reads never need to commit
+        :return:
+        """
+        if self._pending:
+            self._write_batch(
+                f"{self._pending_how} INTO offset_storage (key, shard, position, bytes) VALUES (?,?,?,?)",
+                [(key,) + entry for key, entry in self._pending.items()]
+            )
+
+    def _write_batch(self, query, rows, keys=None):
+        """
+        Write buffered entries with a single statement. The statement runs inside a savepoint. When it fails, the
+        batch is rolled back and written row by row, so that only the rows that violate constraints are lost, and
+        `IntegrityError` is raised for them. Entries stay buffered when the database cannot be written at all
+        :param query: SQL query that inserts a single row
+        :param rows: Rows of the query
+        :param keys: Keys of the rows. Defaults to the first column
+        :return:
+        """
+        if keys is None:
+            keys = [row[0] for row in rows]
+        cursor = self._cur
+        if not self._connection.in_transaction:
+            # releasing the outermost savepoint would commit
+            cursor.execute("BEGIN")
+        cursor.execute("SAVEPOINT flush_writes")
+        failed = []
+        try:
+            try:
+                cursor.executemany(query, rows)
+            except sqlite3.IntegrityError:
+                cursor = self._reset_cursor()
+                cursor.execute("ROLLBACK TO flush_writes")
+                for key, row in zip(keys, rows):
+                    try:
+                        cursor.execute(query, row)
+                    except sqlite3.IntegrityError:
+                        failed.append(key)
+        except sqlite3.Error:
+            cursor = self._reset_cursor()
+            cursor.execute("ROLLBACK TO flush_writes")
+            raise
+        finally:
+            cursor.execute("RELEASE flush_writes")
+
+        written, self._pending = self._pending, dict()
+        for key in failed:
+            # reads must not see entries that were not written
+            del written[key]
+            if self._offset_cache is not None:
+                self._offset_cache.discard(key)
+                self._cache_complete = False
+        if self._thread_safe:
+            self._flushed.update(written)
+        if failed:
+            raise sqlite3.IntegrityError(f"UNIQUE constraint failed: {self._table}.key, keys: {failed!r}")
+
+    def _reset_cursor(self):
+        # release the failed statement
+        self._cursor.close()
+        self._cursor = self._connection.cursor()
+        return self._cursor
+
     def __setitem__(self, key, value):
         """
         Add new entry to the storage or replace the old one
@@ -63,28 +385,95 @@ class DbOffsetStorage:
         """
         self._add_item(key, value, how="REPLACE")
 
+    def __delitem__(self, key):
+        """
+        Remove entry from the storage. Buffered entries are written first, so that the deletion follows them. The
+        key stays in the Bloom filter until the filter is rebuilt
+        :param key: Key is an integer ID
+        :return:
+        """
+        if type(key) is not self._key_type:
+            raise KeyError(key)
+        self._check_process()
+        with self._write_lock:
+            self._flush_writes()
+            self._delete_row(key)
+            self._writes += 1
+            self._flushed.pop(key, None)
+            if self._thread_safe:
+                # connections of reading threads see the entry until the deletion is committed
+                self._removed.add(key)
+            if self._offset_cache is not None:
+                self._offset_cache.discard(key)
+            self.requires_commit = True
+            self.added_without_commit += 1
+            if self._commit_is_due():
+                self.save()
+
+    def _delete_row(self, key):
+        if self._cur.execute(f"DELETE FROM {self._table} WHERE key = ?", (key,)).rowcount == 0:
+            raise KeyError(key)
+
     def __getitem__(self, key):
         """
-        Retrieve a record from storage
+        Retrieve a record from storage. Buffered entries are checked first
         :param key: Key is an integer ID
         :return:
         """
-        if self.requires_commit:
-            self.save()
-        response = self._cur.execute(
-            f"SELECT shard, position, bytes FROM offset_storage WHERE key = ?", (key,)
-        ).fetchone()
+        self._check_process()
+        with self._write_lock:
+            response = self._pending.get(key, None) or self._flushed.get(key, None)
+            if response is None and key in self._removed:
+                raise KeyError()
+            if response is None and self._offset_cache is not None:
+                response = self._offset_cache.get(key, None)
+                if response is None and self._cache_complete:
+                    raise KeyError()
+            writes = self._writes
+        if response is not None:
+            return response
+        response = self._select(key)
         if response is None:
             raise KeyError()
+        with self._write_lock:
+            if writes == self._writes:  # otherwise the response can be outdated
+                self._cache_offset(key, response)
         return response
 
+    def _select(self, key):
+        """
+        Query the database for an entry
+        :param key:
+        :return: tuple (shard_id, seek_position, len_bytes) or None if the key does not exist
+        """
+        return self._read_cursor().execute(
+            "SELECT shard, position, bytes FROM offset_storage WHERE key = ?", (key,)
+        ).fetchone()
+
     def __contains__(self, item):
-        raise NotImplementedError("Use method `get` instead")
+        """
+        Check whether the key exists. Most absent keys are rejected by the Bloom filter without querying the database
+        :param item: Key is an integer ID
+        :return:
+        """
+        if type(item) is not self._key_type:
+            return False
+        self._check_process()
+        with self._write_lock:
+            if item not in self._bloom:
+                return False
+            if item in self._pending or item in self._flushed:
+                return True
+            if item in self._removed:
+                return False
+            if self._offset_cache is not None and self._cache_complete:
+                return self._offset_cache.get(item, None) is not None
+        return self._select(item) is not None
 
     def __len__(self):
-        if self.requires_commit:
-            self.save()
-        return self._cur.execute("SELECT COUNT() FROM offset_storage").fetchone()[0]
+        with self._write_lock:
+            self._flush_writes()
+            return self._db.execute(f"SELECT COUNT() FROM {self._table}").fetchall()[0][0]
 
     def __del__(self):
         self.close()
@@ -106,16 +495,245 @@ class DbOffsetStorage:
             return default
 
     def keys(self):
-        keys = self._cur.execute("SELECT key FROM offset_storage").fetchall()
-        return list(key[0] for key in keys)
+        return [key for key, in self._scan(f"SELECT key FROM {self._table}")]
+
+    def items(self, start=None, stop=None):
+        """
+        Iterate over entries in the order of keys. Entries are streamed from the database cursor
+        :param start: Ordinal of the first entry
+        :param stop: Ordinal of the entry where iteration stops
+        :return: generator of tuples (key, (shard_id, seek_position, len_bytes))
+        """
+        offset = start or 0
+        limit = -1 if stop is None else max(stop - offset, 0)
+        for key, shard, position, bytes_ in self._scan(
+            f"SELECT key, shard, position, bytes FROM {self._table} ORDER BY {self._order_by} LIMIT ? OFFSET ?",
+            (limit, offset)
+        ):
+            yield key, (shard, position, bytes_)
+
+    def key_range(self, start, stop):
+        """
+        Iterate over entries with keys in range [start, stop) with a single query
+        :param start: First key of the range
+        :param stop: Key where the range ends
+        :return: generator of tuples (key, (shard_id, seek_position, len_bytes))
+        """
+        for key, shard, position, bytes_ in self._scan(
+            "SELECT key, shard, position, bytes FROM offset_storage WHERE key BETWEEN ? AND ? ORDER BY key",
+            (start, stop - 1)
+        ):
+            yield key, (shard, position, bytes_)
 
     def save(self):
-        self._db.commit()
-        self.requires_commit = False
-        self.added_without_commit = 0
+        with self._write_lock:
+            # keys are written to the filter before they are committed, so the filter never misses committed keys
+            self._flush_writes()
+            self._bloom.save()
+            self._db.commit()
+            self._flushed.clear()
+            self._removed.clear()
+            self.requires_commit = False
+            self.added_without_commit = 0
+            self._bytes_without_commit = 0
+            self._last_commit = time.monotonic()
 
     def close(self):
-        if self._is_open:
-            self.save()
-            self._cur.connection.close()
-            self._is_open = False
+        with self._write_lock:
+            if self._is_open:
+                self.save()
+                self._bloom.close()
+                for connection, cursor in self._reader_connections:
+                    cursor.close()
+                    connection.close()
+                self._reader_connections = []
+                self._cur.close()
+                self._connection.close()
+                self._is_open = False
+
+
+class HashedKeyOffsetStorage(DbOffsetStorage):
+    """
+    HashedKeyOffsetStorage class creates sqlite3 storage to keep mmap offsets for KVStore with string keys. The
+    64-bit hash of the key is used as INTEGER PRIMARY KEY, and the full key is stored for collision checks. Keys with
+    colliding hashes take the next free slot (linear probing). Meant for internal use.
+    """
+
+    _table = "hashed_offset_storage"
+    _order_by = "key_hash"
+    _key_type = str
+    _probe_window = 8
+    _query_chunk = 500
+
+    def __init__(self, path, read_only=False, **kwargs):
+        """
+        Creates a HashedKeyOffsetStorage instance. Accepts the same parameters as DbOffsetStorage, but only `sparse`
+        offset cache is supported
+        :param path: Path to the dataset file. If exists, existing database is loaded
+        :param read_only: Open existing database for reading only
+        """
+        if kwargs.get("offset_cache", None) == "dense":
+            raise ValueError("`dense` offset cache requires integer keys")
+        super().__init__(path, read_only=read_only, **kwargs)
+
+    @staticmethod
+    def _hash_key(key):
+        # 62 bits keep probing far from the end of sqlite integer range
+        return int.from_bytes(blake2b(key.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little") >> 2
+
+    def _create_table(self):
+        self._cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {self._table} ("
+            "key_hash INTEGER PRIMARY KEY NOT NULL, "
+            "key TEXT NOT NULL, "
+            "shard INTEGER NOT NULL, "
+            "position INTEGER NOT NULL, "
+            "bytes INTEGER NOT NULL)"
+        )
+
+    def _fetch_slots(self, slots):
+        """
+        Find keys that occupy slots
+        :param slots: Iterable of slots (key hashes)
+        :return: dictionary {slot: key or None for free slots}
+        """
+        slots = list(slots)
+        occupied = dict.fromkeys(slots)
+        for start in range(0, len(slots), self._query_chunk):
+            chunk = slots[start: start + self._query_chunk]
+            occupied.update(self._cur.execute(
+                f"SELECT key_hash, key FROM {self._table} WHERE key_hash IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall())
+        return occupied
+
+    def _flush_writes(self):
+        """
+        Write buffered entries to the database without committing. Slots are resolved for the whole batch with
+        chunked queries, colliding keys are probed one by one
+        :return:
+        """
+        if not self._pending:
+            return
+
+        homes = {key: self._hash_key(key) for key in self._pending}
+        occupied = self._fetch_slots(set(homes.values()))
+        rows = []
+        for key, entry in self._pending.items():
+            slot = homes[key]
+            while True:
+                if slot not in occupied:
+                    occupied.update(self._fetch_slots([slot]))
+                if occupied[slot] is None or occupied[slot] == key:
+                    break
+                slot += 1
+            occupied[slot] = key
+            rows.append((slot, key) + entry)
+
+        self._write_batch(
+            f"{self._pending_how} INTO {self._table} (key_hash, key, shard, position, bytes) VALUES (?,?,?,?,?)",
+            rows, keys=list(self._pending)
+        )
+
+    def _delete_row(self, key):
+        """
+        Remove the row of the key. Later keys of the probe sequence are moved back into the freed slot, so that
+        lookups of these keys do not stop at it
+        :param key:
+        :return:
+        """
+        slot = self._hash_key(key)
+        while True:
+            stored_key = self._slot_key(slot)
+            if stored_key is None:
+                raise KeyError(key)
+            if stored_key == key:
+                break
+            slot += 1
+
+        statements = [(f"DELETE FROM {self._table} WHERE key_hash = ?", (slot,))]
+        hole = slot
+        while True:
+            slot += 1
+            stored_key = self._slot_key(slot)
+            if stored_key is None:
+                break
+            if self._hash_key(stored_key) <= hole:
+                statements.append((f"UPDATE {self._table} SET key_hash = ? WHERE key_hash = ?", (hole, slot)))
+                hole = slot
+
+        cursor = self._cur
+        if not self._connection.in_transaction:
+            cursor.execute("BEGIN")
+        cursor.execute("SAVEPOINT delete_row")
+        try:
+            for query, params in statements:
+                cursor.execute(query, params)
+        except sqlite3.Error:
+            cursor = self._reset_cursor()
+            cursor.execute("ROLLBACK TO delete_row")
+            raise
+        finally:
+            cursor.execute("RELEASE delete_row")
+
+    def _slot_key(self, slot):
+        row = self._cur.execute(f"SELECT key FROM {self._table} WHERE key_hash = ?", (slot,)).fetchone()
+        return None if row is None else row[0]
+
+    def _select(self, key):
+        slot = self._hash_key(key)
+        while True:
+            rows = self._read_cursor().execute(
+                f"SELECT key_hash, key, shard, position, bytes FROM {self._table} "
+                f"WHERE key_hash BETWEEN ? AND ? ORDER BY key_hash",
+                (slot, slot + self._probe_window - 1)
+            ).fetchall()
+            for key_hash, stored_key, shard, position, bytes_ in rows:
+                if key_hash != slot:
+                    # free slot ends the probe sequence
+                    return None
+                if stored_key == key:
+                    return shard, position, bytes_
+                slot += 1
+            if len(rows) < self._probe_window:
+                return None
+
+    def get_many(self, keys):
+        """
+        Retrieve several records with chunked queries
+        :param keys: Iterable of string keys
+        :return: dictionary {key: (shard_id, seek_position, len_bytes)} for existing keys
+        """
+        self._check_process()
+        found = dict()
+        with self._write_lock:
+            for key in keys:
+                entry = self._pending.get(key, None) or self._flushed.get(key, None)
+                if entry is not None:
+                    found[key] = entry
+                elif key in self._bloom and key not in self._removed:
+                    found[key] = None
+
+        # keys that are not buffered in memory are looked up in the database
+        homes = {key: self._hash_key(key) for key, entry in found.items() if entry is None}
+        slots = list(set(homes.values()))
+        connection = self._read_cursor().connection
+        for start in range(0, len(slots), self._query_chunk):
+            chunk = slots[start: start + self._query_chunk]
+            for key, shard, position, bytes_ in connection.execute(
+                    f"SELECT key, shard, position, bytes FROM {self._table} "
+                    f"WHERE key_hash IN ({','.join('?' * len(chunk))})", chunk
+            ):
+                if key in homes:
+                    found[key] = (shard, position, bytes_)
+        for key in homes:
+            if found[key] is None:
+                # the key was displaced by a collision or does not exist
+                entry = self._select(key)
+                if entry is None:
+                    del found[key]
+                else:
+                    found[key] = entry
+        return found
+
+    def key_range(self, start, stop):
+        raise TypeError("Range reads are supported only for integer keys")
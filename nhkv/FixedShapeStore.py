@@ -0,0 +1,217 @@
+import mmap
+import os
+from array import array
+from functools import reduce
+from operator import mul
+from pathlib import Path
+
+import dill as pickle
+
+
+class FixedShapeStore:
+    """
+    FixedShapeStore is a storage for numeric records of the same shape, e.g. embedding vectors. Records are kept as
+    rows of a 2D array in a single mmap file without serialization and without offset index: the position of a record
+    is computed from its row number. Keys are dense integers (row numbers) or any hashable objects when key map is
+    enabled. The file grows by doubling its capacity.
+    """
+    _initial_capacity = 1024
+    _is_open = False
+
+    def __init__(self, path, shape=1, dtype="f", key_map=False):
+        """
+        Create a FixedShapeStore instance. If the storage exists, its data file is opened
+        :param path: Path to the location, where the storage will be created
+        :param shape: Shape of a single record. Integer or tuple
+        :param dtype: Type of record fields. The type descriptor should be one of available in standard array package
+        :param key_map: Map arbitrary keys to rows. Otherwise, keys are row numbers
+        """
+        self.path = Path(path)
+        self._shape = (shape,) if isinstance(shape, int) else tuple(shape)
+        self._row_size = reduce(mul, self._shape, 1)
+        self._dtype = dtype
+        self._row_bytes = self._row_size * array(dtype).itemsize
+        self._key_map = dict() if key_map else None
+        self._n_rows = 0
+
+        self.path.mkdir(exist_ok=True, parents=True)
+        self._open_data()
+        self._is_open = True
+
+    def _open_data(self):
+        data_path = self.path.joinpath("rows")
+        if not data_path.is_file():
+            data_path.touch()
+        self._file = open(data_path, "r+b")
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.truncate(self._initial_capacity * self._row_bytes)
+        self._map_data()
+
+    def _map_data(self):
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        self._bytes = memoryview(self._mm)
+        self._view = self._bytes.cast(self._dtype)
+        self._capacity = len(self._mm) // self._row_bytes
+
+    def _unmap_data(self):
+        self._view.release()
+        self._bytes.release()
+        self._mm.close()
+
+    @property
+    def shape(self):
+        return (len(self),) + self._shape
+
+    def _reserve(self, n_rows):
+        if n_rows <= self._capacity:
+            return
+        capacity = max(self._capacity * 2, n_rows)
+        self._unmap_data()
+        self._file.truncate(capacity * self._row_bytes)
+        self._map_data()
+
+    def _get_row(self, key, create=False):
+        if self._key_map is not None:
+            row = self._key_map.get(key, None)
+            if row is None:
+                if not create:
+                    raise KeyError("Key does not exist:", key)
+                row = self._n_rows
+                self._key_map[key] = row
+            return row
+
+        if not isinstance(key, int):
+            raise TypeError(f"Key type should be `int` when no key map is used, but `{type(key).__name__}` given.")
+        if key < 0 or key >= self._n_rows and not create:
+            raise KeyError("Key does not exist:", key)
+        return key
+
+    def _to_array(self, row):
+        if not isinstance(row, array) or row.typecode != self._dtype:
+            row = array(self._dtype, row)
+        if len(row) != self._row_size:
+            raise ValueError(f"Record should have {self._row_size} fields, but {len(row)} given")
+        return row
+
+    def __setitem__(self, key, row):
+        """
+        Assign record
+        :param key: Row number or any hashable when key map is used
+        :param row: Flat sequence of `prod(shape)` numbers
+        :return:
+        """
+        row = self._to_array(row)
+        ind = self._get_row(key, create=True)
+        self._reserve(ind + 1)
+        start = ind * self._row_size
+        self._view[start: start + self._row_size] = row
+        self._n_rows = max(self._n_rows, ind + 1)
+
+    def __getitem__(self, key):
+        """
+        Get record
+        :param key:
+        :return: flat `array` with record fields
+        """
+        start = self._get_row(key) * self._row_bytes
+        row = array(self._dtype)
+        row.frombytes(self._bytes[start: start + self._row_bytes])
+        return row
+
+    def __len__(self):
+        return self._n_rows if self._key_map is None else len(self._key_map)
+
+    def __del__(self):
+        self.close()
+
+    def append(self, row):
+        """
+        Add record after the last row
+        :param row: Flat sequence of `prod(shape)` numbers
+        :return: row number
+        """
+        if self._key_map is not None:
+            raise TypeError("Use keys to add records when key map is used")
+        ind = self._n_rows
+        self[ind] = row
+        return ind
+
+    def gather(self, keys):
+        """
+        Get several records at once. Rows that are adjacent in the file are copied with a single slice
+        :param keys: Iterable of keys
+        :return: flat `array` with records in the order of keys
+        """
+        gathered = array(self._dtype)
+        run_start = run_end = None
+        for ind in (self._get_row(key) for key in keys):
+            if ind == run_end:
+                run_end += 1
+                continue
+            if run_start is not None:
+                gathered.frombytes(self._bytes[run_start * self._row_bytes: run_end * self._row_bytes])
+            run_start, run_end = ind, ind + 1
+        if run_start is not None:
+            gathered.frombytes(self._bytes[run_start * self._row_bytes: run_end * self._row_bytes])
+        return gathered
+
+    def gather_numpy(self, keys):
+        """
+        Get several records at once as numpy array. When key map is not used and keys are passed as numpy array,
+        rows are gathered without Python loop
+        :param keys: Iterable of keys
+        :return: array with shape (len(keys), *shape)
+        """
+        try:
+            # noinspection PyPackageRequirements
+            import numpy as np
+        except ImportError:
+            raise ImportError("Install numpy: pip install numpy")
+
+        if self._key_map is not None:
+            rows = np.fromiter((self._get_row(key) for key in keys), dtype=np.int64)
+        else:
+            rows = np.asarray(keys, dtype=np.int64)
+            if rows.size > 0 and (rows.min() < 0 or rows.max() >= self._n_rows):
+                raise KeyError("Key does not exist")
+
+        data = np.frombuffer(self._bytes, dtype=self._dtype, count=self._n_rows * self._row_size)
+        return data.reshape((self._n_rows,) + self._shape)[rows]
+
+    def keys(self):
+        """
+        Get list of keys
+        :return:
+        """
+        if self._key_map is not None:
+            return list(self._key_map.keys())
+        return list(range(self._n_rows))
+
+    def _save_param(self):
+        pickle.dump(
+            [self._shape, self._dtype, self._n_rows, self._key_map],
+            open(self.path.joinpath("store_params"), "wb"), protocol=4
+        )
+
+    def save(self):
+        """
+        Save all required information for loading later from disk.
+        :return:
+        """
+        self._mm.flush()
+        self._save_param()
+
+    @classmethod
+    def load(cls, path):
+        shape, dtype, n_rows, key_map = pickle.load(open(Path(path).joinpath("store_params"), "rb"))
+        store = cls(path, shape=shape, dtype=dtype, key_map=key_map is not None)
+        store._n_rows = n_rows
+        store._key_map = key_map
+        return store
+
+    def close(self):
+        if self._is_open:
+            self.save()
+            self._unmap_data()
+            self._file.close()
+            self._is_open = False
@@ -0,0 +1,292 @@
+import mmap
+import os
+import struct
+from hashlib import blake2b
+from pathlib import Path
+
+_MASK_64 = (1 << 64) - 1
+
+
+class HashFileIndex:
+    """
+    HashFileIndex is an on-disk open-addressing hash table in a memory mapped file. It maps integer or string keys
+    to (shard, position, length) offsets of KVStore records. Collisions are resolved with linear probing. The table
+    doubles and rehashes when the load factor exceeds `max_load`. String keys are kept in a separate append-only
+    file and are compared on lookup, so hash collisions do not lead to wrong answers. Meant for internal use.
+    """
+    # key type (0 - int, 1 - str), number of slots, number of keys, bytes used in the file with string keys
+    _header = struct.Struct("<QQQQ")
+    # key hash (0 - empty slot), int key or offset of str key, length of str key, shard, position, length
+    _slot = struct.Struct("<QqQQQQ")
+    _key_types = (int, str)
+    _initial_capacity = 1024
+    _initial_keys_size = 2**16
+    _max_load = 0.7
+    _is_open = False
+
+    def __init__(self, path, read_only=False, key_type=int):
+        """
+        Create a HashFileIndex instance. If the file exists, existing table is opened and `key_type` is ignored
+        :param path: Path to the table file. String keys are stored in a file with `.keys` suffix
+        :param read_only: Open existing table for reading only
+        :param key_type: Type of keys: `int` or `str`
+        """
+        self.path = Path(path)
+        self._read_only = read_only
+        self._keys_path = Path(str(self.path) + ".keys")
+
+        if not self.path.is_file():
+            if read_only:
+                raise FileNotFoundError(f"Index does not exist: {self.path}")
+            if key_type not in self._key_types:
+                raise ValueError(f"Key type should be `int` or `str`, but `{key_type}` is provided.")
+            self._create_table(self.path, self._key_types.index(key_type), self._initial_capacity, 0)
+            with open(self._keys_path, "wb") as keys_file:
+                keys_file.truncate(self._initial_keys_size)
+
+        self._open()
+        self._is_open = True
+
+    def _create_table(self, path, key_type_id, capacity, keys_size):
+        with open(path, "wb") as table:
+            table.truncate(self._header.size + capacity * self._slot.size)
+            table.write(self._header.pack(key_type_id, capacity, 0, keys_size))
+
+    def _write_header(self, mm, capacity):
+        mm[:self._header.size] = self._header.pack(
+            self._key_types.index(self.key_type), capacity, self._count, self._keys_size
+        )
+
+    def _open(self):
+        access = mmap.ACCESS_READ if self._read_only else mmap.ACCESS_WRITE
+        mode = "rb" if self._read_only else "r+b"
+        self._file = open(self.path, mode)
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=access)
+        key_type_id, self._capacity, self._count, self._keys_size = self._header.unpack_from(self._mm)
+        self.key_type = self._key_types[key_type_id]
+
+        self._keys_file = open(self._keys_path, mode)
+        self._keys_mm = mmap.mmap(self._keys_file.fileno(), 0, access=access)
+
+    def _close_files(self):
+        self._mm.close()
+        self._file.close()
+        self._keys_mm.close()
+        self._keys_file.close()
+
+    def _hash(self, key):
+        if self.key_type is int:
+            # splitmix64 finalizer
+            h = (key + 0x9E3779B97F4A7C15) & _MASK_64
+            h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & _MASK_64
+            h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & _MASK_64
+            h ^= h >> 31
+        else:
+            h = int.from_bytes(blake2b(self._encode(key), digest_size=8).digest(), "little")
+        return h or 1
+
+    @staticmethod
+    def _encode(key):
+        return key.encode("utf-8", "surrogatepass")
+
+    def _verify_key(self, key):
+        if type(key) is not self.key_type:
+            raise TypeError(f"Key type should be {self.key_type.__name__} but given: ", type(key))
+
+    def _read_key(self, ref, len_):
+        return self._keys_mm[ref: ref + len_].decode("utf-8", "surrogatepass")
+
+    def _find_slot(self, key, h):
+        """
+        Find the slot of the key or the free slot where the key should be placed
+        :param key:
+        :param h: hash of the key
+        :return: tuple (slot, slot content or None for a free slot)
+        """
+        mask = self._capacity - 1
+        slot = h & mask
+        while True:
+            content = self._slot.unpack_from(self._mm, self._header.size + slot * self._slot.size)
+            slot_hash, ref, len_ = content[:3]
+            if slot_hash == 0:
+                return slot, None
+            if slot_hash == h and (ref == key if self.key_type is int else self._read_key(ref, len_) == key):
+                return slot, content
+            slot = (slot + 1) & mask
+
+    def __getitem__(self, key):
+        """
+        Retrieve offsets
+        :param key: Integer or string key
+        :return: tuple (shard_id, seek_position, len_bytes)
+        """
+        if type(key) is not self.key_type:
+            raise KeyError(key)
+        _, content = self._find_slot(key, self._hash(key))
+        if content is None:
+            raise KeyError(key)
+        return content[3:]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return type(key) is self.key_type and self._find_slot(key, self._hash(key))[1] is not None
+
+    def __len__(self):
+        return self._count
+
+    def __setitem__(self, key, value):
+        """
+        Add new entry or replace the old one
+        :param key: Integer or string key
+        :param value: Tuple (shard_id, seek_position, len_bytes)
+        :return:
+        """
+        if self._read_only:
+            raise RuntimeError("Index is opened in read-only mode")
+        self._verify_key(key)
+        if (self._count + 1) > self._capacity * self._max_load:
+            self._grow()
+
+        h = self._hash(key)
+        slot, content = self._find_slot(key, h)
+        if content is not None:
+            ref, len_ = content[1:3]
+        elif self.key_type is int:
+            ref, len_ = key, 0
+        else:
+            ref, len_ = self._append_key(key)
+        if content is None:
+            self._count += 1
+        shard, position, length = value
+        self._slot.pack_into(
+            self._mm, self._header.size + slot * self._slot.size, h, ref, len_, shard, position, length
+        )
+
+    def __delitem__(self, key):
+        """
+        Remove entry. Later entries of the probe sequence are moved back into the freed slot, so that lookups of
+        these entries do not stop at it. Bytes of string keys stay in the file with keys
+        :param key: Integer or string key
+        :return:
+        """
+        if self._read_only:
+            raise RuntimeError("Index is opened in read-only mode")
+        if type(key) is not self.key_type:
+            raise KeyError(key)
+        hole, content = self._find_slot(key, self._hash(key))
+        if content is None:
+            raise KeyError(key)
+
+        mask = self._capacity - 1
+        slot = (hole + 1) & mask
+        while True:
+            content = self._slot.unpack_from(self._mm, self._header.size + slot * self._slot.size)
+            if content[0] == 0:
+                break
+            home = content[0] & mask
+            # the entry can take the freed slot when the slot is between the home of the entry and the entry
+            if (slot - home) & mask >= (slot - hole) & mask:
+                self._slot.pack_into(self._mm, self._header.size + hole * self._slot.size, *content)
+                hole = slot
+            slot = (slot + 1) & mask
+        self._slot.pack_into(self._mm, self._header.size + hole * self._slot.size, 0, 0, 0, 0, 0, 0)
+        self._count -= 1
+
+    def _append_key(self, key):
+        encoded = self._encode(key)
+        ref = self._keys_size
+        if ref + len(encoded) > len(self._keys_mm):
+            self._keys_mm.resize(max(len(self._keys_mm) * 2, ref + len(encoded)))
+        self._keys_mm[ref: ref + len(encoded)] = encoded
+        self._keys_size += len(encoded)
+        return ref, len(encoded)
+
+    def _grow(self):
+        """
+        Double the table and rehash all entries into a new file that replaces the old one
+        :return:
+        """
+        capacity = self._capacity * 2
+        mask = capacity - 1
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        self._create_table(temp_path, self._key_types.index(self.key_type), capacity, self._keys_size)
+        with open(temp_path, "r+b") as table, mmap.mmap(table.fileno(), 0) as mm:
+            for content in self._iter_slots():
+                slot = content[0] & mask
+                while self._slot.unpack_from(mm, self._header.size + slot * self._slot.size)[0] != 0:
+                    slot = (slot + 1) & mask
+                self._slot.pack_into(mm, self._header.size + slot * self._slot.size, *content)
+            self._write_header(mm, capacity)
+            mm.flush()
+
+        self._close_files()
+        os.replace(temp_path, self.path)
+        self._open()
+
+    def _iter_slots(self):
+        for slot in range(self._capacity):
+            content = self._slot.unpack_from(self._mm, self._header.size + slot * self._slot.size)
+            if content[0] != 0:
+                yield content
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def items(self, start=None, stop=None):
+        """
+        Iterate over entries in the order of slots
+        :param start: Ordinal of the first entry
+        :param stop: Ordinal of the entry where iteration stops
+        :return: generator of tuples (key, (shard_id, seek_position, len_bytes))
+        """
+        start = start or 0
+        for ordinal, content in enumerate(self._iter_slots()):
+            if stop is not None and ordinal >= stop:
+                break
+            if ordinal < start:
+                continue
+            _, ref, len_ = content[:3]
+            key = ref if self.key_type is int else self._read_key(ref, len_)
+            yield key, content[3:]
+
+    def key_range(self, start, stop):
+        """
+        Iterate over entries with integer keys in range [start, stop) in the order of keys. Keys of narrow ranges
+        are looked up one by one. Ranges wider than the table are found with a single scan of the slots
+        :param start: First key of the range
+        :param stop: Key where the range ends
+        :return: generator of tuples (key, (shard_id, seek_position, len_bytes))
+        """
+        if self.key_type is not int:
+            raise TypeError("Range reads are supported only for integer keys")
+        if stop - start <= self._capacity:
+            for key in range(start, stop):
+                entry = self.get(key, None)
+                if entry is not None:
+                    yield key, entry
+            return
+        yield from sorted((key, entry) for key, entry in self.items() if start <= key < stop)
+
+    def save(self):
+        """
+        Write the table to disk
+        :return:
+        """
+        if not self._read_only:
+            self._write_header(self._mm, self._capacity)
+            self._mm.flush()
+            self._keys_mm.flush()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._is_open:
+            self.save()
+            self._close_files()
+            self._is_open = False
@@ -1,18 +1,100 @@
+import hashlib
+import heapq
+import io
 import logging
+import math
 import os
+import random
 import sys
+import threading
+import weakref
+from array import array
 from collections import OrderedDict
+from contextlib import nullcontext
+from functools import wraps
+from itertools import islice
 from pathlib import Path
 from typing import Optional, Union
 
 import shelve
 import dill as pickle
 
-from nhkv.dbdict.sqlitedbdict import SqliteDbDict
-from nhkv.DbOffsetStorage import DbOffsetStorage
+from nhkv.DbOffsetStorage import DbOffsetStorage, HashedKeyOffsetStorage
+from nhkv.HashFileIndex import HashFileIndex
 from nhkv.CompactStorage import CompactStorage
+from nhkv.Prefetcher import Prefetcher
+from nhkv.ReadWriteLock import ReadWriteLock, NoLock
+from nhkv.StorePartition import StorePartition
+from nhkv.ValueStream import ValueReader, ValueWriter
 import mmap
 
+# storages with buffered shard data that should be flushed before the process is forked
+_live_stores = weakref.WeakSet()
+# index handles inherited from the parent process are neither used nor closed in a forked child
+_inherited_handles = []
+
+
+def _prepare_stores_for_fork():
+    for store in list(_live_stores):
+        store._prepare_for_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_prepare_stores_for_fork)
+
+# high bits of the length field in the offset index mark entries that do not point to a serialized value directly
+_LENGTH_MASK = (1 << 60) - 1
+_STREAMED_VALUE = 1 << 60  # entry points to the list of extents of a value written with `open_value_writer`
+_INLINE_VALUE = 1 << 61  # entry points to a small value kept in the inline arena instead of a shard
+
+_ACCESS_PATTERNS = {
+    "normal": "MADV_NORMAL",
+    "random": "MADV_RANDOM",
+    "sequential": "MADV_SEQUENTIAL",
+}
+
+
+def _advise(mm, access_pattern):
+    """
+    Pass access pattern hint for the memory mapped file to the kernel. Does nothing on platforms where `madvise` is
+    not available
+    """
+    flag = getattr(mmap, _ACCESS_PATTERNS[access_pattern], None)
+    if flag is not None and hasattr(mm, "madvise"):
+        mm.madvise(flag)
+
+
+def _reading(method):
+    """
+    Run the method under the read lock of the storage
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.read():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _writing(method):
+    """
+    Run the method under the write lock of the storage
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.write():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _release_pages(f, mm):
+    """
+    Release pages of a scanned shard, so that page cache is not filled with data that will not be read again
+    """
+    if hasattr(mmap, "MADV_DONTNEED") and hasattr(mm, "madvise"):
+        mm.madvise(mmap.MADV_DONTNEED)
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
 
 class CompactKeyValueStore:
     """
@@ -23,30 +105,81 @@ class CompactKeyValueStore:
     _index: CompactStorage = None
     _key_map = None
     _is_open = False
+    _read_only = False
+    _pid = None
+    _allocation = None
+    _headroom = 0.
+    _value_hashes = None
+    _value_refs = None
+    _inline_threshold = 0
+    _inline_arena = None
+    _inline_file = None
+    _inline_free = None
+    _inline_released = None
+    _deleted = 0
+    _max_range_read = 2**24  # upper bound for a single read of contiguous records
+    _thread_safe = False
+    _lock = NoLock()
+    _shard_lock = nullcontext()
 
     _opened_shards = None
     _shard_for_write = 0
     _written_in_current_shard = 0
     _shard_size = 0
 
-    def __init__(self, path, shard_size=2**30, serializer=None, deserializer=None, **kwargs):
+    def __init__(
+            self, path, shard_size=2**30, serializer=None, deserializer=None, read_only=False, access_pattern="normal",
+            max_opened_shards=10, read_engine="mmap", pread_threshold=2**16, deduplicate=False, inline_threshold=0,
+            thread_safe=False, **kwargs
+    ):
         """
         Initialize CompactKeyValueStore instance
         :param path: Path to the location, where the storage will be created
         :param shard_size: Size of a single shard in bytes
         :param serializer: Function for serializing values. Must return bytes
         :param deserializer: Function for deserializing values. Takes in a bytes
+        :param read_only: Open storage for reading only. Shards are mapped read-only, the lock file is ignored and
+        any attempt to write raises an exception
+        :param access_pattern: Expected access pattern for shards: `normal`, `random` or `sequential`. Passed to the
+        kernel with `madvise` to control readahead. Scanning methods accept overrides for a single call
+        :param max_opened_shards: Maximum number of shards that are kept open. The same budget applies separately to
+        file descriptors cached by `pread` engine
+        :param read_engine: Engine for reading values: `mmap` maps shards into memory, `pread` reads values with
+        `os.pread` from cached file descriptors without mapping shards, `auto` uses `pread` for values smaller than
+        `pread_threshold` and `mmap` otherwise. `pread` is useful for random reads over a large number of shards
+        :param pread_threshold: Value size in bytes, below which `auto` engine reads values with `pread`
+        :param deduplicate: Store identical serialized values only once. Values are identified by content hash, and
+        reference counts are kept for shared records. Hashes are kept in memory and saved with store parameters
+        :param inline_threshold: Serialized values shorter than the threshold are kept in a memory arena next to the
+        offset index instead of shards. Reading such values does not touch shard files. Values are written to the
+        arena file before the index points to them. Space of overwritten values is reused by values of the same
+        length after the next `save`
+        :param thread_safe: Allow using the storage from several threads. Reads (`get`, `[]`, `in`) run
+        concurrently, writes (`[]=`, `save`, `close`) wait for running reads and block new ones. Iteration and
+        streaming methods are not synchronized
         :param kwargs: additional parameters to be passed to offset storage initializer and file index
         initializer
         """
         self.path = Path(path)
+        self._read_only = read_only
 
         self._init_serializers(serializer, deserializer)
-        self._initialize_file_index(shard_size, **kwargs)
+        self._init_locks(thread_safe)
+        self._init_access_pattern(access_pattern)
+        self._initialize_file_index(
+            shard_size, max_opened_shards=max_opened_shards, read_engine=read_engine, pread_threshold=pread_threshold
+        )
         self._initialize_offset_index(**kwargs)
+        self._initialize_value_hashes(deduplicate)
+        self._inline_threshold = inline_threshold
+        self._inline_arena = bytearray()
+        self._inline_free = dict()  # (length, [positions of free slots in the arena])
+        self._inline_released = []  # (length, position) of slots released after the last save
         self._check_dir_exists()
 
         self._is_open = True
+        self._pid = os.getpid()
+        _live_stores.add(self)
 
     def _init_serializers(self, serializer, deserializer):
         """
@@ -54,9 +187,12 @@ class CompactKeyValueStore:
         :param deserializer:
         :return:
         """
+        self._options = {}
+
         if serializer is not None and deserializer is not None:
             self._serialize = serializer
             self._deserialize = deserializer
+            self._options.update(serializer=serializer, deserializer=deserializer)
             return
 
         if (
@@ -68,28 +204,147 @@ class CompactKeyValueStore:
         self._serialize = lambda value: pickle.dumps(value, protocol=4, fix_imports=False)
         self._deserialize = lambda value: pickle.loads(value)
 
-    # noinspection PyUnusedLocal
-    def _initialize_file_index(self, shard_size, **kwargs):
+    def _init_locks(self, thread_safe):
+        self._thread_safe = thread_safe
+        self._lock = ReadWriteLock() if thread_safe else NoLock()
+        # readers share the cache of opened shards
+        self._shard_lock = threading.Lock() if thread_safe else nullcontext()
+        if thread_safe:
+            self._options["thread_safe"] = True
+
+    def _init_access_pattern(self, access_pattern):
+        self._check_access_pattern(access_pattern)
+        self._access_pattern = access_pattern
+        if access_pattern != "normal":
+            self._options["access_pattern"] = access_pattern
+
+    @staticmethod
+    def _check_access_pattern(access_pattern):
+        if access_pattern not in _ACCESS_PATTERNS:
+            raise ValueError(
+                f"`access_pattern` should be one of {list(_ACCESS_PATTERNS)}, but `{access_pattern}` is provided."
+            )
+
+    def _initialize_file_index(self, shard_size, max_opened_shards=10, read_engine="mmap", pread_threshold=2**16):
         """
         Initialize file index
         :param shard_size: shard size in bytes
-        :param kwargs: no additional parameters are used at the moment
+        :param max_opened_shards: maximum number of opened shards
+        :param read_engine: `mmap`, `pread` or `auto`
+        :param pread_threshold: values smaller than the threshold are read with `pread` by `auto` engine
         :return:
         """
+        if max_opened_shards < 1:
+            raise ValueError(f"`max_opened_shards` should be positive, but {max_opened_shards} given")
+        if read_engine not in ("mmap", "pread", "auto"):
+            raise ValueError(f"`read_engine` should be `mmap`, `pread` or `auto`, but `{read_engine}` is provided.")
+
         self._file_index = dict()  # (shard, filename)
         self._opened_shards = OrderedDict()  # (shard, file, mmap object) if mmap is none -> opened for write
+        self._opened_descriptors = OrderedDict()  # (shard, file descriptor) used by pread engine
         self._shard_for_write = 0
         self._written_in_current_shard = 0
         self._shard_size = shard_size
+        self._max_opened_shards = max_opened_shards
+        self._read_engine = read_engine if hasattr(os, "pread") else "mmap"
+        self._pread_threshold = pread_threshold
 
-    def _initialize_offset_index(self, **kwargs):
+        if max_opened_shards != 10:
+            self._options["max_opened_shards"] = max_opened_shards
+        if read_engine != "mmap":
+            self._options.update(read_engine=read_engine, pread_threshold=pread_threshold)
+
+    def _initialize_offset_index(self, allocation=None, headroom=0.25, **kwargs):
         """
         Initialize offset storage
+        :param allocation: Allocation policy for new records. By default, records occupy exactly as much space as
+        needed, and updated value is overwritten in place only when its size does not change. `size_class` rounds
+        record size up to one of size classes (at most 25% of slack), `headroom` reserves `headroom` fraction of
+        value size. The capacity of the record is stored in the index, and updated value is overwritten in place
+        while it fits
+        :param headroom: Fraction of value size reserved with `headroom` allocation policy
         :param kwargs: no additional parameters are used at the moment
         :return:
         """
+        if allocation not in (None, "size_class", "headroom"):
+            raise ValueError(
+                f"`allocation` should be None, `size_class` or `headroom`, but `{allocation}` is provided."
+            )
+        self._allocation = allocation
+        self._headroom = headroom
         self._key_map = dict()
-        self._index = CompactStorage(3, dtype="L")  # third of space is wasted to shards
+        if allocation is None:
+            # 64-bit fields keep flags in the high bits of the length
+            self._index = CompactStorage(3, dtype="Q")  # third of space is wasted to shards
+        else:
+            self._index = CompactStorage(4, dtype="Q")  # (shard, position, length, capacity)
+
+    def _get_capacity(self, len_):
+        """
+        Compute size of the record for a value according to allocation policy
+        :param len_: Size of serialized value
+        :return: capacity in bytes or None if the policy is not set
+        """
+        if self._allocation == "size_class":
+            # four size classes between consecutive powers of two
+            step = max(1 << max(len_.bit_length() - 3, 0), 8)
+            return -(-len_ // step) * step
+        if self._allocation == "headroom":
+            return len_ + int(math.ceil(len_ * self._headroom))
+        return None
+
+    def _initialize_value_hashes(self, deduplicate):
+        if deduplicate:
+            self._value_hashes = dict()  # (hash, (shard, position, length))
+            self._value_refs = dict()  # ((shard, position), [hash, reference count])
+        else:
+            self._value_hashes = None
+            self._value_refs = None
+
+    @staticmethod
+    def _hash_value(serialized):
+        return hashlib.blake2b(serialized, digest_size=16).digest()
+
+    def _set_duplicate(self, key, digest):
+        """
+        Point the key to an existing record with the same content
+        :return: True if such record exists
+        """
+        entry = self._value_hashes.get(digest, None)
+        if entry is None:
+            return False
+        self._value_refs[entry[:2]][1] += 1
+        self._set_entry(key, entry)
+        return True
+
+    def _register_value(self, digest, entry):
+        self._value_hashes[digest] = entry[:3]
+        self._value_refs[entry[:2]] = [digest, 1]
+
+    def _release_entry(self, entry):
+        """
+        Decrease reference count for a record that is no longer used by the key
+        """
+        if entry[2] & _INLINE_VALUE:
+            if entry[2] & _LENGTH_MASK:
+                # the index saved earlier can still point to the slot, so it is reused only after the next save
+                self._inline_released.append((entry[2] & _LENGTH_MASK, entry[1]))
+            return
+        if self._value_refs is None or not self._is_plain_entry(entry[2]):
+            return  # streamed entries are not shared, and their positions are not shard positions
+        refs = self._value_refs.get(entry[:2], None)
+        if refs is None:
+            return
+        refs[1] -= 1
+        if refs[1] == 0:
+            del self._value_refs[entry[:2]]
+            del self._value_hashes[refs[0]]
+
+    def _is_shared_entry(self, entry):
+        return (
+            self._value_refs is not None and self._is_plain_entry(entry[2]) and
+            self._value_refs.get(entry[:2], (None, 0))[1] > 1
+        )
 
     def _init_storage(self, size):
         self._index._active_storage_size = size
@@ -104,11 +359,131 @@ class CompactKeyValueStore:
         triplet = self._index[key]
         if triplet is None:
             raise KeyError(f"Key not found: {key}")
-        shard, pos, len_ = triplet
+        return self._read_entry(*triplet[:3])
+
+    def _read_entry(self, shard, pos, len_):
         if len_ == 0:
             raise ValueError("Entry length is 0")
-        _, mm = self._reading_mode(shard)
-        return self._deserialize(mm[pos: pos + len_])
+        if len_ & _INLINE_VALUE:
+            return self._deserialize(self._read_inline(pos, len_))
+        if len_ & _STREAMED_VALUE:
+            with ValueReader(self, self._get_extents(shard, pos, len_)) as reader:
+                return self._deserialize(reader.readall())
+        return self._deserialize(self._read_bytes(shard, pos, len_))
+
+    def _read_bytes(self, shard, pos, len_):
+        if self._read_engine == "pread" or self._read_engine == "auto" and len_ < self._pread_threshold:
+            if not self._thread_safe:
+                return self._pread(shard, pos, len_)
+            with self._shard_lock:
+                # cached descriptor can be closed by another reader, while the duplicate stays valid
+                fd = os.dup(self._get_descriptor(shard))
+            try:
+                # the lock is not held during the read, so reads from several threads run in parallel
+                return os.pread(fd, len_, pos)
+            finally:
+                os.close(fd)
+        with self._shard_lock:
+            # copying from the mapping holds the GIL, so keeping the lock does not serialize reads any further
+            _, mm = self._reading_mode(shard)
+            return mm[pos: pos + len_]
+
+    def _read_inline(self, pos, len_):
+        len_ &= _LENGTH_MASK
+        with memoryview(self._inline_arena) as arena:
+            return bytes(arena[pos: pos + len_])
+
+    def _set_inline_entry(self, key, serialized):
+        """
+        Write a small value to the inline arena. The value is written to the arena file before the index points to
+        it, so that the index never points to bytes that are missing on disk, even when the index is committed
+        before `save`. Free slots of the same length are reused
+        """
+        len_ = len(serialized)
+        positions = self._inline_free.get(len_, None)
+        if positions:
+            pos = positions.pop()
+            if not positions:
+                del self._inline_free[len_]
+            self._inline_arena[pos: pos + len_] = serialized
+        else:
+            pos = len(self._inline_arena)
+            self._inline_arena.extend(serialized)
+        if len_ > 0:
+            arena_file = self._get_inline_file()
+            arena_file.seek(pos)
+            arena_file.write(serialized)
+            arena_file.flush()
+        self._set_entry(key, (0, pos, len_ | _INLINE_VALUE))
+
+    def _get_inline_file(self):
+        if self._inline_file is None:
+            arena_path = self.path.joinpath("inline_values")
+            self._inline_file = open(arena_path, "r+b" if arena_path.is_file() else "w+b")
+        return self._inline_file
+
+    def _save_inline_values(self):
+        """
+        Make slots released since the last save available for reuse. Should be called after the index is saved
+        """
+        for len_, pos in self._inline_released:
+            self._inline_free.setdefault(len_, []).append(pos)
+        self._inline_released = []
+
+    def _load_inline_values(self):
+        arena_path = self.path.joinpath("inline_values")
+        if arena_path.is_file():
+            with open(arena_path, "rb") as arena:
+                self._inline_arena = bytearray(arena.read())
+
+    @staticmethod
+    def _is_plain_entry(len_):
+        """
+        Check that the entry points to a serialized value stored as a single record
+        """
+        return len_ <= _LENGTH_MASK
+
+    def _get_extents(self, shard, pos, len_):
+        """
+        Get locations of the parts of the value
+        :return: list of tuples (shard, position, length)
+        """
+        if len_ & _STREAMED_VALUE:
+            extents = array("Q")
+            extents.frombytes(self._read_bytes(shard, pos, len_ & _LENGTH_MASK))
+            return [tuple(extents[i: i + 3]) for i in range(0, len(extents), 3)]
+        return [(shard, pos, len_)]
+
+    def _set_streamed_entry(self, key, extents):
+        extents = array("Q", [field for extent in extents for field in extent])
+        shard, pos, len_ = self._write_record(extents.tobytes())
+        self._set_entry(key, (shard, pos, len_ | _STREAMED_VALUE))
+
+    def _pread(self, id_, pos, len_):
+        return os.pread(self._get_descriptor(id_), len_, pos)
+
+    def _get_descriptor(self, id_):
+        """
+        Get cached file descriptor of the shard for `pread` engine
+        """
+        self._check_process()
+        if not self._read_only:
+            self._unlock_storage()
+            if id_ in self._opened_shards and self._opened_shards[id_][1] is None:
+                self._opened_shards[id_][0].flush()  # data can remain in the buffer of the file opened for write
+
+        if id_ in self._opened_descriptors:
+            self._opened_descriptors.move_to_end(id_, last=True)
+            fd = self._opened_descriptors[id_]
+        else:
+            if id_ not in self._file_index:
+                self._file_index[id_] = self._get_name_format(id_)
+            fd = os.open(self.path.joinpath(self._file_index[id_]), os.O_RDONLY)
+            self._opened_descriptors[id_] = fd
+            if len(self._opened_descriptors) > self._max_opened_shards:
+                _, fd_ = self._opened_descriptors.popitem(last=False)
+                os.close(fd_)
+        return fd
 
     @staticmethod
     def _get_name_format(id_):
@@ -116,8 +491,13 @@ class CompactKeyValueStore:
 
     def _open_for_read(self, name):
         # raise file not exists
-        f = open(self.path.joinpath(name), "r+b")
-        mm = mmap.mmap(f.fileno(), 0)
+        if self._read_only:
+            f = open(self.path.joinpath(name), "rb")
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            f = open(self.path.joinpath(name), "r+b")
+            mm = mmap.mmap(f.fileno(), 0)
+        _advise(mm, self._access_pattern)
         return f, mm
 
     def _open_for_write(self, name):
@@ -128,14 +508,18 @@ class CompactKeyValueStore:
     def _check_dir_exists(self):
         self.path.mkdir(exist_ok=True, parents=True)
 
-    def _close_some_files_if_too_many_opened(self, id_, max_opened_shards_limit=10):
+    def _close_some_files_if_too_many_opened(self, id_):
         self._opened_shards.move_to_end(id_, last=True)
-        if len(self._opened_shards) >= max_opened_shards_limit:
+        if len(self._opened_shards) > self._max_opened_shards:
             _, shard = self._opened_shards.popitem(last=False)
             if shard[1] is not None:
                 shard[1].close()
             shard[0].close()
 
+    def _check_writable(self):
+        if self._read_only:
+            raise RuntimeError("Storage is opened in read-only mode")
+
     def _lock_error(self):
         raise RuntimeError(
             "Storage is locked. Make sure you called `save` when wrote data to the storage during the previous run"
@@ -171,7 +555,59 @@ class CompactKeyValueStore:
             else:
                 self._lock_error()
 
+    def _check_process(self):
+        """
+        Make sure that opened shards and index belong to the current process. Storage is reopened in read-only mode
+        after it is unpickled or inherited by a forked process
+        """
+        if self._pid != os.getpid():
+            self._reopen()
+
+    def _reopen(self):
+        if self._index is None:  # unpickled handle
+            loaded = self.load(self.path, read_only=True, **self._options)
+            self.__dict__.update(loaded.__dict__)
+        else:  # forked process, index kept in memory is still valid
+            for shard in self._opened_shards.values():
+                for s in shard[::-1]:
+                    if s:
+                        s.close()
+            self._opened_shards = OrderedDict()
+            for fd in self._opened_descriptors.values():
+                os.close(fd)
+            self._opened_descriptors = OrderedDict()
+            self._read_only = True
+            # locks can be held by threads that do not exist in the child
+            self._init_locks(self._thread_safe)
+        self._pid = os.getpid()
+
+    def _prepare_for_fork(self):
+        """
+        Flush file buffers of shards opened for write. Otherwise, buffered data is written by both processes when the
+        child closes inherited files. The index is not saved, so forked children see the storage in the state of the
+        last `save`, except for CompactKeyValueStore, which keeps the index in memory
+        """
+        if self._is_open and not self._read_only and self._pid == os.getpid():
+            for shard in self._opened_shards.values():
+                if shard[1] is None:
+                    shard[0].flush()
+
+    def __getstate__(self):
+        """
+        Storage is pickled as a lightweight handle that holds only the location and options. The handle is reopened
+        in read-only mode on the first access, and sees only the data that was saved. `copy.copy` and `copy.deepcopy`
+        rely on pickling as well, so copies of a storage are read-only handles too.
+        """
+        return {"path": self.path, "_options": pickle.dumps(self._options, protocol=4)}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._options = pickle.loads(state["_options"])
+        self._read_only = True
+
     def _writing_mode(self, id_):
+        self._check_process()
+        self._check_writable()
         self._lock_storage()
 
         if id_ not in self._opened_shards:
@@ -187,7 +623,9 @@ class CompactKeyValueStore:
         return self._opened_shards[id_]
 
     def _reading_mode(self, id_):
-        self._unlock_storage()
+        self._check_process()
+        if not self._read_only:
+            self._unlock_storage()
 
         if id_ not in self._opened_shards:
             if id_ not in self._file_index:
@@ -218,7 +656,14 @@ class CompactKeyValueStore:
             "_written_in_current_shard",
             "_shard_size",
             "path",
-            "_key_map"
+            "_key_map",
+            "_allocation",
+            "_headroom",
+            "_value_hashes",
+            "_value_refs",
+            "_inline_threshold",
+            "_deleted",
+            "_inline_free",
         ]
 
     def _save_param(self):
@@ -231,7 +676,8 @@ class CompactKeyValueStore:
         params = pickle.load(open(self.path.joinpath("store_params"), "rb"))
         variable_names = self._get_variables_for_saving()
 
-        assert len(params) == len(variable_names)
+        # storages saved by earlier versions do not have variables added later
+        assert len(params) <= len(variable_names)
         runtime_version = params.pop(0)
         class_name = params.pop(0)
         assert runtime_version == self._runtime_version
@@ -251,19 +697,107 @@ class CompactKeyValueStore:
             for s in shard[::-1]:
                 if s:
                     s.flush()
+        for fd in self._opened_descriptors.values():
+            os.close(fd)
+        self._opened_descriptors.clear()
 
     def _flush_shards(self):
         for shard in self._opened_shards.values():
             if shard[1] is not None:
                 shard[1].flush()
+            else:  # opened for write, data can remain in the file buffer
+                shard[0].flush()
+
+    def _iter_index(self, start=None, stop=None):
+        """
+        Iterate over index entries in the order they were added
+        :param start: Ordinal of the first entry
+        :param stop: Ordinal of the entry where iteration stops
+        :return: generator of tuples (key, shard, position, length)
+        """
+        self._check_process()
+        keys = self._key_map.keys() if self._key_map is not None else range(len(self._index))
+        for id_, key in islice(enumerate(keys), start, stop):
+            yield (key,) + self._index[id_][:3]
+
+    def _shard_sizes(self):
+        sizes = {}
+        for id_, name in self._file_index.items():
+            shard_path = self.path.joinpath(name)
+            sizes[id_] = shard_path.stat().st_size if shard_path.is_file() else 0
+        return sizes
+
+    def _iter_partition(self, partition):
+        if partition.shards is not None:
+            shards = set(partition.shards)
+            # only the parts of the index that hold records of the shards are scanned
+            spans = [(None, None)] if partition.spans is None else partition.spans
+            # inline values are not kept in shards and belong to the first partition
+            entries = (
+                entry for start, stop in spans for entry in self._iter_index(start, stop) if
+                (partition.partition_id == 0 if entry[3] & _INLINE_VALUE else entry[1] in shards)
+            )
+        else:
+            entries = self._iter_index(*partition.span)
+
+        yield from self._read_entries(entries)
 
+    def _read_entries(self, entries, access_pattern=None):
+        """
+        Read records for index entries
+        :param entries: Iterable of tuples (key, shard, position, length)
+        :param access_pattern: Access pattern hint for shards that are read during this call. Pages of shards are
+        released after a `sequential` scan. The storage access pattern is restored when the call is complete
+        :return: generator of key-value pairs
+        """
+        if access_pattern is None:
+            for key, shard, pos, len_ in entries:
+                if len_ == 0:
+                    continue
+                yield key, self._read_entry(shard, pos, len_)
+            return
+
+        self._check_access_pattern(access_pattern)
+        advised = {}
+        last_shard = None
+        try:
+            for key, shard, pos, len_ in entries:
+                if len_ == 0:
+                    continue
+                if shard != last_shard and self._is_plain_entry(len_):
+                    if access_pattern == "sequential" and last_shard in advised:
+                        f, mm = advised[last_shard]
+                        if not mm.closed:
+                            _release_pages(f, mm)
+                    f, mm = self._reading_mode(shard)
+                    if advised.get(shard, (None, None))[1] is not mm:
+                        _advise(mm, access_pattern)
+                        advised[shard] = (f, mm)
+                    last_shard = shard
+                yield key, self._read_entry(shard, pos, len_)
+        finally:
+            for f, mm in advised.values():
+                if mm.closed:
+                    continue
+                if access_pattern == "sequential":
+                    _release_pages(f, mm)
+                _advise(mm, self._access_pattern)
+
+    @_reading
     def __contains__(self, item):
-        raise NotImplementedError("This operation is too expensive. Use `get` instead.")
-        # triplet = self._index[item]
-        # if triplet is None:
-        #     return False
-        # return True
+        """
+        Check whether the key exists. Only the offset index is probed, value bytes are not read
+        :param item:
+        :return:
+        """
+        self._check_process()
+        if self._key_map is not None:
+            return item in self._key_map and self._index[self._key_map[item]][2] != 0
+        if not isinstance(item, int) or item < 0 or item >= len(self._index):
+            return False
+        return self._index[item][2] != 0
 
+    @_writing
     def __setitem__(self, key, value):
         """
         Set item
@@ -271,66 +805,230 @@ class CompactKeyValueStore:
         :param value:
         :return:
         """
-        if self._key_map is not None:
-            if key in self._key_map:
-                key_: Optional[int] = self._key_map[key]
-            else:
-                key_ = None
-        else:
-            if not isinstance(key, int):
-                raise ValueError("Keys should be integers when no key map is available")
-            key_: Optional[int] = key
+        self._check_process()
+        self._check_writable()
+
+        key_ = self._find_id(key)
 
         serialized = self._serialize(value)
 
+        if len(serialized) < self._inline_threshold:
+            self._set_inline_entry(key, serialized)
+            return
+
+        digest = None
+        if self._value_hashes is not None:
+            digest = self._hash_value(serialized)
+            if self._set_duplicate(key, digest):
+                return
+
         if key_ is not None:
             try:
                 # check if there is an entry with such key
-                existing_shard, existing_pos, existing_len = self._index[key_]
+                existing = self._index[key_]
             except IndexError:
                 pass
             else:
-                if len(serialized) == existing_len:
+                existing_shard, existing_pos, existing_len = existing[:3]
+                if self._allocation is None:
+                    fits = len(serialized) == existing_len
+                else:
+                    fits = len(serialized) <= existing[3]
+                if fits and existing_len != 0 and self._is_plain_entry(existing_len) and \
+                        not self._is_shared_entry(existing):
                     # successfully retrieved existing position and can overwrite old data
                     _, mm = self._reading_mode(existing_shard)
-                    mm[existing_pos: existing_pos + existing_len] = serialized
+                    mm[existing_pos: existing_pos + len(serialized)] = serialized
+                    entry = (existing_shard, existing_pos, len(serialized)) + existing[3:]
+                    if len(serialized) != existing_len:
+                        self._index[key_] = entry
+                    if digest is not None:
+                        self._release_entry(existing)
+                        self._register_value(digest, entry)
                     return
 
-        # the key is new or the data size is different
+        # the key is new or the data does not fit
+        entry = self._write_record(serialized, capacity=self._get_capacity(len(serialized)))
+        if digest is not None:
+            self._register_value(digest, entry)
+        self._set_entry(key, entry)
+
+    def _verify_key_type(self, key):
+        if self._key_map is None and not isinstance(key, int):
+            raise ValueError("Keys should be integers when no key map is available")
+
+    def _find_id(self, key) -> Optional[int]:
+        """
+        Find position of the key in the offset index
+        :param key:
+        :return: position in the index or None if the key is new
+        """
+        self._verify_key_type(key)
+        if self._key_map is not None:
+            return self._key_map.get(key, None)
+        return key
+
+    def _write_record(self, serialized, capacity=None):
+        """
+        Append data to the current shard
+        :param serialized: bytes
+        :param capacity: Size of the record. Remaining space is filled with zeros
+        :return: tuple (shard, position, length) or (shard, position, length, capacity) when capacity is given
+        """
         f, _ = self._writing_mode(self._shard_for_write)
         position = f.tell()
         written = f.write(serialized)
-        to_index = (self._shard_for_write, position, written)
+        entry = (self._shard_for_write, position, written)
+        if capacity is not None:
+            f.write(bytes(capacity - written))
+            entry += (capacity,)
+            written = capacity
+        self._increment_byte_count(written)
+        return entry
+
+    def _set_entry(self, key, entry):
+        """
+        Point the key to a new location
+        :param key:
+        :param entry: tuple (shard, position, length)
+        :return:
+        """
+        if self._allocation is not None and len(entry) == 3:
+            entry += (0,)  # record without slack space
+        key_ = self._find_id(key)
         if key_ is None or key_ == len(self._index):
-            index_key = self._index.append(to_index)
+            index_key = self._index.append(entry)
             if self._key_map is not None:
                 self._key_map[key] = index_key
         else:
-            self._index[key_] = to_index
+            existing = self._index[key_]
+            if existing[2] == 0:
+                # the key was deleted, its entry does not point to a record
+                if self._deleted > 0:
+                    self._deleted -= 1
+            else:
+                self._release_entry(existing)
+            self._index[key_] = entry
 
-        self._increment_byte_count(written)
+    @_writing
+    def __delitem__(self, key):
+        """
+        Delete the key. The space occupied by the value is not reclaimed
+        :param key:
+        :return:
+        """
+        self._check_process()
+        self._check_writable()
+        key_ = self._get_id(key)
+        existing = self._index[key_]
+        if existing[2] == 0:
+            raise KeyError("Key does not exist:", key)
+        self._release_entry(existing)
+        # the key keeps its place in the index, so that the order of entries does not change
+        self._index[key_] = (0,) * len(existing)
+        self._deleted += 1
 
+    @_reading
     def __getitem__(self, key):
         """
         Get value from key.
         :param key:
         :return:
         """
+        self._check_process()
+        if isinstance(key, slice):
+            return self._get_slice(key)
+        key_ = self._get_id(key)
+        try:
+            return self._get_with_id(key_)
+        except ValueError:
+            raise KeyError("Key does not exist:", key)
+
+    def _get_slice(self, key):
+        if key.step is not None:
+            raise ValueError("Slices with step are not supported")
+        if key.stop is None:
+            raise ValueError("Slice should have the end of the range")
+        return [value for _, value in self.get_range(0 if key.start is None else key.start, key.stop)]
+
+    def _iter_range_entries(self, start, stop):
+        if self._key_map is None:
+            keys = range(max(start, 0), min(stop, len(self._index)))
+        elif stop - start <= len(self._key_map):
+            keys = (key for key in range(start, stop) if key in self._key_map)
+        else:
+            # wide ranges with few keys are found without probing every integer of the range
+            keys = sorted(key for key in self._key_map if type(key) is int and start <= key < stop)
+        for key in keys:
+            yield (key,) + self._index[self._get_id(key)][:3]
+
+    def get_range(self, start, stop):
+        """
+        Get records for integer keys in range [start, stop). Missing keys are skipped. Records that are stored next to
+        each other are read with a single slice. Values are deserialized lazily
+        :param start: First key of the range
+        :param stop: Key where the range ends
+        :return: generator of key-value pairs in the order of keys
+        """
+        self._check_process()
+        if not isinstance(start, int) or not isinstance(stop, int):
+            raise TypeError("Range reads are supported only for integer keys")
+
+        run = []
+        run_bytes = 0
+        for entry in self._iter_range_entries(start, stop):
+            key, shard, pos, len_ = entry
+            if len_ == 0:
+                continue
+            if run and (
+                    not self._is_plain_entry(len_) or run[-1][1] != shard or sum(run[-1][2:]) != pos or
+                    run_bytes + len_ > self._max_range_read
+            ):
+                yield from self._read_run(run)
+                run = []
+                run_bytes = 0
+            if not self._is_plain_entry(len_):
+                yield key, self._read_entry(shard, pos, len_)
+                continue
+            run.append(entry)
+            run_bytes += len_
+        yield from self._read_run(run)
+
+    def _read_run(self, run):
+        """
+        Read records that are stored next to each other
+        :param run: List of tuples (key, shard, position, length)
+        :return: generator of key-value pairs
+        """
+        if not run:
+            return
+        _, shard, first, _ = run[0]
+        _, _, last, last_len = run[-1]
+        data = self._read_bytes(shard, first, last + last_len - first)
+        for key, _, pos, len_ in run:
+            yield key, self._deserialize(data[pos - first: pos - first + len_])
+
+    def _get_id(self, key):
         if self._key_map is not None:
             if key not in self._key_map:
                 raise KeyError("Key does not exist:", key)
-            key_ = self._key_map[key]
+            return self._key_map[key]
         else:
-            key_ = key
-            if key_ >= len(self._index):
+            if key >= len(self._index):
                 raise KeyError("Key does not exist:", key)
-        try:
-            return self._get_with_id(key_)
-        except ValueError:
-            raise KeyError("Key does not exist:", key)
+            return key
+
+    def _get_entry(self, key):
+        """
+        Find location of the record
+        :param key:
+        :return: tuple (shard, position, length)
+        """
+        return self._index[self._get_id(key)][:3]
 
     def __len__(self):
-        return len(self._index)
+        self._check_process()
+        return len(self._index) - self._deleted
 
     def __del__(self):
         pass  # throws exception on shutdown
@@ -341,18 +1039,106 @@ class CompactKeyValueStore:
         Get list of keys
         :return:
         """
+        self._check_process()
         if self._key_map is not None:
+            if self._deleted:
+                return [key for key, id_ in self._key_map.items() if self._index[id_][2] != 0]
             return list(self._key_map.keys())
         else:
             return list(range(len(self)))
 
-    def items(self):
+    def items(self, access_pattern=None):
         """
         Returns generator for key-value pairs
+        :param access_pattern: Override storage access pattern for this scan
         :return:
         """
-        for key in self.keys():
-            yield key, self[key]
+        yield from self._read_entries(self._iter_index(), access_pattern=access_pattern)
+
+    def iter_shuffled(self, seed=0, block_bytes=2**22, buffer_size=1024, epoch=0, access_pattern=None):
+        """
+        Iterate over records in shuffled order, while keeping disk access nearly sequential. Records are grouped into
+        blocks that are contiguous on disk, the order of blocks is shuffled, and records are shuffled once more
+        inside a bounded in-memory buffer. The order is deterministic for a given seed and epoch.
+        :param seed: Random seed
+        :param block_bytes: Approximate size of a contiguous block in bytes
+        :param buffer_size: Number of records kept in the shuffle buffer
+        :param epoch: Epoch number. Different epochs produce different orders for the same seed
+        :param access_pattern: Override storage access pattern for this call
+        :return: generator of key-value pairs
+        """
+        rng = random.Random(f"{seed}/{epoch}")
+
+        blocks = []
+        block = []
+        block_size = 0
+        for entry in sorted(self._iter_index(), key=lambda entry: (entry[1], entry[2])):
+            if entry[3] == 0:
+                continue
+            if block and (block_size >= block_bytes or block[-1][1] != entry[1]):
+                blocks.append(block)
+                block = []
+                block_size = 0
+            block.append(entry)
+            block_size += entry[3] & _LENGTH_MASK
+        if block:
+            blocks.append(block)
+        rng.shuffle(blocks)
+
+        buffer = []
+        entries = (entry for block in blocks for entry in block)
+        for record in self._read_entries(entries, access_pattern=access_pattern):
+            if len(buffer) < buffer_size:
+                buffer.append(record)
+                continue
+            ind = rng.randrange(buffer_size)
+            yield buffer[ind]
+            buffer[ind] = record
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def prefetch(self, keys, depth=64, deserialize=False):
+        """
+        Iterate over records in the given order, while a background thread reads upcoming records ahead of the
+        consumer. Useful when the order of reads is known in advance, e.g. for training epochs
+        :param keys: Iterable of keys in the order of reading
+        :param depth: Number of records that are prefetched ahead of the consumer
+        :param deserialize: Deserialize upcoming records in the background thread. Otherwise, only the pages of
+        upcoming records are loaded into page cache
+        :return: `Prefetcher` that yields key-value pairs
+        """
+        self._check_process()
+        if not self._read_only:
+            self._flush_shards()
+        return Prefetcher(self, keys, depth=depth, deserialize=deserialize)
+
+    def open_value_reader(self, key):
+        """
+        Open a value for reading in chunks. Returns bytes in serialized form, i.e. the bytes that were written with
+        `open_value_writer` or produced by the serializer
+        :param key:
+        :return: seekable file-like object
+        """
+        self._check_process()
+        entry = self._get_entry(key)
+        if entry[2] == 0:
+            raise KeyError("Key does not exist:", key)
+        if entry[2] & _INLINE_VALUE:
+            return io.BytesIO(self._read_inline(*entry[1:]))
+        return ValueReader(self, self._get_extents(*entry))
+
+    def open_value_writer(self, key):
+        """
+        Open a value for writing in chunks. Allows to store values that are larger than memory or `shard_size`.
+        Written bytes are stored as is and are passed to the deserializer when the value is retrieved with
+        `store[key]`. The value becomes available when the writer is closed
+        :param key:
+        :return: file-like object
+        """
+        self._check_process()
+        self._check_writable()
+        self._verify_key_type(key)
+        return ValueWriter(self, key)
 
     def get(self, key, default):
         """
@@ -366,33 +1152,125 @@ class CompactKeyValueStore:
         except KeyError:
             return default
 
+    def partitions(self, n, by="bytes"):
+        """
+        Split storage into disjoint partitions that can be scanned independently, e.g. by worker processes.
+        Storage is saved before partitioning, so that workers can open it from disk.
+        :param n: Number of partitions
+        :param by: Partitioning strategy. `bytes` splits records into contiguous spans with approximately equal
+        number of bytes, `shard` assigns whole shards to partitions
+        :return: list of picklable `StorePartition` descriptors
+        """
+        if n < 1:
+            raise ValueError(f"Number of partitions should be positive, but {n} given")
+
+        self._check_process()
+        if not self._read_only:
+            self.save()
+
+        descriptors = []
+        if by == "shard":
+            sizes = self._shard_sizes()
+            assigned = [[] for _ in range(n)]
+            heap = [(0, ind) for ind in range(n)]
+            for shard_id in sorted(sizes, key=lambda id_: sizes[id_], reverse=True):
+                size, ind = heapq.heappop(heap)
+                assigned[ind].append(shard_id)
+                heapq.heappush(heap, (size + sizes[shard_id], ind))
+            spans = self._shard_spans()
+            for ind, shards in enumerate(assigned):
+                # inline values belong to the first partition
+                owners = shards + [None] if ind == 0 else shards
+                descriptors.append(StorePartition(
+                    self.__class__, self.path, ind, n, shards=sorted(shards), options=self._options,
+                    spans=self._merge_spans([spans[owner] for owner in owners if owner in spans])
+                ))
+        elif by == "bytes":
+            # two streaming passes over the index, so that entry lengths are not kept in memory
+            total = sum(entry[3] & _LENGTH_MASK for entry in self._iter_index())
+            bounds = [0]
+            cumulative = 0
+            n_entries = 0
+            for n_entries, entry in enumerate(self._iter_index(), start=1):
+                cumulative += entry[3] & _LENGTH_MASK
+                while len(bounds) < n and cumulative * n >= total * len(bounds):
+                    bounds.append(n_entries)
+            bounds.extend([n_entries] * (n + 1 - len(bounds)))
+            for ind in range(n):
+                descriptors.append(StorePartition(
+                    self.__class__, self.path, ind, n, span=(bounds[ind], bounds[ind + 1]), options=self._options
+                ))
+        else:
+            raise ValueError(f"`by` should be `bytes` or `shard`, but `{by}` is provided.")
+        return descriptors
+
+    def _shard_spans(self):
+        """
+        Find the range of index entries that hold records of every shard
+        :return: dictionary {shard: (first ordinal, last ordinal + 1)}, inline values are assigned to None
+        """
+        spans = {}
+        for ordinal, (_, shard, _, len_) in enumerate(self._iter_index()):
+            if len_ == 0:
+                continue
+            owner = None if len_ & _INLINE_VALUE else shard
+            spans[owner] = (spans.get(owner, (ordinal,))[0], ordinal + 1)
+        return spans
+
+    @staticmethod
+    def _merge_spans(spans):
+        merged = []
+        for start, stop in sorted(spans):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+            else:
+                merged.append((start, stop))
+        return merged
+
+    @_writing
     def save(self):
         """
         Save all required information for loading later from disk.
         :return:
         """
+        self._check_process()
+        if self._read_only:
+            return
         self._flush_shards()
         self._save_index()
+        self._save_inline_values()
         self._save_param()
         self._unlock_storage()
 
     @classmethod
-    def load(cls, path):
-        store = cls(path)
+    def load(cls, path, read_only=False, **kwargs):
+        """
+        Load previously created storage
+        :param path: Location of the storage
+        :param read_only: Open storage for reading only
+        :param kwargs: additional parameters passed to the initializer, e.g. serializer and deserializer
+        :return:
+        """
+        store = cls(path, read_only=read_only, **kwargs)
         store._load_param()
         store._load_index()
+        store._load_inline_values()
         return store
 
+    @_writing
     def close(self):
         if self._is_open:
             self.save()
             self._close_all_shards()
+            if self._inline_file is not None:
+                self._inline_file.close()
+                self._inline_file = None
             self._is_open = False
 
 
 class KVStore(CompactKeyValueStore):
 
-    _index: Union[DbOffsetStorage, shelve.Shelf] = None
+    _index: Union[DbOffsetStorage, HashFileIndex, shelve.Shelf] = None
 
     def __init__(
             self, path, shard_size=2 ** 30, serializer=None, deserializer=None,
@@ -402,10 +1280,12 @@ class KVStore(CompactKeyValueStore):
         Create a disk backed key-value storage.
         :param path: Location on the disk
         :param shard_size: Size of storage partition in bytes
-        :param index_backend: Backend for storing the index. Available backends are `shelve` and `sqlite`. `shelve` is
-            based on Python's shelve library. It relies on key hashing and collisions are possible. Additionally,
-            `shelve` storage occupies more space on disk. There is no collisions with `sqlite`, but key value is must
-            be string
+        :param index_backend: Backend for storing the index. Available backends are `shelve`, `sqlite`, `sqlite_str`
+            and `hashfile`. `shelve` is based on Python's shelve library. It relies on key hashing and collisions are
+            possible. Additionally, `shelve` storage occupies more space on disk. There is no collisions with `sqlite`,
+            but keys must be integers. `sqlite_str` keeps string keys in sqlite, using 64-bit key hash as the primary
+            key and the full key for resolving collisions. `hashfile` is a hash table in a memory mapped file. It
+            supports integer keys, or string keys with `index_options={"key_type": str}`.
         """
         super().__init__(
             path, shard_size, serializer=serializer, deserializer=deserializer, index_backend=index_backend, **kwargs
@@ -414,11 +1294,14 @@ class KVStore(CompactKeyValueStore):
         self._infer_key_type()
 
     def _infer_key_type(self):
-        if type(self._index) is SqliteDbDict:
-            raise NotImplementedError()
-            # self._key_type = str
-            # self._key_type_error_message = "Key type should be `str` when `sqlite` is used " \
-            #                                "for index backend, but {key_type} given."
+        if type(self._index) is HashedKeyOffsetStorage:
+            self._key_type = str
+            self._key_type_error_message = "Key type should be `str` when `sqlite_str` is used " \
+                                           "for index backend, but `{key_type}` given."
+        elif type(self._index) is HashFileIndex:
+            self._key_type = self._index.key_type
+            self._key_type_error_message = f"Key type should be `{self._key_type.__name__}` for this `hashfile` " \
+                                           "index, but `{key_type}` given."
         elif type(self._index) is DbOffsetStorage:
             self._key_type = int
             self._key_type_error_message = "Key type should be `int` when `sqlite` is used " \
@@ -434,10 +1317,35 @@ class KVStore(CompactKeyValueStore):
         if type(key) != self._key_type:
             raise TypeError(self._key_type_error_message.format(key_type=type(key).__name__))
 
-    def _initialize_offset_index(self, index_backend="sqlite", **kwargs):
+    def _initialize_offset_index(
+            self, index_backend="sqlite", index_options=None, allocation=None, headroom=None, **kwargs
+    ):
+        """
+        Initialize offset index
+        :param index_backend: `sqlite`, `sqlite_str`, `hashfile` or `shelve`. Inferred from existing files when None
+        :param index_options: Parameters passed to `DbOffsetStorage` when `sqlite` or `sqlite_str` backend is used,
+        e.g. `cache_size`, `mmap_size`, `batch_size`, `commit_rows`, `commit_bytes` or `commit_interval`, or to
+        `HashFileIndex` when `hashfile` backend is used, e.g. `key_type`
+        :param allocation: Not supported, KVStore always writes updated values as new records
+        :param headroom: Not supported
+        :return:
+        """
+        if allocation is not None or headroom is not None:
+            raise ValueError(
+                "Slack space allocation is supported only by CompactKeyValueStore, KVStore does not update records "
+                "in place"
+            )
         if index_backend is None:
             index_backend = self._infer_backend()
         self._index_backend = index_backend
+        self._index_options = index_options or {}
+        if index_options:
+            self._options["index_options"] = index_options
+        if self._thread_safe:
+            if index_backend == "shelve":
+                raise ValueError("`shelve` index does not support concurrent access, use `sqlite` or `hashfile`")
+            if index_backend in ("sqlite", "sqlite_str"):
+                self._index_options = dict(self._index_options, thread_safe=True)
         self._create_index()
 
     def _get_shelve_index_path(self, with_suffix=False):
@@ -458,11 +1366,21 @@ class KVStore(CompactKeyValueStore):
     def _get_sqlite_index_path(self):
         return self.path.joinpath("sqlite_index.db")
 
+    def _get_sqlite_str_index_path(self):
+        return self.path.joinpath("sqlite_str_index.db")
+
+    def _get_hashfile_index_path(self):
+        return self.path.joinpath("hashfile_index")
+
     def _infer_backend(self):
         if self._get_shelve_index_path(with_suffix=True).is_file():
             return "shelve"
         elif self._get_sqlite_index_path().is_file():
             return "sqlite"
+        elif self._get_sqlite_str_index_path().is_file():
+            return "sqlite_str"
+        elif self._get_hashfile_index_path().is_file():
+            return "hashfile"
         else:
             raise FileNotFoundError("No index file found.")
 
@@ -471,9 +1389,14 @@ class KVStore(CompactKeyValueStore):
             index_path = self._get_shelve_index_path()
         elif self._index_backend == "sqlite":
             index_path = self._get_sqlite_index_path()
+        elif self._index_backend == "sqlite_str":
+            index_path = self._get_sqlite_str_index_path()
+        elif self._index_backend == "hashfile":
+            index_path = self._get_hashfile_index_path()
         else:
             raise ValueError(
-                f"`index_backend` should be `shelve` or `sqlite`, but `{self._index_backend}` is provided."
+                f"`index_backend` should be `shelve`, `sqlite`, `sqlite_str` or `hashfile`, but "
+                f"`{self._index_backend}` is provided."
             )
         return index_path
 
@@ -482,9 +1405,14 @@ class KVStore(CompactKeyValueStore):
         index_path.parent.mkdir(exist_ok=True, parents=True)
 
         if self._index_backend == "shelve":
-            self._index = shelve.open(str(index_path.absolute()), protocol=4)
+            flag = "r" if self._read_only else "c"
+            self._index = shelve.open(str(index_path.absolute()), flag=flag, protocol=4)
         elif self._index_backend == "sqlite":
-            self._index = DbOffsetStorage(index_path)
+            self._index = DbOffsetStorage(index_path, read_only=self._read_only, **self._index_options)
+        elif self._index_backend == "sqlite_str":
+            self._index = HashedKeyOffsetStorage(index_path, read_only=self._read_only, **self._index_options)
+        elif self._index_backend == "hashfile":
+            self._index = HashFileIndex(index_path, read_only=self._read_only, **self._index_options)
         else:
             raise ValueError("Unknown index backend")
             # self._index = DbDict(index_path)
@@ -496,7 +1424,7 @@ class KVStore(CompactKeyValueStore):
         """
         if self._index_backend == "shelve":
             self._index.sync()
-        elif self._index_backend == "sqlite":
+        elif self._index_backend in ("sqlite", "sqlite_str", "hashfile"):
             self._index.save()
         else:
             raise Exception("Something went wrong")
@@ -504,6 +1432,23 @@ class KVStore(CompactKeyValueStore):
     def _load_index(self):
         pass
 
+    def _reopen(self):
+        if self._index is not None:  # forked process
+            _inherited_handles.append(self._index)
+            self._read_only = True
+            self._create_index()
+        super()._reopen()
+
+    def _iter_index(self, start=None, stop=None):
+        self._check_process()
+        if self._index_backend in ("sqlite", "sqlite_str", "hashfile"):
+            entries = self._index.items(start, stop)
+        else:
+            entries = islice(self._index.items(), start, stop)
+        for key, (shard, position, length) in entries:
+            yield key, shard, position, length
+
+    @_writing
     def __setitem__(self, key, value):
         """
 
@@ -511,24 +1456,71 @@ class KVStore(CompactKeyValueStore):
         :param value:
         :return:
         """
+        self._check_process()
+        self._check_writable()
         self._verify_key_type(key)
 
         serialized = self._serialize(value)
 
+        if len(serialized) < self._inline_threshold:
+            self._set_inline_entry(key, serialized)
+            return
+
+        digest = None
+        if self._value_hashes is not None:
+            digest = self._hash_value(serialized)
+            if self._set_duplicate(key, digest):
+                return
+
         # no old data or the key is new
-        f, _ = self._writing_mode(self._shard_for_write)
-        position = f.tell()
-        written = f.write(serialized)
+        entry = self._write_record(serialized)
+        if digest is not None:
+            self._register_value(digest, entry)
+        self._set_entry(key, entry)
+
+    def _set_entry(self, key, entry):
+        if self._value_refs is not None or self._inline_threshold > 0:
+            existing = self._index.get(key, None)
+            if existing is not None:
+                self._release_entry(existing)
+        self._index[key] = entry
+
+    @_writing
+    def __delitem__(self, key):
+        """
+        Delete the key. The key is removed from the index, the space occupied by the value is not reclaimed
+        :param key:
+        :return:
+        """
+        self._check_process()
+        self._check_writable()
+        self._verify_key_type(key)
+        existing = self._index.get(key, None)
+        if existing is None:
+            raise KeyError("Key does not exist:", key)
+        del self._index[key]
+        self._release_entry(existing)
 
-        self._index[key] = (self._shard_for_write, position, written)
-        self._increment_byte_count(written)
+    def _get_entry(self, key):
+        self._verify_key_type(key)
+        return self._index[key]
+
+    def _iter_range_entries(self, start, stop):
+        if self._key_type is not int:
+            raise TypeError("Range reads are supported only for integer keys")
+        for key, (shard, position, length) in self._index.key_range(start, stop):
+            yield key, shard, position, length
 
+    @_reading
     def __getitem__(self, key):
         """
 
         :param key:
         :return:
         """
+        self._check_process()
+        if isinstance(key, slice):
+            return self._get_slice(key)
         self._verify_key_type(key)
 
         # if type(self._index) is DbDict:
@@ -538,23 +1530,37 @@ class KVStore(CompactKeyValueStore):
         #         )
         return self._get_with_id(key)
 
+    @_reading
     def __contains__(self, item):
-        raise NotImplementedError("This operation is too expensive. Use `get` instead.")
+        """
+        Check whether the key exists. Only the offset index is probed, value bytes are not read. With `sqlite`
+        index backend, most absent keys are rejected by a Bloom filter without querying the database
+        :param item:
+        :return:
+        """
+        self._check_process()
+        if type(item) != self._key_type:
+            return False
+        return item in self._index
 
     def keys(self):
         """
         Get list of keys
         :return:
         """
+        self._check_process()
         return list(self._index.keys())
 
     @classmethod
-    def load(cls, path):
+    def load(cls, path, read_only=False, **kwargs):
         """
         Load previously created storage
         :param path:
+        :param read_only: Open storage for reading only
+        :param kwargs: additional parameters passed to the initializer, e.g. serializer and deserializer
         :return:
         """
-        store = cls(path, index_backend=None)
+        store = cls(path, index_backend=None, read_only=read_only, **kwargs)
         store._load_param()
+        store._load_inline_values()
         return store
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+
+from nhkv.CompactStorage import CompactStorage
+
+
+class DenseOffsetCache:
+    """
+    DenseOffsetCache keeps offsets for integer keys in a compact array indexed by key. Suitable when keys are dense,
+    e.g. sequential IDs. Keys that are far beyond the largest cached key are not cached to avoid huge gaps.
+    Meant for internal use.
+    """
+    _max_gap = 2**16
+
+    def __init__(self):
+        self._storage = CompactStorage(4, dtype="Q")  # (is_cached, shard, position, len_bytes)
+
+    def __len__(self):
+        return len(self._storage)
+
+    def get(self, key, default=None):
+        if 0 <= key < len(self._storage):
+            is_cached, shard, position, bytes_ = self._storage[key]
+            if is_cached:
+                return shard, position, bytes_
+        return default
+
+    def __setitem__(self, key, value):
+        if key < 0 or key > len(self._storage) + self._max_gap:
+            return
+        while len(self._storage) < key:
+            self._storage.append((0, 0, 0, 0))
+        if key == len(self._storage):
+            self._storage.append((1,) + tuple(value))
+        else:
+            self._storage[key] = (1,) + tuple(value)
+
+    def discard(self, key):
+        if 0 <= key < len(self._storage):
+            self._storage[key] = (0, 0, 0, 0)
+
+    @property
+    def is_full(self):
+        return False
+
+
+class SparseOffsetCache:
+    """
+    SparseOffsetCache keeps offsets for at most `max_entries` recently used keys. Suitable when keys are sparse.
+    Meant for internal use.
+    """
+    def __init__(self, max_entries=2**20):
+        if max_entries < 1:
+            raise ValueError(f"`max_entries` should be positive, but {max_entries} given")
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        value = self._entries.get(key, None)
+        if value is None:
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._entries[key] = tuple(value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    @property
+    def is_full(self):
+        return len(self._entries) >= self._max_entries
+
+
+def create_offset_cache(kind, max_entries=2**20):
+    """
+    Create offset cache
+    :param kind: `dense` or `sparse`
+    :param max_entries: Maximum number of entries in `sparse` cache
+    :return:
+    """
+    if kind == "dense":
+        return DenseOffsetCache()
+    elif kind == "sparse":
+        return SparseOffsetCache(max_entries)
+    raise ValueError(f"`offset_cache` should be `dense` or `sparse`, but `{kind}` is provided.")
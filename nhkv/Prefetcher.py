@@ -0,0 +1,136 @@
+import mmap
+from collections import OrderedDict, deque
+from itertools import islice
+from queue import Queue
+from threading import Thread
+
+
+class Prefetcher:
+    """
+    Prefetcher iterates over storage records in a known order and reads upcoming records in a background thread.
+    Offsets are resolved by the consumer `depth` records ahead. The background thread maps shards on its own, and
+    either asks the kernel to load pages of upcoming records (`madvise(MADV_WILLNEED)`, or touches pages when
+    `madvise` is not available), or deserializes upcoming records into a bounded queue. Meant to be created with
+    `store.prefetch(keys)`.
+    """
+    _max_opened_shards = 10
+
+    def __init__(self, store, keys, depth=64, deserialize=False):
+        """
+        Create a Prefetcher instance
+        :param store: CompactKeyValueStore or KVStore instance
+        :param keys: Iterable of keys in the order of reading
+        :param depth: Number of records that are prefetched ahead of the consumer
+        :param deserialize: Deserialize records in the background thread
+        """
+        if depth < 1:
+            raise ValueError(f"Prefetch depth should be positive, but {depth} given")
+        self._store = store
+        self._keys = iter(keys)
+        self._depth = depth
+        self._deserialize = deserialize
+        self._opened_shards = OrderedDict()
+
+    def _submit(self, tasks, pending, key):
+        try:
+            shard, pos, len_ = self._store._get_entry(key)
+            if len_ == 0:
+                raise KeyError("Key does not exist:", key)
+        except KeyError as e:
+            pending.append((key, None, e))
+            tasks.put(None)
+            return
+        if not self._store._is_plain_entry(len_):
+            # values that consist of several parts are read by the consumer
+            pending.append((key, (shard, pos, len_), None))
+            tasks.put(None)
+            return
+        pending.append((key, (shard, pos, len_), None))
+        tasks.put((self._store.path.joinpath(self._store._file_index[shard]), pos, len_))
+
+    def _open_shard(self, shard_path, end):
+        if shard_path in self._opened_shards:
+            self._opened_shards.move_to_end(shard_path)
+            f, mm = self._opened_shards[shard_path]
+            if end <= len(mm):
+                return mm
+            # shard has grown since it was mapped
+            del self._opened_shards[shard_path]
+            mm.close()
+            f.close()
+
+        f = open(shard_path, "rb")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._opened_shards[shard_path] = (f, mm)
+        if len(self._opened_shards) > self._max_opened_shards:
+            _, (f_, mm_) = self._opened_shards.popitem(last=False)
+            mm_.close()
+            f_.close()
+        return mm
+
+    @staticmethod
+    def _load_pages(mm, pos, len_):
+        start = pos - pos % mmap.PAGESIZE
+        if hasattr(mm, "madvise") and hasattr(mmap, "MADV_WILLNEED"):
+            mm.madvise(mmap.MADV_WILLNEED, start, pos + len_ - start)
+        else:
+            for page in range(start, pos + len_, mmap.PAGESIZE):
+                mm[page]
+
+    def _run(self, tasks, results):
+        try:
+            while True:
+                task = tasks.get()
+                if task is None:
+                    if self._deserialize:
+                        results.put((False, None))
+                    continue
+                if task is StopIteration:
+                    break
+                shard_path, pos, len_ = task
+                try:
+                    mm = self._open_shard(shard_path, pos + len_)
+                    if self._deserialize:
+                        results.put((True, self._store._deserialize(mm[pos: pos + len_])))
+                    else:
+                        self._load_pages(mm, pos, len_)
+                except Exception as e:
+                    if self._deserialize:
+                        results.put((False, e))
+        finally:
+            for f, mm in self._opened_shards.values():
+                mm.close()
+                f.close()
+            self._opened_shards.clear()
+
+    def __iter__(self):
+        tasks = Queue()
+        results = Queue(maxsize=self._depth + 1)
+        pending = deque()
+        worker = Thread(target=self._run, args=(tasks, results), daemon=True)
+        worker.start()
+
+        try:
+            for key in islice(self._keys, self._depth):
+                self._submit(tasks, pending, key)
+
+            while pending:
+                key, entry, error = pending.popleft()
+                for next_key in islice(self._keys, 1):
+                    self._submit(tasks, pending, next_key)
+
+                ready, value = results.get() if self._deserialize else (False, None)
+                if isinstance(value, Exception):
+                    raise value
+                if error is not None:
+                    raise error
+                if not ready:
+                    value = self._store._read_entry(*entry)
+                yield key, value
+        finally:
+            tasks.put(StopIteration)
+            # unblock the worker if the results queue is full
+            while worker.is_alive():
+                while not results.empty():
+                    results.get_nowait()
+                worker.join(timeout=0.01)
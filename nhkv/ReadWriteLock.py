@@ -0,0 +1,70 @@
+import threading
+from contextlib import contextmanager, nullcontext
+
+
+class ReadWriteLock:
+    """
+    ReadWriteLock allows any number of concurrent readers or a single writer. Waiting writers block new readers, so
+    writers are not starved. The thread that holds the write lock can acquire it again, and can read.
+    Meant for internal use.
+    """
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        if self._writer == threading.get_ident():
+            yield
+            return
+
+        with self._condition:
+            while self._writer is not None or self._waiting_writers > 0:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        thread = threading.get_ident()
+        with self._condition:
+            if self._writer == thread:
+                self._writer_depth += 1
+            else:
+                self._waiting_writers += 1
+                while self._writer is not None or self._readers > 0:
+                    self._condition.wait()
+                self._waiting_writers -= 1
+                self._writer = thread
+                self._writer_depth = 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer_depth -= 1
+                if self._writer_depth == 0:
+                    self._writer = None
+                    self._condition.notify_all()
+
+
+class NoLock:
+    """
+    NoLock has the interface of ReadWriteLock, but does not synchronize anything. Used when thread safety is not
+    requested. Meant for internal use.
+    """
+    _context = nullcontext()
+
+    def read(self):
+        return self._context
+
+    def write(self):
+        return self._context
@@ -0,0 +1,97 @@
+from multiprocessing import Pool
+from pathlib import Path
+
+import dill as pickle
+
+
+class StorePartition:
+    """
+    StorePartition is a lightweight descriptor of a disjoint part of CompactKeyValueStore or KVStore. Descriptors are
+    created with `store.partitions(n)` and can be passed to worker processes. A worker opens the storage in read-only
+    mode and streams records that belong to the partition.
+    """
+    def __init__(
+            self, store_class, path, partition_id, n_partitions, shards=None, span=None, options=None, spans=None
+    ):
+        """
+        Create a partition descriptor
+        :param store_class: Class of the partitioned storage
+        :param path: Location of the storage
+        :param partition_id: Index of this partition
+        :param n_partitions: Total number of partitions
+        :param shards: List of shard ids that belong to this partition. Used when partitioned by shard
+        :param span: Tuple (start, stop) of index entry ordinals that belong to this partition. Used when
+        partitioned by bytes
+        :param options: Additional parameters for loading the storage, e.g. serializer and deserializer
+        :param spans: List of tuples (start, stop) of index entry ordinals that hold records of `shards`. Only these
+        parts of the index are scanned. If not provided, the whole index is scanned
+        """
+        if (shards is None) == (span is None):
+            raise ValueError("Exactly one of `shards` and `span` should be specified")
+
+        self.store_class = store_class
+        self.path = Path(path)
+        self.partition_id = partition_id
+        self.n_partitions = n_partitions
+        self.shards = shards
+        self.span = span
+        self.spans = spans
+        self.options = options or {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # serializers are often lambdas that standard pickle cannot handle
+        state["options"] = pickle.dumps(self.options, protocol=4)
+        return state
+
+    def __setstate__(self, state):
+        state["options"] = pickle.loads(state["options"])
+        self.__dict__.update(state)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.path}, {self.partition_id}/{self.n_partitions})"
+
+    def open(self):
+        """
+        Open partitioned storage in read-only mode
+        :return: storage instance
+        """
+        return self.store_class.load(self.path, read_only=True, **self.options)
+
+    def records(self, store=None):
+        """
+        Stream records that belong to the partition
+        :param store: Storage opened with `open`. If not provided, storage is opened and closed automatically
+        :return: generator of key-value pairs
+        """
+        if store is not None:
+            yield from store._iter_partition(self)
+            return
+
+        store = self.open()
+        try:
+            yield from store._iter_partition(self)
+        finally:
+            store.close()
+
+    def __iter__(self):
+        return self.records()
+
+
+def _process_partition(args):
+    func, partition = args
+    return func(partition)
+
+
+def process_partitions(func, partitions, processes=None):
+    """
+    Process partitions in parallel with a pool of worker processes
+    :param func: Function that takes a `StorePartition` and returns a result. Must be picklable
+    :param partitions: List of partitions created with `store.partitions(n)`
+    :param processes: Number of worker processes. Defaults to the number of partitions
+    :return: list of results in the order of partitions
+    """
+    if processes is None:
+        processes = len(partitions)
+    with Pool(processes) as pool:
+        return pool.map(_process_partition, [(func, partition) for partition in partitions])
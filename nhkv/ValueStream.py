@@ -0,0 +1,146 @@
+import io
+
+
+class ValueReader(io.RawIOBase):
+    """
+    ValueReader is a read-only seekable file-like object for a value stored in CompactKeyValueStore or KVStore. The
+    value can consist of several extents spread across shards. Data is copied from shard mmaps directly into the
+    buffers passed to `readinto`. Meant to be created with `store.open_value_reader(key)`.
+    """
+    def __init__(self, store, extents):
+        """
+        Create a ValueReader instance
+        :param store: Storage that contains the value
+        :param extents: List of tuples (shard, position, length)
+        """
+        super().__init__()
+        self._store = store
+        self._extents = extents
+        self._size = sum(len_ for _, _, len_ in extents)
+        self._position = 0
+
+    def __len__(self):
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position: {position}")
+        self._position = position
+        return position
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+        with memoryview(b) as view, view.cast("B") as buffer:
+            filled = 0
+            extent_start = 0
+            for shard, pos, len_ in self._extents:
+                if filled == len(buffer):
+                    break
+                extent_end = extent_start + len_
+                if self._position < extent_end:
+                    offset = self._position - extent_start
+                    n = min(len_ - offset, len(buffer) - filled)
+                    _, mm = self._store._reading_mode(shard)
+                    with memoryview(mm) as mm_view, mm_view[pos + offset: pos + offset + n] as chunk:
+                        buffer[filled: filled + n] = chunk
+                    filled += n
+                    self._position += n
+                extent_start = extent_end
+        return filled
+
+    def readall(self):
+        data = bytearray(max(self._size - self._position, 0))
+        self.readinto(data)
+        return bytes(data)
+
+
+class ValueWriter(io.RawIOBase):
+    """
+    ValueWriter is a write-only file-like object that streams a large value into CompactKeyValueStore or KVStore in
+    chunks. When the current shard is full, writing continues in the next shard. The key points to the new value
+    only after the writer is closed. Meant to be created with `store.open_value_writer(key)`.
+    """
+    def __init__(self, store, key):
+        """
+        Create a ValueWriter instance
+        :param store: Storage where the value is written
+        :param key: Key of the value
+        """
+        super().__init__()
+        self._store = store
+        self._key = key
+        self._extents = []
+        self._size = 0
+        self._aborted = False
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._size
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+        with memoryview(b) as view, view.cast("B") as data:
+            total = len(data)
+            offset = 0
+            while offset < total:
+                shard = self._store._shard_for_write
+                room = self._store._shard_size - self._store._written_in_current_shard
+                f, _ = self._store._writing_mode(shard)
+                position = f.tell()
+                with data[offset: offset + room] as chunk:
+                    written = f.write(chunk)
+                self._store._increment_byte_count(written)
+
+                if self._extents and self._extents[-1][0] == shard and sum(self._extents[-1][1:]) == position:
+                    last_shard, last_position, last_len = self._extents.pop()
+                    self._extents.append((last_shard, last_position, last_len + written))
+                else:
+                    self._extents.append((shard, position, written))
+                self._size += written
+                offset += written
+        return total
+
+    def abort(self):
+        """
+        Close the writer without changing the value stored under the key
+        :return:
+        """
+        self._aborted = True
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            try:
+                if not self._aborted:
+                    self._store._set_streamed_entry(self._key, self._extents)
+            finally:
+                super().close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
@@ -1,6 +1,8 @@
 from pathlib import Path
 
 from nhkv.KVStore import KVStore, CompactKeyValueStore
+from nhkv.FixedShapeStore import FixedShapeStore
+from nhkv.StorePartition import StorePartition, process_partitions
 from nhkv.dbdict import *
 
 
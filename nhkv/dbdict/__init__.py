@@ -1,4 +1,5 @@
 from nhkv.dbdict.leveldbdict import LevelDbDict
+from nhkv.dbdict.nhkvdbdict import NhkvDbDict
 from nhkv.dbdict.rocksdbdict import RocksDbDict
 from nhkv.dbdict.sqlitedbdict import SqliteDbDict
 
@@ -11,3 +12,5 @@ def AutoDbDict(path, backend, **kwargs):
         return RocksDbDict(path, **kwargs)
     if backend == "leveldb":
         return LevelDbDict(path, **kwargs)
+    if backend == "nhkv":
+        return NhkvDbDict(path, **kwargs)
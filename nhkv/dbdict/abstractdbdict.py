@@ -61,10 +61,131 @@ class AbstractDbDict(ABC):
         except KeyError:
             return default
 
+    def update(self, items):
+        """
+        Add several key-value pairs
+        :param items: Dictionary or iterable of key-value pairs
+        :return:
+        """
+        if hasattr(items, "items"):
+            items = items.items()
+        for key, value in items:
+            self[key] = value
+
+    def put_many(self, items):
+        """
+        Add several key-value pairs. Same as `update`
+        :param items: Dictionary or iterable of key-value pairs
+        :return:
+        """
+        self.update(items)
+
+    def delete_many(self, keys):
+        """
+        Remove several keys. Missing keys are ignored
+        :param keys: Iterable of keys
+        :return:
+        """
+        for key in keys:
+            del self[key]
+
+    def get_many(self, keys):
+        """
+        Retrieve several values
+        :param keys: Iterable of keys
+        :return: dictionary with existing keys and their values
+        """
+        found = dict()
+        for key in keys:
+            try:
+                found[key] = self[key]
+            except KeyError:
+                pass
+        return found
+
     @abstractmethod
     def keys(self):
         ...
 
+    def iterkeys(self):
+        """
+        Iterate over keys without loading all of them into memory
+        :return: generator of keys
+        """
+        yield from self.keys()
+
+    def itervalues(self):
+        """
+        Iterate over values without loading all of them into memory
+        :return: generator of values
+        """
+        for _, value in self.iteritems():
+            yield value
+
+    def iteritems(self):
+        """
+        Iterate over key-value pairs without loading all of them into memory
+        :return: generator of key-value pairs
+        """
+        for key in self.iterkeys():
+            yield key, self[key]
+
+    def scan(self, start=None, end=None, prefix=None, reverse=False, limit=None):
+        """
+        Iterate over entries in the order of keys. This implementation sorts all keys, backends that keep keys sorted
+        override it
+        :param start: The first key of the range. The range is not bounded from below when None
+        :param end: The key where the range ends (excluded). The range is not bounded from above when None
+        :param prefix: Only keys that start with the prefix are returned. Supported for string keys
+        :param reverse: Iterate in descending order of keys
+        :param limit: Maximum number of entries
+        :return: generator of key-value pairs
+        """
+        lower, upper = self._scan_bounds(start, end, prefix)
+        keys = sorted(
+            (key for key in self.iterkeys() if
+             (lower is None or key >= lower) and (upper is None or key < upper)),
+            reverse=reverse
+        )
+        for key in keys[:limit]:
+            yield key, self[key]
+
+    def _scan_bounds(self, start, end, prefix):
+        """
+        Combine range and prefix into a single range
+        :return: tuple (lower, upper), the lower bound is included, the upper one is excluded. None means unbounded
+        """
+        if start is not None:
+            self._check_key_type(start)
+        if end is not None:
+            self._check_key_type(end)
+        if prefix is None:
+            return start, end
+
+        if type(prefix) != str:
+            raise TypeError("Prefix scans are supported only for string keys")
+        self._check_key_type(prefix)
+        prefix_end = self._prefix_end(prefix)
+        lower = prefix if start is None else max(start, prefix)
+        upper = prefix_end if end is None else end if prefix_end is None else min(end, prefix_end)
+        return lower, upper
+
+    @staticmethod
+    def _prefix_end(prefix):
+        """
+        Find the smallest string that is greater than all strings with the prefix
+        :param prefix:
+        :return: string or None if there is no such string
+        """
+        while prefix:
+            code = ord(prefix[-1]) + 1
+            if 0xd800 <= code <= 0xdfff:
+                code = 0xe000  # surrogates cannot be encoded
+            if code <= 0x10ffff:
+                return prefix[:-1] + chr(code)
+            prefix = prefix[:-1]
+        return None
+
     @abstractmethod
     def save(self):
         ...
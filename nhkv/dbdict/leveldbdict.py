@@ -1,7 +1,16 @@
+import os
+from pathlib import Path
+
+from nhkv.BloomFilter import BloomFilter
 from nhkv.dbdict.abstractdbdict import AbstractDbDict
 
 
 class LevelDbDict(AbstractDbDict):
+    # bytes 0xff never occur in UTF-8, so the counter does not collide with keys and is sorted after them
+    _count_key = b"\xff\xffcount"
+    _bloom = None
+    _bloom_capacity = 100000
+
     def __init__(self, path, **kwargs):
         super().__init__(path, **kwargs)
 
@@ -11,7 +20,65 @@ class LevelDbDict(AbstractDbDict):
             import leveldb
         except ImportError:
             raise ImportError("Install leveldb: pip install leveldb")
+        self._leveldb = leveldb
         self._conn = leveldb.LevelDB(path, create_if_missing=True)
+        self._bloom_path = Path(str(path) + ".bloom")
+        self._initialize_counter()
+        self._open_bloom()
+
+    def _initialize_counter(self):
+        """
+        Read the number of entries that is persisted together with the data. Databases created without the counter
+        are scanned once
+        :return:
+        """
+        try:
+            self._len = int.from_bytes(self._conn.Get(self._count_key), "little")
+        except KeyError:
+            self._len = sum(1 for _ in self.iterkeys())
+            self._conn.Put(self._count_key, self._len.to_bytes(8, "little"))
+
+    def _open_bloom(self):
+        """
+        Open Bloom filter with keys of the database. LevelDB cannot tell that a key is absent without reading it, so
+        the filter lets writes of new keys update the counter without a `Get`. Overwrites and deletions of existing
+        keys still read the key. The filter is rebuilt from the database when the file does not exist
+        :return:
+        """
+        if self._bloom_path.is_file():
+            self._bloom = BloomFilter(self._bloom_path)
+        else:
+            self._build_bloom()
+
+    def _build_bloom(self, reserve=0):
+        """
+        Build the filter from keys of the database
+        :param reserve: Number of keys that are going to be added
+        :return:
+        """
+        temp_path = self._bloom_path.with_name(self._bloom_path.name + ".tmp")
+        bloom = BloomFilter(temp_path, capacity=max(self._bloom_capacity, (self._len + reserve) * 2))
+        for key in self._conn.RangeIter(include_value=False):
+            if key == self._count_key:
+                break
+            bloom.add(key)
+
+        if self._bloom is not None:
+            self._bloom.close()
+        bloom.close()
+        os.replace(temp_path, self._bloom_path)
+        self._bloom = BloomFilter(self._bloom_path)
+
+    def _add_to_bloom(self, keys):
+        """
+        Add keys to the filter before they are written, so that the filter never misses stored keys
+        :param keys: List of encoded keys
+        :return:
+        """
+        if len(self._bloom) + len(keys) > self._bloom.capacity:
+            self._build_bloom(reserve=len(keys))
+        for key in keys:
+            self._bloom.add(key)
 
     @classmethod
     def _check_key_type(cls, key):
@@ -27,9 +94,26 @@ class LevelDbDict(AbstractDbDict):
     def _decode_key(cls, key):
         return key.decode("utf-8")
 
+    def _exists(self, key):
+        if key not in self._bloom:
+            return False
+        try:
+            self._conn.Get(key)
+        except KeyError:
+            return False
+        return True
+
     def __setitem__(self, key, value):
         key = self._encode_key(key)
-        self._conn.Put(key, self._serialize(value))
+        batch = self._leveldb.WriteBatch()
+        batch.Put(key, self._serialize(value))
+        if not self._exists(key):
+            self._add_to_bloom([key])
+            batch.Put(self._count_key, (self._len + 1).to_bytes(8, "little"))
+            self._conn.Write(batch)
+            self._len += 1
+        else:
+            self._conn.Write(batch)
 
     def __getitem__(self, key):
         key = self._encode_key(key)
@@ -37,24 +121,128 @@ class LevelDbDict(AbstractDbDict):
 
     def __delitem__(self, key):
         key = self._encode_key(key)
-        self._conn.Delete(key)
+        if not self._exists(key):
+            return
+        batch = self._leveldb.WriteBatch()
+        batch.Delete(key)
+        batch.Put(self._count_key, (self._len - 1).to_bytes(8, "little"))
+        self._conn.Write(batch)
+        self._len -= 1
+
+    def update(self, items):
+        """
+        Add several key-value pairs with a single atomic WriteBatch
+        :param items: Dictionary or iterable of key-value pairs
+        :return:
+        """
+        if hasattr(items, "items"):
+            items = items.items()
+        values = {self._encode_key(key): self._serialize(value) for key, value in items}
+        new_keys = [key for key in values if not self._exists(key)]
+        added = len(new_keys)
+        self._add_to_bloom(new_keys)
+
+        batch = self._leveldb.WriteBatch()
+        for key, value in values.items():
+            batch.Put(key, value)
+        if added:
+            batch.Put(self._count_key, (self._len + added).to_bytes(8, "little"))
+        self._conn.Write(batch)
+        self._len += added
+
+    def delete_many(self, keys):
+        """
+        Remove several keys with a single atomic WriteBatch. Missing keys are ignored
+        :param keys: Iterable of keys
+        :return:
+        """
+        existing = [key for key in set(self._encode_key(key) for key in keys) if self._exists(key)]
+        if not existing:
+            return
+
+        batch = self._leveldb.WriteBatch()
+        for key in existing:
+            batch.Delete(key)
+        batch.Put(self._count_key, (self._len - len(existing)).to_bytes(8, "little"))
+        self._conn.Write(batch)
+        self._len -= len(existing)
+
+    def get_many(self, keys, snapshot=None):
+        """
+        Retrieve several values
+        :param keys: Iterable of keys
+        :param snapshot: Snapshot created with `snapshot()`. Values are read from the snapshot when provided
+        :return: dictionary with existing keys and their values
+        """
+        source = self._conn if snapshot is None else snapshot
+        found = dict()
+        for key in keys:
+            try:
+                found[key] = self._deserialize(source.Get(self._encode_key(key)))
+            except KeyError:
+                pass
+        return found
+
+    def snapshot(self):
+        """
+        Create a consistent read-only view of the database. Pass it to `get_many` to read several keys at the same
+        point in time
+        :return: snapshot object
+        """
+        return self._conn.CreateSnapshot()
 
     def __len__(self):
-        it = self._conn.RangeIter()
-        count = 0
-        for _ in it:
-            count += 1
-        return count
+        return self._len
 
     def __del__(self):
         self.close()
 
     def keys(self):
-        it = self._conn.RangeIter()
-        return [self._decode_key(i[0]) for i in it]
+        return list(self.iterkeys())
+
+    def iterkeys(self):
+        for key in self._conn.RangeIter(include_value=False):
+            if key == self._count_key:
+                break
+            yield self._decode_key(key)
+
+    def iteritems(self):
+        for key, value in self._conn.RangeIter():
+            if key == self._count_key:
+                break
+            yield self._decode_key(key), self._deserialize(value)
+
+    def scan(self, start=None, end=None, prefix=None, reverse=False, limit=None):
+        """
+        Iterate over entries in the order of keys. The engine iterator is positioned at the start of the range
+        :param start: The first key of the range. The range is not bounded from below when None
+        :param end: The key where the range ends (excluded). The range is not bounded from above when None
+        :param prefix: Only keys that start with the prefix are returned
+        :param reverse: Iterate in descending order of keys
+        :param limit: Maximum number of entries
+        :return: generator of key-value pairs
+        """
+        lower, upper = self._scan_bounds(start, end, prefix)
+        key_from = None if lower is None else self._encode_key(lower)
+        # the counter is sorted after all keys
+        key_to = self._count_key if upper is None else self._encode_key(upper)
+        return self._iter_range(key_from, key_to, reverse, limit)
+
+    def _iter_range(self, key_from, key_to, reverse, limit):
+        count = 0
+        for key, value in self._conn.RangeIter(key_from=key_from, key_to=key_to, reverse=reverse):
+            if key >= key_to:
+                continue  # the end of RangeIter is inclusive
+            if limit is not None and count >= limit:
+                break
+            yield self._decode_key(key), self._deserialize(value)
+            count += 1
 
     def save(self):
-        pass
+        if self._bloom is not None:
+            self._bloom.save()
 
     def close(self):
-        pass
+        if self._bloom is not None:
+            self._bloom.close()
+            self._bloom = None
@@ -0,0 +1,76 @@
+from pathlib import Path
+from typing import Union, Type
+
+from nhkv.KVStore import CompactKeyValueStore
+from nhkv.dbdict.abstractdbdict import AbstractDbDict
+
+
+class NhkvDbDict(AbstractDbDict):
+    """
+    NhkvDbDict is a class for storing key-value pairs in CompactKeyValueStore. Keys can have types `int` or `str`, and
+    must be passed to the object constructor. Values are pickled and stored in memory mapped shards, the index is
+    kept in memory and is written to disk on `save`. Does not require native libraries.
+    """
+    _is_open = False
+
+    def __init__(self, path, key_type: Union[Type[int], Type[str]] = str, **kwargs):
+        """
+        Create a key-value storage backed by CompactKeyValueStore
+        :param path: path to the directory of the storage. If the storage exists, it is loaded
+        :param key_type: Possible key types are `int` and `str` (pass Python type names, not strings)
+        :param kwargs: additional parameters passed to CompactKeyValueStore, e.g. `shard_size` or `inline_threshold`
+        """
+        super().__init__(path, key_type=key_type, **kwargs)
+
+    def _initialize_connection(self, path, key_type=str, **kwargs):
+        if key_type not in (int, str):
+            raise ValueError("Supported key types are `int`, `str`")
+        self._key_type = key_type
+
+        # values are serialized by the dict and stored as is
+        kwargs.update(serializer=lambda value: value, deserializer=lambda value: value)
+        if Path(path).joinpath("store_params").is_file():
+            self._store = CompactKeyValueStore.load(path, **kwargs)
+        else:
+            self._store = CompactKeyValueStore(path, **kwargs)
+
+    def _check_key_type(self, key):
+        if type(key) != self._key_type:
+            raise TypeError(f"Declared and provided key types to not match: {type(key)} != {self._key_type}")
+
+    def __setitem__(self, key, value):
+        self._check_key_type(key)
+        self._store[key] = self._serialize(value)
+        self.requires_commit = True
+
+    def __getitem__(self, key):
+        self._check_key_type(key)
+        return self._deserialize(self._store[key])
+
+    def __delitem__(self, key):
+        self._check_key_type(key)
+        try:
+            del self._store[key]
+            self.requires_commit = True
+        except KeyError:
+            pass
+
+    def __len__(self):
+        return len(self._store)
+
+    def keys(self):
+        return self._store.keys()
+
+    def iteritems(self):
+        for key, value in self._store.items():
+            yield key, self._deserialize(value)
+
+    def save(self):
+        self._store.save()
+        self.requires_commit = False
+
+    def close(self):
+        if self._is_open is True:
+            self.save()
+            self._store.close()
+            self._is_open = False
@@ -2,6 +2,9 @@ from nhkv.dbdict.abstractdbdict import AbstractDbDict
 
 
 class RocksDbDict(AbstractDbDict):
+    # bytes 0xff never occur in UTF-8, so the counter does not collide with keys and is sorted after them
+    _count_key = b"\xff\xffcount"
+
     def __init__(self, path, **kwargs):
         super().__init__(path, **kwargs)
 
@@ -11,7 +14,22 @@ class RocksDbDict(AbstractDbDict):
             import rocksdb
         except ImportError:
             raise ImportError("Install rocksdb: pip install python-rocksdb")
+        self._rocksdb = rocksdb
         self._conn = rocksdb.DB(path, rocksdb.Options(create_if_missing=True))
+        self._initialize_counter()
+
+    def _initialize_counter(self):
+        """
+        Read the number of entries that is persisted together with the data. Databases created without the counter
+        are scanned once
+        :return:
+        """
+        count = self._conn.get(self._count_key)
+        if count is None:
+            self._len = sum(1 for _ in self.iterkeys())
+            self._conn.put(self._count_key, self._len.to_bytes(8, "little"))
+        else:
+            self._len = int.from_bytes(count, "little")
 
     @classmethod
     def _check_key_type(cls, key):
@@ -27,9 +45,20 @@ class RocksDbDict(AbstractDbDict):
     def _decode_key(cls, key):
         return key.decode("utf-8")
 
+    def _exists(self, key):
+        may_exist, _ = self._conn.key_may_exist(key)
+        return may_exist and self._conn.get(key) is not None
+
     def __setitem__(self, key, value):
         key = self._encode_key(key)
-        self._conn.put(key, self._serialize(value))
+        batch = self._rocksdb.WriteBatch()
+        batch.put(key, self._serialize(value))
+        if not self._exists(key):
+            batch.put(self._count_key, (self._len + 1).to_bytes(8, "little"))
+            self._conn.write(batch)
+            self._len += 1
+        else:
+            self._conn.write(batch)
 
     def __getitem__(self, key):
         key = self._encode_key(key)
@@ -40,18 +69,136 @@ class RocksDbDict(AbstractDbDict):
 
     def __delitem__(self, key):
         key = self._encode_key(key)
-        self._conn.delete(key)
+        if not self._exists(key):
+            return
+        batch = self._rocksdb.WriteBatch()
+        batch.delete(key)
+        batch.put(self._count_key, (self._len - 1).to_bytes(8, "little"))
+        self._conn.write(batch)
+        self._len -= 1
+
+    def update(self, items):
+        """
+        Add several key-value pairs with a single atomic WriteBatch
+        :param items: Dictionary or iterable of key-value pairs
+        :return:
+        """
+        if hasattr(items, "items"):
+            items = items.items()
+        values = {self._encode_key(key): self._serialize(value) for key, value in items}
+        added = sum(1 for value in self._conn.multi_get(list(values)).values() if value is None)
+
+        batch = self._rocksdb.WriteBatch()
+        for key, value in values.items():
+            batch.put(key, value)
+        if added:
+            batch.put(self._count_key, (self._len + added).to_bytes(8, "little"))
+        self._conn.write(batch)
+        self._len += added
+
+    def delete_many(self, keys):
+        """
+        Remove several keys with a single atomic WriteBatch. Missing keys are ignored
+        :param keys: Iterable of keys
+        :return:
+        """
+        encoded = list(set(self._encode_key(key) for key in keys))
+        existing = [key for key, value in self._conn.multi_get(encoded).items() if value is not None]
+        if not existing:
+            return
+
+        batch = self._rocksdb.WriteBatch()
+        for key in existing:
+            batch.delete(key)
+        batch.put(self._count_key, (self._len - len(existing)).to_bytes(8, "little"))
+        self._conn.write(batch)
+        self._len -= len(existing)
+
+    def get_many(self, keys, snapshot=None):
+        """
+        Retrieve several values with a single `multi_get`
+        :param keys: Iterable of keys
+        :param snapshot: Snapshot created with `snapshot()`. Values are read from the snapshot when provided
+        :return: dictionary with existing keys and their values
+        """
+        requested = {self._encode_key(key): key for key in keys}
+        if snapshot is None:
+            values = self._conn.multi_get(list(requested))
+        else:
+            values = self._conn.multi_get(list(requested), snapshot=snapshot)
+        return {
+            requested[key]: self._deserialize(value) for key, value in values.items() if value is not None
+        }
+
+    def snapshot(self):
+        """
+        Create a consistent read-only view of the database. Pass it to `get_many` to read several keys at the same
+        point in time
+        :return: snapshot object
+        """
+        return self._conn.snapshot()
 
     def __len__(self):
-        return len(self.keys())
+        return self._len
 
     def __del__(self):
         pass
 
     def keys(self):
+        return list(self.iterkeys())
+
+    def iterkeys(self):
         it = self._conn.iterkeys()
         it.seek_to_first()
-        return [self._decode_key(key) for key in it]
+        for key in it:
+            if key == self._count_key:
+                break
+            yield self._decode_key(key)
+
+    def iteritems(self):
+        it = self._conn.iteritems()
+        it.seek_to_first()
+        for key, value in it:
+            if key == self._count_key:
+                break
+            yield self._decode_key(key), self._deserialize(value)
+
+    def scan(self, start=None, end=None, prefix=None, reverse=False, limit=None):
+        """
+        Iterate over entries in the order of keys. The engine iterator is positioned at the start of the range
+        :param start: The first key of the range. The range is not bounded from below when None
+        :param end: The key where the range ends (excluded). The range is not bounded from above when None
+        :param prefix: Only keys that start with the prefix are returned
+        :param reverse: Iterate in descending order of keys
+        :param limit: Maximum number of entries
+        :return: generator of key-value pairs
+        """
+        lower, upper = self._scan_bounds(start, end, prefix)
+        key_from = None if lower is None else self._encode_key(lower)
+        # the counter is sorted after all keys
+        key_to = self._count_key if upper is None else self._encode_key(upper)
+        return self._iter_range(key_from, key_to, reverse, limit)
+
+    def _iter_range(self, key_from, key_to, reverse, limit):
+        it = self._conn.iteritems()
+        if reverse:
+            it.seek_for_prev(key_to)
+            it = reversed(it)
+        elif key_from is None:
+            it.seek_to_first()
+        else:
+            it.seek(key_from)
+
+        count = 0
+        for key, value in it:
+            if key >= key_to:
+                if reverse:
+                    continue  # seek_for_prev stops at the end of the range
+                break
+            if key_from is not None and key < key_from or limit is not None and count >= limit:
+                break
+            yield self._decode_key(key), self._deserialize(value)
+            count += 1
 
     def save(self):
         pass
@@ -1,4 +1,11 @@
+import io
+import os
 import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager, nullcontext
+from itertools import islice
+from pathlib import Path
 from typing import Union, Type, Optional
 
 from nhkv.dbdict.abstractdbdict import AbstractDbDict
@@ -11,23 +18,55 @@ class SqliteDbDict(AbstractDbDict):
     """
     STR_KEY_LIMIT = 512
     _is_open = False
+    _query_chunk = 500
+    _blob_chunk = 2**20
 
-    def __init__(self, path, key_type: Union[Type[int], Type[str]] = str, str_key_lim: Optional[int] = None, **kwargs):
+    def __init__(
+            self, path, key_type: Union[Type[int], Type[str]] = str, str_key_lim: Optional[int] = None,
+            cache_size=2**26, mmap_size=2**28, blob_threshold=2**20, overflow_threshold=None, thread_safe=False,
+            **kwargs
+    ):
         """
-        Create a Sqlite3-backed key-value storage
+        Create a Sqlite3-backed key-value storage. The database uses WAL journal with `synchronous=NORMAL`
         :param path: path to the location where database file will be created. If the file exists, existing storage is
         loaded
         :param key_type: Possible key types are `int` and `str` (pass Python type names, not strings)
         :param str_key_lim: Maximum length for string keys
+        :param cache_size: Size of sqlite page cache in bytes
+        :param mmap_size: Size of the database that sqlite reads through memory mapping. `0` disables mapping
+        :param blob_threshold: Values of at least this size in bytes are written and read in chunks with incremental
+        blob I/O (requires Python 3.11+)
+        :param overflow_threshold: Values of at least this size in bytes are stored in separate files next to the
+        database. Every value is written into a new file, and files of replaced or deleted values are removed after
+        the transaction is committed. Disabled by default
+        :param thread_safe: Allow using the storage from several threads. Writes are serialized through a single
+        connection. Every reading thread has its own read-only connection. While there are uncommitted writes, reads
+        go through the writer connection and wait for running writes, so that all threads see uncommitted values
         """
-        super().__init__(path, key_type=key_type, str_key_lim=str_key_lim, **kwargs)
+        self._thread_safe = thread_safe
+        self._write_lock = threading.RLock() if thread_safe else nullcontext()
+        self._readers = threading.local()
+        self._reader_connections = []
+        self._blob_threshold = blob_threshold
+        self._overflow_threshold = overflow_threshold
+        self._overflow_dir = Path(str(path) + ".overflow")
+        self._obsolete_files = []  # files of replaced values, removed after commit
+        super().__init__(
+            path, key_type=key_type, str_key_lim=str_key_lim, cache_size=cache_size, mmap_size=mmap_size, **kwargs
+        )
 
     def _initialize_connection(self, path, **kwargs):
         key_type = kwargs["key_type"]
         str_key_lim = kwargs["str_key_lim"]
 
-        self._conn = sqlite3.connect(path)
+        self._conn = sqlite3.connect(path, check_same_thread=not self._thread_safe)
         self._cur = self._conn.cursor()
+        self._read_pragmas = [
+            f"cache_size = {-(int(kwargs['cache_size']) // 1024)}", f"mmap_size = {int(kwargs['mmap_size'])}"
+        ]
+        for pragma in ["journal_mode = WAL", "synchronous = NORMAL"] + self._read_pragmas:
+            # unfinished statements keep WAL files after the connection is closed
+            self._cur.execute(f"PRAGMA {pragma}").fetchall()
 
         self._key_type = key_type
 
@@ -44,9 +83,73 @@ class SqliteDbDict(AbstractDbDict):
         self._cur.execute(
             "CREATE TABLE IF NOT EXISTS [mydict] ("
             "[key] %s PRIMARY KEY NOT NULL, "
-            "[value] BLOB)" % keyt_
+            "[value] BLOB, "
+            "[overflow] TEXT)" % keyt_
+        )
+        columns = [column[1] for column in self._cur.execute("PRAGMA table_info([mydict])").fetchall()]
+        if "overflow" not in columns:
+            # databases created before overflow files were introduced
+            self._cur.execute("ALTER TABLE [mydict] ADD COLUMN [overflow] TEXT")
+        self._initialize_counter()
+
+    def _initialize_counter(self):
+        """
+        Keep the number of entries in a separate table, so that `len` does not scan the database. The counter is
+        maintained by triggers. Replaced keys are detected before insertion, because REPLACE does not fire delete
+        triggers unless `recursive_triggers` is enabled
+        :return:
+        """
+        tables = [table[0] for table in self._cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        if "mydict_count" in tables:
+            return
+        self._cur.executescript(
+            "BEGIN;"
+            "CREATE TABLE [mydict_count] ([count] INTEGER NOT NULL);"
+            "INSERT INTO [mydict_count] SELECT COUNT() FROM [mydict];"
+            "CREATE TRIGGER IF NOT EXISTS [mydict_replace] BEFORE INSERT ON [mydict] "
+            "WHEN EXISTS (SELECT 1 FROM [mydict] WHERE key = NEW.key) "
+            "BEGIN UPDATE [mydict_count] SET count = count - 1; END;"
+            "CREATE TRIGGER IF NOT EXISTS [mydict_insert] AFTER INSERT ON [mydict] "
+            "BEGIN UPDATE [mydict_count] SET count = count + 1; END;"
+            "CREATE TRIGGER IF NOT EXISTS [mydict_delete] AFTER DELETE ON [mydict] "
+            "BEGIN UPDATE [mydict_count] SET count = count - 1; END;"
+            "COMMIT;"
         )
 
+    @contextmanager
+    def _reading(self):
+        """
+        Get connection for reading. In thread-safe mode, uncommitted values are visible only to the writer
+        connection, so it is used under the write lock until the values are committed. Otherwise, the thread reads
+        with its own read-only connection
+        :return:
+        """
+        if self._thread_safe and self.requires_commit:
+            with self._write_lock:
+                if self.requires_commit:
+                    yield self._conn
+                    return
+        yield self._reader()
+
+    def _reader(self):
+        """
+        Get read-only connection of the current thread. The writer connection is returned when not in thread-safe mode
+        :return:
+        """
+        if not self._thread_safe:
+            return self._conn
+        connection = getattr(self._readers, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                Path(self.path).absolute().as_uri() + "?mode=ro", uri=True, check_same_thread=False
+            )
+            for pragma in self._read_pragmas:
+                connection.execute(f"PRAGMA {pragma}").fetchall()
+            with self._write_lock:
+                self._reader_connections.append(connection)
+            self._readers.connection = connection
+        return connection
+
     def _check_key_type(self, key):
         if type(key) != self._key_type:
             raise TypeError(f"Declared and provided key types to not match: {type(key)} != {self._key_type}")
@@ -62,52 +165,378 @@ class SqliteDbDict(AbstractDbDict):
         if self._key_type is str:
             key = self._str_key_trunc(key)
 
-        val = sqlite3.Binary(self._serialize(value))
-        self._cur.execute("REPLACE INTO [mydict] (key, value) VALUES (?, ?)",
-                          (key, val))
+        serialized = self._serialize(value)
+        with self._write_lock:
+            if self._overflow_threshold is not None and len(serialized) >= self._overflow_threshold:
+                with self._open_overflow_writer(key) as file:
+                    file.write(serialized)
+            elif len(serialized) >= self._blob_threshold and self._supports_blobs():
+                with self._open_blob_writer(key, len(serialized)) as blob, memoryview(serialized) as view:
+                    for start in range(0, len(view), self._blob_chunk):
+                        blob.write(view[start: start + self._blob_chunk])
+            else:
+                obsolete = self._find_overflow([key])
+                self._cur.execute("REPLACE INTO [mydict] (key, value) VALUES (?, ?)",
+                                  (key, sqlite3.Binary(serialized)))
+                self._obsolete_files.extend(obsolete)
 
-        self.requires_commit = True
+            self.requires_commit = True
 
-    def __getitem__(self, key):
+    def _supports_blobs(self):
+        return hasattr(self._conn, "blobopen")
+
+    def _new_overflow_path(self):
+        """
+        Get a unique name for a new overflow file, so that committed files are never overwritten
+        :return:
+        """
+        self._overflow_dir.mkdir(exist_ok=True)
+        return self._overflow_dir.joinpath(uuid.uuid4().hex)
+
+    def _find_overflow(self, keys):
+        """
+        Find overflow files of the keys that are going to be replaced or deleted. The files are added to
+        `_obsolete_files` once the statement succeeds, and are removed after the commit, so that committed values stay
+        readable until then
+        :param keys: List of keys
+        :return: list of file names
+        """
+        if self._overflow_threshold is None and not self._overflow_dir.is_dir():
+            return []
+        files = []
+        for start in range(0, len(keys), self._query_chunk):
+            chunk = keys[start: start + self._query_chunk]
+            files.extend(overflow for overflow, in self._conn.execute(
+                f"SELECT overflow FROM [mydict] WHERE key IN ({','.join('?' * len(chunk))}) AND overflow IS NOT NULL",
+                chunk
+            ))
+        return files
+
+    def _remove_files(self, names):
+        for name in names:
+            overflow_path = self._overflow_dir.joinpath(name)
+            if overflow_path.is_file():
+                os.remove(overflow_path)
+
+    def _open_overflow_writer(self, key):
+        obsolete = self._find_overflow([key])
+        overflow_path = self._new_overflow_path()
+        self._cur.execute("REPLACE INTO [mydict] (key, value, overflow) VALUES (?, NULL, ?)",
+                          (key, overflow_path.name))
+        self._obsolete_files.extend(obsolete)
+        return open(overflow_path, "wb")
+
+    def _open_blob_writer(self, key, size):
+        obsolete = self._find_overflow([key])
+        self._cur.execute("REPLACE INTO [mydict] (key, value) VALUES (?, zeroblob(?))", (key, size))
+        self._obsolete_files.extend(obsolete)
+        if not self._supports_blobs():
+            return _BufferedBlobWriter(self, self._cur.lastrowid)
+        return self._conn.blobopen("mydict", "value", self._cur.lastrowid)
+
+    def open_writer(self, key, size):
+        """
+        Open a file-like object for writing a value in chunks. The key points to the new value as soon as the writer
+        is opened. Written bytes should be a serialized value. Values that reach `overflow_threshold` are written
+        into a separate file, others are written into preallocated blob of `size` bytes. Without incremental blob I/O
+        (Python < 3.11), the value is collected in memory and written when the writer is closed. In thread-safe mode,
+        the writer should be used only by the thread that opened it
+        :param key:
+        :param size: Size of the serialized value in bytes
+        :return: writable file-like object
+        """
         self._check_key_type(key)
+        if self._key_type is str:
+            key = self._str_key_trunc(key)
+        with self._write_lock:
+            self.requires_commit = True
+            if self._overflow_threshold is not None and size >= self._overflow_threshold:
+                return self._open_overflow_writer(key)
+            return self._open_blob_writer(key, size)
 
-        if self.requires_commit:
-            self.save()
-            self.requires_commit = False
+    def open_reader(self, key):
+        """
+        Open a file-like object for reading a serialized value in chunks. Without incremental blob I/O (Python < 3.11),
+        values stored in the database are read into memory
+        :param key:
+        :return: readable file-like object
+        """
+        self._check_key_type(key)
+        if self._key_type is str:
+            key = self._str_key_trunc(key)
+        with self._reading() as connection:
+            resp = connection.execute("SELECT rowid, overflow FROM [mydict] WHERE key = ?", (key,)).fetchall()
+            if len(resp) == 0:
+                raise KeyError("Key not found")
+            rowid, overflow = resp[0]
+            if overflow is not None:
+                return open(self._overflow_dir.joinpath(overflow), "rb")
+            if not self._supports_blobs():
+                value, = connection.execute("SELECT value FROM [mydict] WHERE rowid = ?", (rowid,)).fetchall()[0]
+                return io.BytesIO(bytes(value))
+            return connection.blobopen("mydict", "value", rowid, readonly=True)
+
+    def _read_value(self, connection, rowid, length, overflow):
+        """
+        Read a value that is too large to be fetched with a query
+        :return: serialized value
+        """
+        if overflow is not None:
+            with open(self._overflow_dir.joinpath(overflow), "rb") as file:
+                return file.read()
+        data = bytearray(length)
+        with connection.blobopen("mydict", "value", rowid, readonly=True) as blob:
+            for start in range(0, length, self._blob_chunk):
+                data[start: start + self._blob_chunk] = blob.read(self._blob_chunk)
+        # small values are passed to the deserializer as bytes as well
+        return bytes(data)
+
+    def update(self, items):
+        """
+        Add several key-value pairs. Pairs are written in chunks, a statement per chunk
+        :param items: Dictionary or iterable of key-value pairs
+        :return:
+        """
+        if hasattr(items, "items"):
+            items = items.items()
+        items = iter(items)
+
+        with self._write_lock:
+            while True:
+                rows = []
+                written = []  # overflow files of the chunk
+                try:
+                    for key, value in islice(items, self._query_chunk):
+                        self._check_key_type(key)
+                        if self._key_type is str:
+                            key = self._str_key_trunc(key)
+                        serialized = self._serialize(value)
+                        if self._overflow_threshold is not None and len(serialized) >= self._overflow_threshold:
+                            overflow_path = self._new_overflow_path()
+                            written.append(overflow_path.name)
+                            with open(overflow_path, "wb") as file:
+                                file.write(serialized)
+                            rows.append((key, None, overflow_path.name))
+                        else:
+                            rows.append((key, sqlite3.Binary(serialized), None))
+                    if not rows:
+                        break
+                    obsolete = self._find_overflow([key for key, _, _ in rows])
+                    self._write_rows("REPLACE INTO [mydict] (key, value, overflow) VALUES (?, ?, ?)", rows)
+                except BaseException:
+                    # files of values that were not written to the database
+                    self._remove_files(written)
+                    raise
+                # keys that repeat in the chunk replace files of their earlier values
+                latest = {key: overflow for key, _, overflow in rows}
+                self._obsolete_files.extend(obsolete)
+                self._obsolete_files.extend(
+                    overflow for key, _, overflow in rows if overflow is not None and latest[key] != overflow
+                )
+                self.requires_commit = True
+
+    def _write_rows(self, query, rows):
+        """
+        Execute the query for all rows inside a savepoint, so that either all rows are written or none of them
+        :param query: SQL query
+        :param rows: List of query parameters
+        :return:
+        """
+        if not self._conn.in_transaction:
+            # releasing the outermost savepoint would commit
+            self._cur.execute("BEGIN")
+        self._cur.execute("SAVEPOINT write_rows")
+        try:
+            self._cur.executemany(query, rows)
+        except BaseException:
+            # release the failed statement
+            self._cur.close()
+            self._cur = self._conn.cursor()
+            self._cur.execute("ROLLBACK TO write_rows")
+            raise
+        finally:
+            self._cur.execute("RELEASE write_rows")
+
+    def delete_many(self, keys):
+        """
+        Remove several keys with a single statement. Missing keys are ignored
+        :param keys: Iterable of keys
+        :return:
+        """
+        db_keys = []
+        for key in keys:
+            self._check_key_type(key)
+            db_keys.append(self._str_key_trunc(key) if self._key_type is str else key)
 
+        with self._write_lock:
+            obsolete = self._find_overflow(db_keys)
+            self._write_rows("DELETE FROM [mydict] WHERE key = ?", [(key,) for key in db_keys])
+            self._obsolete_files.extend(obsolete)
+            self.requires_commit = True
+
+    def get_many(self, keys):
+        """
+        Retrieve several values with chunked queries
+        :param keys: Iterable of keys
+        :return: dictionary with existing keys and their values
+        """
+        keys = list(keys)
+        for key in keys:
+            self._check_key_type(key)
+        # truncated keys are mapped back to the requested ones
+        requested = {self._str_key_trunc(key) if self._key_type is str else key: key for key in keys}
+
+        found = dict()
+        db_keys = list(requested)
+        with self._reading() as connection:
+            for start in range(0, len(db_keys), self._query_chunk):
+                chunk = db_keys[start: start + self._query_chunk]
+                for key, val, rowid, length, overflow in connection.execute(
+                        self._select_value_query(f"key IN ({','.join('?' * len(chunk))})"),
+                        [self._get_blob_limit()] + chunk
+                ).fetchall():
+                    found[requested[key]] = self._deserialize(
+                        bytes(val) if val is not None else self._read_value(connection, rowid, length, overflow)
+                    )
+        return found
+
+    def __getitem__(self, key):
+        self._check_key_type(key)
+
+        # uncommitted changes are visible to the same connection
         if self._key_type is str:
             key = self._str_key_trunc(key)
 
-        self._cur.execute("SELECT value FROM [mydict] WHERE key = ?", (key,))
-        resp = self._cur.fetchmany(1)
-        if len(resp) == 0:
-            raise KeyError("Key not found")
-        val = resp[0][0]
+        with self._reading() as connection:
+            resp = connection.execute(self._select_value_query("key = ?"), (self._get_blob_limit(), key)).fetchall()
+            if len(resp) == 0:
+                raise KeyError("Key not found")
+            _, val, rowid, length, overflow = resp[0]
 
+            if val is None:
+                # large values are not fetched by the query, the buffer is filled from the blob directly
+                return self._deserialize(self._read_value(connection, rowid, length, overflow))
         return self._deserialize(bytes(val))
 
+    def _get_blob_limit(self):
+        return self._blob_threshold if self._supports_blobs() else 2**63 - 1
+
+    @staticmethod
+    def _select_value_query(condition=None):
+        query = "SELECT key, CASE WHEN length(value) < ? THEN value END, rowid, length(value), overflow FROM [mydict]"
+        if condition is not None:
+            query += f" WHERE {condition}"
+        return query
+
     def __delitem__(self, key):
-        try:
-            self._conn.execute("DELETE FROM [mydict] WHERE key = ?", (key,))
-        except:
-            pass
+        with self._write_lock:
+            try:
+                obsolete = self._find_overflow([key])
+                self._conn.execute("DELETE FROM [mydict] WHERE key = ?", (key,))
+                self._obsolete_files.extend(obsolete)
+            except:
+                pass
 
     def __len__(self):
-        return self._cur.execute("SELECT COUNT() FROM [mydict]").fetchone()[0]
+        with self._reading() as connection:
+            return connection.execute("SELECT count FROM [mydict_count]").fetchall()[0][0]
 
     def __del__(self):
         self.close()
 
     def keys(self):
-        keys = self._cur.execute("SELECT key FROM [mydict]").fetchall()
-        return list(key[0] for key in keys)
+        return list(self.iterkeys())
+
+    def iterkeys(self):
+        # while there are uncommitted values, writes from other threads wait until the iteration is complete
+        with self._reading() as connection:
+            cursor = connection.execute("SELECT key FROM [mydict]")
+            try:
+                for key, in cursor:
+                    yield key
+            finally:
+                if self._is_open:
+                    cursor.close()
+
+    def iteritems(self):
+        return self._iter_items(self._select_value_query(), (self._get_blob_limit(),))
+
+    def scan(self, start=None, end=None, prefix=None, reverse=False, limit=None):
+        """
+        Iterate over entries in the order of keys. The range is read with the primary key index
+        :param start: The first key of the range. The range is not bounded from below when None
+        :param end: The key where the range ends (excluded). The range is not bounded from above when None
+        :param prefix: Only keys that start with the prefix are returned. Supported for string keys
+        :param reverse: Iterate in descending order of keys
+        :param limit: Maximum number of entries
+        :return: generator of key-value pairs
+        """
+        lower, upper = self._scan_bounds(start, end, prefix)
+        conditions = []
+        params = [self._get_blob_limit()]
+        if lower is not None:
+            conditions.append("key >= ?")
+            params.append(lower)
+        if upper is not None:
+            conditions.append("key < ?")
+            params.append(upper)
+        query = self._select_value_query(" AND ".join(conditions) if conditions else None)
+        query += " ORDER BY key DESC" if reverse else " ORDER BY key"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self._iter_items(query, params)
+
+    def _iter_items(self, query, params):
+        """
+        Stream key-value pairs selected with `_select_value_query`
+        :return: generator of key-value pairs
+        """
+        with self._reading() as connection:
+            cursor = connection.execute(query, params)
+            try:
+                for key, val, rowid, length, overflow in cursor:
+                    yield key, self._deserialize(
+                        bytes(val) if val is not None else self._read_value(connection, rowid, length, overflow)
+                    )
+            finally:
+                if self._is_open:
+                    cursor.close()
 
     def save(self):
-        self._conn.commit()
+        with self._write_lock:
+            self._conn.commit()
+            self.requires_commit = False
+            # committed values do not point to these files anymore
+            obsolete, self._obsolete_files = self._obsolete_files, []
+            self._remove_files(obsolete)
 
     def close(self):
-        if self._is_open is True:
-            self.save()
-            self._cur.close()
-            self._conn.close()
-            self._is_open = False
+        with self._write_lock:
+            if self._is_open is True:
+                self.save()
+                for connection in self._reader_connections:
+                    connection.close()
+                self._reader_connections = []
+                self._cur.close()
+                self._conn.close()
+                self._is_open = False
+
+
+class _BufferedBlobWriter(io.BytesIO):
+    """
+    Collects a value in memory and writes it into the database when closed. Used by `SqliteDbDict.open_writer` when
+    incremental blob I/O is not available
+    """
+    def __init__(self, db_dict, rowid):
+        super().__init__()
+        self._db_dict = db_dict
+        self._rowid = rowid
+
+    def close(self):
+        if not self.closed:
+            with self._db_dict._write_lock:
+                self._db_dict._cur.execute(
+                    "UPDATE [mydict] SET value = ? WHERE rowid = ?", (sqlite3.Binary(self.getvalue()), self._rowid)
+                )
+        super().close()
@@ -1,6 +1,8 @@
 import os
 import shutil
 
+import pytest
+
 
 def test_compact_storage():
     import random
@@ -90,6 +92,7 @@ def test_db_offset_storage():
 
     import os
     os.remove(db_path)
+    os.remove(db_path + ".bloom")
 
 
 def test_db_dict():
@@ -370,6 +373,7 @@ def test_context_manager():
     storage1 = get_or_create_storage(SqliteDbDict, path=dbdict_path)
     storage2 = get_or_create_storage(SqliteDbDict, path=dbdict_path)
     assert id(storage1) == id(storage2)
+    storage1.close()
 
     from nhkv import KVStore
     storage_path = "storage"
@@ -405,3 +409,1351 @@ def test_storage_lock():
     storage1.save()
     assert not storage_path.joinpath("lock").is_file()
     shutil.rmtree(storage_path)
+
+
+def _parametrize_stores(*backends):
+    """
+    Run the test with CompactKeyValueStore (backend `None`) and KVStore with the given index backends
+    :param backends: `None` or names of KVStore index backends
+    :return: pytest decorator
+    """
+    return pytest.mark.parametrize("backend", backends, ids=[backend or "compact" for backend in backends])
+
+
+@pytest.fixture
+def store_type(backend):
+    """
+    Storage class and its parameters for the parametrized backend
+    :return: tuple (store_class, kwargs)
+    """
+    from nhkv import CompactKeyValueStore, KVStore
+
+    if backend is None:
+        return CompactKeyValueStore, {}
+    return KVStore, {"index_backend": backend}
+
+
+def _count_partition_records(partition):
+    return sorted(key for key, _ in partition)
+
+
+@_parametrize_stores(None, "sqlite")
+def test_store_partitions(store_type, tmp_path):
+    import pickle
+    from nhkv import process_partitions
+
+    store_class, kwargs = store_type
+    path = tmp_path / "storage"
+    storage = store_class(path, shard_size=1000, **kwargs)
+    for key in range(200):
+        storage[key] = "value" * (key % 7 + 1)
+    storage.save()
+
+    for by in ["bytes", "shard"]:
+        partitions = storage.partitions(3, by=by)
+        assert len(partitions) == 3
+        partitions = pickle.loads(pickle.dumps(partitions))
+
+        scanned = {}
+        for partition in partitions:
+            for key, value in partition:
+                assert key not in scanned
+                scanned[key] = value
+        assert scanned == {key: "value" * (key % 7 + 1) for key in range(200)}
+
+    results = process_partitions(_count_partition_records, storage.partitions(2), processes=2)
+    assert sorted(results[0] + results[1]) == list(range(200))
+
+    # shard partitions scan only the entries of their shards
+    partitions = storage.partitions(len(storage._file_index), by="shard")
+    assert all(sum(stop - start for start, stop in partition.spans) < 50 for partition in partitions)
+
+    # handles that were not used yet are opened before partitioning
+    handle = pickle.loads(pickle.dumps(storage))
+    partitions = handle.partitions(2, by="shard")
+    assert sorted(_count_partition_records(partitions[0]) + _count_partition_records(partitions[1])) == \
+        list(range(200))
+
+    storage.close()
+
+    storage = store_class.load(path, read_only=True)
+    assert storage[10] == "value" * 4
+    try:
+        storage[10] = "new value"
+        assert False, "Exception is not caught"
+    except RuntimeError:
+        pass
+    storage.close()
+
+    del storage
+
+
+def _read_from_store(args):
+    storage, keys = args
+    return [storage[key] for key in keys]
+
+
+def _read_inherited_store(storage, keys, queue):
+    queue.put([storage.get(key, None) for key in keys])
+
+
+@_parametrize_stores(None, "sqlite", "shelve", "hashfile")
+def test_store_handles_in_worker_processes(store_type, tmp_path):
+    import copy
+    import pickle
+    import multiprocessing
+    from nhkv import CompactKeyValueStore
+
+    store_class, kwargs = store_type
+    path = tmp_path / "storage"
+    storage = store_class(path, shard_size=100, **kwargs)
+    keys = [str(key) if kwargs.get("index_backend") == "shelve" else key for key in range(50)]
+    for key in keys:
+        storage[key] = f"value {key}"
+    storage.save()
+    assert storage[keys[1]] == "value 1"  # shards are opened before workers are started
+
+    handle = pickle.loads(pickle.dumps(storage))
+    assert len(handle) == 50
+    assert copy.copy(storage)._read_only and not storage._read_only
+    assert handle[keys[3]] == "value 3"
+    try:
+        handle[keys[3]] = "new value"
+        assert False, "Exception is not caught"
+    except RuntimeError:
+        pass
+
+    for method in ["fork", "spawn"]:
+        with multiprocessing.get_context(method).Pool(2) as pool:
+            results = pool.map(_read_from_store, [(storage, keys[:25]), (storage, keys[25:])])
+        assert results[0] + results[1] == [f"value {key}" for key in keys]
+
+    # storage is inherited by forked processes without pickling, the index is not saved by the fork
+    keys.append("50" if kwargs.get("index_backend") == "shelve" else 50)
+    storage[keys[-1]] = "value 50"
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    workers = [context.Process(target=_read_inherited_store, args=(storage, keys, queue)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        values = queue.get()
+        assert values[:50] == [f"value {key}" for key in keys[:50]]
+        if store_class is CompactKeyValueStore:
+            assert values[50] == "value 50"  # the index is kept in memory
+        elif kwargs["index_backend"] == "sqlite":
+            assert values[50] is None  # entries written after `save` are not committed
+        worker.join()
+        assert worker.exitcode == 0
+    assert storage[keys[-1]] == "value 50"
+
+    # parent process is not affected by workers
+    storage[keys[0]] = "new value"
+    assert storage[keys[0]] == "new value"
+    storage.close()
+
+    del storage, handle
+
+
+@_parametrize_stores(None, "sqlite")
+def test_prefetch(store_type, tmp_path):
+    import random
+
+    store_class, kwargs = store_type
+    path = tmp_path / "storage"
+    storage = store_class(path, shard_size=500, **kwargs)
+    for key in range(100):
+        storage[key] = [key] * (key % 5 + 1)
+
+    order = list(range(100))
+    random.shuffle(order)
+    for deserialize in [False, True]:
+        retrieved = list(storage.prefetch(order, depth=8, deserialize=deserialize))
+        assert retrieved == [(key, [key] * (key % 5 + 1)) for key in order]
+
+        # stopping iteration early shuts down the background thread
+        for key, value in storage.prefetch(order, depth=4, deserialize=deserialize):
+            break
+
+        try:
+            list(storage.prefetch([1, 2, 1000], deserialize=deserialize))
+            assert False, "Exception is not caught"
+        except KeyError:
+            pass
+
+    storage.close()
+    del storage
+
+
+@_parametrize_stores(None, "sqlite")
+def test_iter_shuffled(store_type, tmp_path):
+    store_class, kwargs = store_type
+    path = tmp_path / "storage"
+    storage = store_class(path, shard_size=1000, **kwargs)
+    for key in range(300):
+        storage[key] = key
+
+    epoch_0 = list(storage.iter_shuffled(seed=1, block_bytes=100, buffer_size=20, epoch=0))
+    assert sorted(epoch_0) == [(key, key) for key in range(300)]
+    assert epoch_0 != [(key, key) for key in range(300)]
+    assert epoch_0 == list(storage.iter_shuffled(seed=1, block_bytes=100, buffer_size=20, epoch=0))
+    assert epoch_0 != list(storage.iter_shuffled(seed=1, block_bytes=100, buffer_size=20, epoch=1))
+    assert epoch_0 != list(storage.iter_shuffled(seed=2, block_bytes=100, buffer_size=20, epoch=0))
+
+    storage.close()
+    del storage
+
+
+def test_access_pattern():
+    from nhkv import CompactKeyValueStore
+
+    path = "temp_access_pattern"
+    try:
+        CompactKeyValueStore(path, access_pattern="backwards")
+        assert False, "Exception is not caught"
+    except ValueError:
+        pass
+
+    storage = CompactKeyValueStore(path, shard_size=1000, access_pattern="random")
+    for key in range(100):
+        storage[key] = key
+    assert storage[10] == 10
+    for access_pattern in [None, "normal", "random", "sequential"]:
+        assert list(storage.items(access_pattern=access_pattern)) == [(key, key) for key in range(100)]
+        assert len(list(storage.iter_shuffled(access_pattern=access_pattern))) == 100
+    assert storage[20] == 20
+    storage.close()
+    del storage
+
+    storage = CompactKeyValueStore.load(path, read_only=True, access_pattern="sequential")
+    assert list(storage.items()) == [(key, key) for key in range(100)]
+    storage.close()
+    del storage
+    shutil.rmtree(path)
+
+
+@_parametrize_stores(None, "sqlite")
+def test_pread_engine(store_type, tmp_path):
+    store_class, kwargs = store_type
+    path = tmp_path / "storage"
+    storage = store_class(path, shard_size=100, max_opened_shards=3, read_engine="pread", **kwargs)
+    for key in range(100):
+        storage[key] = "value" * key
+    assert [storage[key] for key in range(100)] == ["value" * key for key in range(100)]
+    assert len(storage._opened_descriptors) <= 3
+    storage.save()
+    storage[100] = "not flushed"
+    assert storage[100] == "not flushed"
+    storage.close()
+    del storage
+
+    storage = store_class.load(path, read_engine="auto", pread_threshold=100)
+    assert [storage[key] for key in range(100)] == ["value" * key for key in range(100)]
+    assert len(storage._opened_shards) <= 10
+    storage.close()
+    del storage
+
+
+@_parametrize_stores(None, "sqlite")
+def test_value_streams(store_type, tmp_path):
+    import io
+
+    store_class, kwargs = store_type
+    path = tmp_path / "storage"
+    storage = store_class(path, shard_size=1000, serializer=lambda x: x, deserializer=bytes, **kwargs)
+    storage[0] = b"small value"
+    data = bytes(range(256)) * 20
+
+    with storage.open_value_writer(1) as writer:
+        for start in range(0, len(data), 700):
+            writer.write(data[start: start + 700])
+        storage[2] = b"written in between"
+    storage[3] = b"after"
+
+    assert storage[1] == data
+    assert storage[2] == b"written in between"
+    assert len(set(shard for shard, _, _ in storage._get_extents(*storage._get_entry(1)))) > 1
+
+    with storage.open_value_reader(1) as reader:
+        assert reader.read(10) == data[:10]
+        reader.seek(995)
+        assert reader.read(10) == data[995:1005]
+        reader.seek(-5, io.SEEK_END)
+        assert reader.read() == data[-5:]
+        reader.seek(0)
+        buffer = bytearray(len(data))
+        assert reader.readinto(buffer) == len(data)
+        assert buffer == data
+
+    with storage.open_value_reader(0) as reader:
+        assert reader.read() == b"small value"
+
+    try:
+        with storage.open_value_writer(0) as writer:
+            writer.write(b"incomplete")
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    assert storage[0] == b"small value"
+
+    assert list(storage.prefetch([1, 0], deserialize=True)) == [(1, data), (0, b"small value")]
+
+    storage.close()
+    del storage
+
+
+def test_slack_space_allocation():
+    from nhkv import CompactKeyValueStore, KVStore
+
+    path = "temp_allocation"
+    for allocation in ["size_class", "headroom"]:
+        storage = CompactKeyValueStore(path, allocation=allocation, serializer=lambda x: x, deserializer=bytes)
+        storage["counter"] = b"1" * 100
+        storage["other"] = b"other"
+        shard, position, _, capacity = storage._index[storage._key_map["counter"]]
+        assert capacity > 100
+
+        for size in [101, 110, 90, capacity]:
+            storage["counter"] = b"2" * size
+            assert storage["counter"] == b"2" * size
+            assert storage._index[storage._key_map["counter"]] == (shard, position, size, capacity)
+        assert storage["other"] == b"other"
+
+        storage["counter"] = b"3" * (capacity + 1)
+        assert storage["counter"] == b"3" * (capacity + 1)
+        assert storage._index[storage._key_map["counter"]][1] != position
+
+        with storage.open_value_writer("stream") as writer:
+            writer.write(b"streamed")
+        storage["stream"] = b"new"
+        assert storage["stream"] == b"new"
+        storage.close()
+        del storage
+
+        storage = CompactKeyValueStore.load(path, serializer=lambda x: x, deserializer=bytes)
+        assert storage._allocation == allocation
+        assert storage["counter"] == b"3" * (capacity + 1)
+        assert storage["other"] == b"other"
+        storage.close()
+        del storage
+        shutil.rmtree(path)
+
+    for kwargs in [{"allocation": "size_class"}, {"allocation": "headroom", "headroom": 0.5}, {"headroom": 0.5}]:
+        try:
+            KVStore(path, **kwargs)
+            assert False, "Exception is not caught"
+        except ValueError:
+            pass
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+@_parametrize_stores(None, "sqlite")
+def test_deduplication(store_type, tmp_path):
+    store_class, kwargs = store_type
+    path = tmp_path / "storage"
+    storage = store_class(path, deduplicate=True, **kwargs)
+    storage[0] = "image" * 100
+    storage[1] = "image" * 100
+    storage[2] = "document"
+    assert storage._get_entry(0) == storage._get_entry(1)
+    assert storage._value_refs[storage._get_entry(0)[:2]][1] == 2
+    written = storage._written_in_current_shard
+
+    # shared record is not overwritten in place
+    storage[1] = "IMAGE" * 100
+    assert storage[0] == "image" * 100
+    assert storage[1] == "IMAGE" * 100
+    assert storage._value_refs[storage._get_entry(0)[:2]][1] == 1
+
+    storage[1] = "image" * 100
+    storage[2] = "image" * 100
+    assert storage._written_in_current_shard > written
+    assert storage._value_refs[storage._get_entry(0)[:2]][1] == 3
+    assert len(storage._value_hashes) == 1
+    storage.close()
+    del storage
+
+    storage = store_class.load(path)
+    assert [storage[key] for key in range(3)] == ["image" * 100] * 3
+    written = storage._written_in_current_shard
+    storage[3] = "image" * 100
+    assert storage._written_in_current_shard == written
+    assert storage._value_refs[storage._get_entry(3)[:2]][1] == 4
+    storage.close()
+    del storage
+
+
+@_parametrize_stores(None, "sqlite")
+def test_inline_values(store_type, tmp_path):
+    from nhkv import KVStore
+
+    store_class, kwargs = store_type
+    path = tmp_path / "storage"
+    storage = store_class(path, inline_threshold=16, serializer=lambda x: x, deserializer=bytes, **kwargs)
+    storage[0] = b"tiny"
+    storage[1] = b"large value" * 10
+    storage[0] = b"also tiny"
+    storage[2] = b""
+    assert storage[0] == b"also tiny"
+    assert storage[1] == b"large value" * 10
+    assert storage[2] == b""
+    assert storage._opened_shards.keys() == {0}
+    assert storage.open_value_reader(0).read() == b"also tiny"
+    assert list(storage.items(access_pattern="sequential")) == [
+        (0, b"also tiny"), (1, b"large value" * 10), (2, b"")
+    ]
+    storage.close()
+    del storage
+
+    storage = store_class.load(path, serializer=lambda x: x, deserializer=bytes)
+    assert storage[0] == b"also tiny"
+    assert storage[2] == b""
+    assert len(storage._opened_shards) == 0
+    storage[3] = b"new tiny"
+    assert storage[3] == b"new tiny"
+    storage.close()
+    del storage
+
+    storage = store_class.load(path, read_only=True, serializer=lambda x: x, deserializer=bytes)
+    try:
+        storage[4] = b"tiny"
+        assert False, "Exception is not caught"
+    except RuntimeError:
+        pass
+    storage.close()
+    del storage
+
+    # inline entries do not share reference counts with shard records at the same position
+    path = tmp_path / "shared"
+    storage = store_class(
+        path, deduplicate=True, inline_threshold=3, serializer=lambda x: x, deserializer=bytes, **kwargs
+    )
+    storage[0] = storage[1] = b"XXXX"
+    storage[2] = b"1"
+    storage[2] = b"22"
+    storage[0] = b"WWWW"
+    assert storage[1] == b"XXXX" and storage[0] == b"WWWW"
+    storage.close()
+    del storage
+
+    # inline values are on disk before the index is committed, and slots of overwritten values are reused
+    path = tmp_path / "unsaved"
+    options = dict(kwargs, index_options={"commit_rows": 1}) if store_class is KVStore else kwargs
+    storage = store_class(path, inline_threshold=16, serializer=lambda x: x, deserializer=bytes, **options)
+    storage.save()
+    for key in range(5):
+        storage[key] = b"tiny %d" % key
+    if store_class is KVStore:
+        # the index is committed after every entry, but the storage is not saved
+        handle = store_class.load(path, read_only=True, serializer=lambda x: x, deserializer=bytes)
+        assert [handle[key] for key in range(5)] == [b"tiny %d" % key for key in range(5)]
+        handle.close()
+        del handle
+    arena_size = len(storage._inline_arena)
+    for version in range(10):
+        storage[0] = b"tiny 0.%d" % version
+        storage.save()
+    assert len(storage._inline_arena) <= arena_size + 2 * len(b"tiny 0.0")
+    assert storage[0] == b"tiny 0.9" and storage[4] == b"tiny 4"
+    storage.close()
+    del storage
+    storage = store_class.load(path, serializer=lambda x: x, deserializer=bytes)
+    storage[5] = b"tiny 0.x"
+    assert storage[0] == b"tiny 0.9" and storage[5] == b"tiny 0.x"
+    assert len(storage._inline_arena) <= arena_size + 2 * len(b"tiny 0.0")
+    storage.close()
+    del storage
+
+    # partitions of a storage without shards keep inline values
+    path = tmp_path / "partitions"
+    storage = store_class(path, inline_threshold=16, serializer=lambda x: x, deserializer=bytes, **kwargs)
+    for key in range(5):
+        storage[key] = b"tiny"
+    partitions = storage.partitions(3, by="shard")
+    assert sorted(key for partition in partitions for key, _ in partition.records()) == list(range(5))
+    storage.close()
+    del storage
+
+
+def test_fixed_shape_store():
+    from array import array
+    from nhkv import FixedShapeStore
+
+    path = "temp_fixed_shape"
+    storage = FixedShapeStore(path, shape=(2, 3), dtype="f")
+    for key in range(10):
+        assert storage.append([key] * 6) == key
+    storage[12] = array("f", [12] * 6)
+    assert len(storage) == 13
+    assert storage.shape == (13, 2, 3)
+    assert storage[3] == array("f", [3] * 6)
+    assert storage[11] == array("f", [0] * 6)
+    assert storage.gather([1, 2, 3, 12, 0]) == array("f", [1] * 6 + [2] * 6 + [3] * 6 + [12] * 6 + [0] * 6)
+
+    try:
+        storage[0] = [1, 2]
+        assert False, "Exception is not caught"
+    except ValueError:
+        pass
+
+    try:
+        # noinspection PyUnusedLocal
+        test = storage[13]
+        assert False, "Exception is not caught"
+    except KeyError:
+        pass
+
+    # the data file grows and is mapped again when the capacity is exceeded
+    capacity = storage._capacity
+    for key in range(13, capacity + 1):
+        storage.append([key] * 6)
+    assert storage._capacity == capacity * 2 and len(storage) == capacity + 1
+    assert storage[3] == array("f", [3] * 6) and storage[capacity] == array("f", [capacity] * 6)
+
+    try:
+        gathered = storage.gather_numpy([3, 1])
+        assert gathered.shape == (2, 2, 3)
+        assert gathered[0, 1, 2] == 3
+    except ImportError:
+        pass
+
+    storage.close()
+    del storage
+
+    storage = FixedShapeStore.load(path)
+    assert storage[12] == array("f", [12] * 6) and storage[capacity] == array("f", [capacity] * 6)
+    storage.close()
+    del storage
+    shutil.rmtree(path)
+
+    storage = FixedShapeStore(path, shape=2, dtype="d", key_map=True)
+    storage["a"] = [1, 2]
+    storage["b"] = [3, 4]
+    assert storage.gather(["b", "a"]) == array("d", [3, 4, 1, 2])
+    assert storage.keys() == ["a", "b"]
+    storage.close()
+    del storage
+
+    storage = FixedShapeStore.load(path)
+    assert storage["b"] == array("d", [3, 4])
+    storage.close()
+    del storage
+    shutil.rmtree(path)
+
+
+@_parametrize_stores(None, "sqlite", "hashfile")
+def test_range_reads(store_type, tmp_path):
+    store_class, kwargs = store_type
+    path = tmp_path / "storage"
+    storage = store_class(path, shard_size=200, inline_threshold=4, **kwargs)
+    for key in range(0, 50):
+        if key % 10 != 3:
+            storage[key] = [key] * (key % 4)
+
+    reads = []
+    read_bytes = storage._read_bytes
+    storage._read_bytes = lambda *args: reads.append(args) or read_bytes(*args)
+
+    expected = [(key, [key] * (key % 4)) for key in range(5, 45) if key % 10 != 3]
+    assert list(storage.get_range(5, 45)) == expected
+    assert len(reads) < len(expected) / 2
+    assert storage[5:45] == [value for _, value in expected]
+    assert list(storage.get_range(100, 200)) == []
+
+    try:
+        list(storage.get_range("1", "2"))
+        assert False, "Exception is not caught"
+    except TypeError:
+        pass
+
+    storage.close()
+    del storage
+
+    # wide ranges over a few keys do not probe every integer of the range
+    storage = store_class(tmp_path / "sparse", **kwargs)
+    for key in [3, 10**6, 10**11, 5]:
+        storage[key] = key
+    assert list(storage.get_range(0, 10**12)) == [(3, 3), (5, 5), (10**6, 10**6), (10**11, 10**11)]
+    assert storage[4:10**7] == [5, 10**6]
+    storage.close()
+    del storage
+
+
+@_parametrize_stores(None, "sqlite", "shelve")
+def test_contains(store_type, tmp_path):
+    store_class, kwargs = store_type
+    # CompactKeyValueStore is checked with positional keys and with a key map
+    key_types = {None: [int, str], "sqlite": [int], "shelve": [str]}[kwargs.get("index_backend")]
+    for key_type in key_types:
+        path = tmp_path / key_type.__name__
+        storage = store_class(path, **kwargs)
+        for key in range(0, 100, 2):
+            storage[key_type(key)] = key
+        assert all(key_type(key) in storage for key in range(0, 100, 2))
+        assert not any(key_type(key) in storage for key in range(1, 100, 2))
+        assert key_type(1000) not in storage
+        assert (1 if key_type is str else "1") not in storage
+        storage.save()
+
+        storage = store_class.load(path)
+        assert key_type(10) in storage and key_type(11) not in storage
+        storage.close()
+        del storage
+
+
+def test_contains_bloom_filter(tmp_path):
+    from nhkv.DbOffsetStorage import DbOffsetStorage
+
+    # filter grows together with the index and is rebuilt when missing
+    index_path = tmp_path / "index"
+    bloom_capacity = DbOffsetStorage._bloom_capacity
+    DbOffsetStorage._bloom_capacity = 10
+    try:
+        index = DbOffsetStorage(index_path)
+        for key in range(100):
+            index[key] = (0, key, 1)
+        assert index._bloom.capacity >= 100
+        assert all(key in index for key in range(100))
+        assert sum(key in index._bloom for key in range(100, 1100)) < 100
+        index.close()
+
+        os.remove(tmp_path / "index.bloom")
+        index = DbOffsetStorage(index_path, read_only=True)
+        assert 99 in index and 100 not in index
+        index.close()
+        assert not os.path.isfile(tmp_path / "index.bloom")
+    finally:
+        DbOffsetStorage._bloom_capacity = bloom_capacity
+
+
+def test_db_offset_storage_batches():
+    import sqlite3
+    from nhkv import KVStore
+    from nhkv.DbOffsetStorage import DbOffsetStorage
+
+    db_path = "temp_batches.db"
+    index = DbOffsetStorage(db_path, batch_size=10, commit_rows=10**6, commit_bytes=1000)
+    assert index._db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert index._db.execute("PRAGMA synchronous").fetchone()[0] == 1
+    assert index._db.execute("SELECT COUNT() FROM sqlite_master WHERE type = 'index'").fetchone()[0] == 0
+
+    for key in range(25):
+        index.append(key, (0, key * 10, 10))
+    assert len(index._pending) == 5
+    assert index._bytes_without_commit == 250
+    index[3] = (1, 0, 10)  # different statement flushes the batch
+    assert len(index._pending) == 1 and index._pending_how == "REPLACE"
+
+    for key in range(25, 100):
+        index[key] = (0, key * 10, 10)
+    assert index.added_without_commit < 100  # committed by bytes
+    assert index[3] == (1, 0, 10) and index[99] == (0, 990, 10)
+    assert len(index) == 100
+    before = index._bytes_without_commit
+    index[99] = (0, 0, 10 | 1 << 61)  # flags of inline entries are not counted as bytes
+    assert index._bytes_without_commit == before + 10
+
+    try:
+        index.append(5, (0, 0, 1))  # raised by append instead of the next flush
+        assert False, "Exception is not caught"
+    except sqlite3.IntegrityError:
+        pass
+    index.save()
+
+    # a key written by another connection fails only its own row of the batch
+    other = sqlite3.connect(db_path)
+    other.execute("INSERT INTO offset_storage VALUES (103, 2, 0, 1)")
+    other.commit()
+    other.close()
+    for key in range(100, 106):
+        index.append(key, (0, key, 1))
+    try:
+        index.save()
+        assert False, "Exception is not caught"
+    except sqlite3.IntegrityError as e:
+        assert "103" in str(e)
+    assert not index._pending
+    index.save()
+    assert [index[key] for key in range(100, 106)] == [(0, 100, 1), (0, 101, 1), (0, 102, 1), (2, 0, 1),
+                                                       (0, 104, 1), (0, 105, 1)]
+    assert len(index) == 106
+
+    index.close()
+    os.remove(db_path)
+    os.remove(db_path + ".bloom")
+
+    path = "temp_batches_store"
+    storage = KVStore(path, index_options={"batch_size": 3, "cache_size": 2**20})
+    for key in range(10):
+        storage[key] = key
+    assert storage._index._batch_size == 3
+    storage.close()
+
+    storage = KVStore.load(path, read_only=True, index_options={"batch_size": 3})
+    assert storage._index._batch_size == 3
+    assert [storage[key] for key in range(10)] == list(range(10))
+    storage.close()
+    del storage
+    shutil.rmtree(path)
+
+
+def test_db_offset_storage_overlay():
+    import sqlite3
+    from nhkv.DbOffsetStorage import DbOffsetStorage
+
+    db_path = "temp_overlay.db"
+    index = DbOffsetStorage(db_path, batch_size=4)
+    index.append(0, (0, 0, 1))
+    index.save()
+
+    for key in range(1, 7):
+        index[key] = (0, key, 1)
+    index[6] = (1, 6, 1)
+    assert list(index._pending) == [5, 6]
+    assert index[2] == (0, 2, 1) and index[6] == (1, 6, 1)
+    assert 5 in index and 7 not in index
+    assert len(index) == 7 and len(index._pending) == 0
+    assert index.keys() == list(range(7))
+    assert index.requires_commit  # reads do not commit
+
+    other = sqlite3.connect(db_path)
+    assert other.execute("SELECT COUNT() FROM offset_storage").fetchone()[0] == 1
+    index.save()
+    assert other.execute("SELECT COUNT() FROM offset_storage").fetchone()[0] == 7
+    other.close()
+
+    index.append(7, (0, 7, 1))
+    try:
+        index.append(7, (0, 7, 1))
+        assert False, "Exception is not caught"
+    except sqlite3.IntegrityError:
+        pass
+
+    index.close()
+    os.remove(db_path)
+    os.remove(db_path + ".bloom")
+
+    # entries of a failed flush are removed from the read overlay and the offset cache
+    for kwargs in [{"thread_safe": True}, {"offset_cache": "sparse"}, {"offset_cache": "dense", "preload": True}]:
+        index = DbOffsetStorage(db_path, batch_size=10, **kwargs)
+        index.save()
+        other = sqlite3.connect(db_path)
+        other.execute("INSERT INTO offset_storage VALUES (2, 9, 9, 9)")
+        other.commit()
+        other.close()
+        for key in range(4):
+            index.append(key, (0, key, 1))
+        try:
+            len(index)
+            assert False, "Exception is not caught"
+        except sqlite3.IntegrityError:
+            pass
+        assert 2 not in index._flushed and 2 in index
+        assert index[2] == (9, 9, 9) and index[3] == (0, 3, 1)
+        index.close()
+        os.remove(db_path)
+        os.remove(db_path + ".bloom")
+
+
+def test_offset_cache():
+    from nhkv import KVStore
+    from nhkv.DbOffsetStorage import DbOffsetStorage
+
+    path = "temp_offset_cache"
+    storage = KVStore(path, index_options={"offset_cache": "dense"})
+    for key in range(100):
+        storage[key] = key
+    storage.save()
+    assert storage._index._offset_cache.get(50) == storage._index[50]
+    storage.close()
+
+    for kwargs in [{"offset_cache": "dense"}, {"offset_cache": "sparse", "cache_entries": 1000}]:
+        storage = KVStore.load(path, read_only=True, index_options=dict(kwargs, preload=True))
+        assert storage._index._cache_complete
+        # database is not queried after preloading
+        storage._index._cursor.close()
+        assert [storage[key] for key in range(100)] == list(range(100))
+        assert 10 in storage and 100 not in storage
+        assert storage.get(200, None) is None
+        storage.close()
+        del storage
+
+    index = DbOffsetStorage(
+        os.path.join(path, "sqlite_index.db"), read_only=True, offset_cache="sparse", cache_entries=10, preload=True
+    )
+    assert not index._cache_complete and len(index._offset_cache) == 10
+    assert [index[key] for key in range(20)] == [entry for _, entry in index.items(0, 20)]
+    assert len(index._offset_cache) == 10
+    index.close()
+
+    try:
+        DbOffsetStorage(os.path.join(path, "sqlite_index.db"), read_only=True, offset_cache="hash")
+        assert False, "Exception is not caught"
+    except ValueError:
+        pass
+
+    shutil.rmtree(path)
+
+
+def test_string_keys_in_sqlite():
+    from nhkv import KVStore
+    from nhkv.DbOffsetStorage import HashedKeyOffsetStorage
+
+    path = "temp_sqlite_str"
+    storage = KVStore(path, index_backend="sqlite_str", index_options={"batch_size": 16})
+    for key in range(100):
+        storage[f"key_{key}"] = key
+    storage["key_7"] = "updated"
+    assert storage["key_3"] == 3 and storage["key_7"] == "updated"
+    assert "key_99" in storage and "key_100" not in storage and 99 not in storage
+
+    try:
+        storage[1] = 1
+        assert False, "Exception is not caught"
+    except TypeError:
+        pass
+    storage.close()
+
+    storage = KVStore.load(path)
+    assert len(storage._index) == 100
+    assert sorted(storage.keys()) == sorted(f"key_{key}" for key in range(100))
+    assert dict(storage.items())["key_50"] == 50
+    storage.close()
+    del storage
+    shutil.rmtree(path)
+
+    # keys with colliding hashes are placed into the next free slots
+    hash_key = HashedKeyOffsetStorage.__dict__["_hash_key"]
+    HashedKeyOffsetStorage._hash_key = staticmethod(
+        lambda key: 42 if key.startswith("c") else hash_key.__func__(key)
+    )
+    try:
+        index = HashedKeyOffsetStorage("temp_hashed.db", batch_size=2)
+        for ind, key in enumerate(["c1", "c2", "a", "c3", "c4"]):
+            index[key] = (0, ind, 1)
+        index["c2"] = (1, 1, 1)
+        assert index.get_many(["c1", "c2", "c4", "c5", "a"]) == {
+            "c1": (0, 0, 1), "c2": (1, 1, 1), "c4": (0, 4, 1), "a": (0, 2, 1)
+        }
+        index.save()
+        assert [index[key] for key in ["c1", "c2", "c3", "c4"]] == [(0, 0, 1), (1, 1, 1), (0, 3, 1), (0, 4, 1)]
+        assert "c5" not in index and len(index) == 5
+        index.close()
+    finally:
+        HashedKeyOffsetStorage._hash_key = hash_key
+    os.remove("temp_hashed.db")
+    os.remove("temp_hashed.db.bloom")
+
+
+def test_hashfile_index():
+    from nhkv import KVStore
+    from nhkv.HashFileIndex import HashFileIndex
+
+    for key_type in [int, str]:
+        path = "temp_hashfile"
+        storage = KVStore(path, index_backend="hashfile", index_options={"key_type": key_type})
+        for key in range(3000):
+            storage[key_type(key)] = key
+        storage[key_type(7)] = "updated"
+        assert storage._index._capacity >= 4096
+        assert storage[key_type(5)] == 5 and storage[key_type(7)] == "updated"
+        assert key_type(2999) in storage and key_type(3000) not in storage
+        assert len(storage._index) == 3000
+
+        try:
+            storage[0 if key_type is str else "0"] = 1
+            assert False, "Exception is not caught"
+        except TypeError:
+            pass
+        storage.close()
+
+        storage = KVStore.load(path, read_only=True)
+        assert storage._index.key_type is key_type
+        assert sorted(storage.keys(), key=int) == [key_type(key) for key in range(3000)]
+        assert dict(storage.items())[key_type(100)] == 100
+        if key_type is int:
+            assert storage[10:13] == [10, 11, 12]
+        storage.close()
+        del storage
+        shutil.rmtree(path)
+
+    # colliding hashes are resolved by comparing keys
+    index = HashFileIndex("temp_hashfile_index", key_type=str)
+    index._hash = lambda key: 42
+    for ind, key in enumerate(["a", "b", "c"]):
+        index[key] = (0, ind, 1)
+    index["b"] = (1, 1, 1)
+    assert [index[key] for key in ["a", "b", "c"]] == [(0, 0, 1), (1, 1, 1), (0, 2, 1)]
+    assert "d" not in index and len(index) == 3
+    index.close()
+    os.remove("temp_hashfile_index")
+    os.remove("temp_hashfile_index.keys")
+
+
+def test_db_dict_batches():
+    import sqlite3
+    from nhkv.dbdict.sqlitedbdict import SqliteDbDict
+
+    db_path = "temp_db_dict_batches.db"
+    storage = SqliteDbDict(db_path, key_type=str, str_key_lim=8)
+    assert storage._cur.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    storage.update({"a": 1, "b": 2})
+    storage.update((str(key), key) for key in range(1000))
+    storage.put_many([("long_key_1", "long")])
+    assert storage.requires_commit
+    assert storage["b"] == 2 and storage["999"] == 999  # uncommitted values are readable
+
+    other = sqlite3.connect(db_path)
+    assert other.execute("SELECT COUNT() FROM mydict").fetchone()[0] == 0
+    storage.save()
+    assert other.execute("SELECT COUNT() FROM mydict").fetchone()[0] == 1003
+    other.close()
+
+    found = storage.get_many(["a", "missing"] + [str(key) for key in range(0, 1000, 3)] + ["long_key_1"])
+    assert found.pop("a") == 1 and found.pop("long_key_1") == "long"
+    assert found == {str(key): key for key in range(0, 1000, 3)}
+
+    storage.delete_many(["a", "missing", "long_key_1"] + [str(key) for key in range(500)])
+    assert len(storage) == 501 and storage.get_many(["a", "b", "499", "500"]) == {"b": 2, "500": 500}
+    try:
+        storage.delete_many([1])
+        assert False, "Exception is not caught"
+    except TypeError:
+        pass
+
+    try:
+        storage.update({1: 1})
+        assert False, "Exception is not caught"
+    except TypeError:
+        pass
+
+    storage.close()
+    del storage
+    os.remove(db_path)
+
+
+def test_native_db_dict_batches():
+    from nhkv import AutoDbDict
+
+    for backend in ["rocksdb", "leveldb"]:
+        path = f"temp_native_batches_{backend}.db"
+        try:
+            storage = AutoDbDict(path, backend)
+        except ImportError:
+            continue
+        storage.put_many({str(key): key for key in range(100)})
+        storage.update([("a", 1), ("0", "zero"), ("a", 2)])
+        assert len(storage) == 101 and storage["a"] == 2 and storage["0"] == "zero"
+
+        snapshot = storage.snapshot()
+        storage["1"] = "new"
+        assert storage.get_many(["1", "2", "missing"], snapshot=snapshot) == {"1": 1, "2": 2}
+        assert storage.get_many(["1", "2", "missing"]) == {"1": "new", "2": 2}
+
+        storage.delete_many(["a", "missing", "0", "0"])
+        del storage["99"]
+        del storage["missing"]
+        assert len(storage) == 98
+        assert list(storage.iterkeys()) == storage.keys() == sorted(str(key) for key in range(1, 99))
+        assert dict(storage.iteritems()) == dict({str(key): key for key in range(2, 99)}, **{"1": "new"})
+        assert len(list(storage.itervalues())) == 98
+
+        assert [key for key, _ in storage.scan(prefix="1")] == ["1"] + [str(key) for key in range(10, 20)]
+        assert list(storage.scan("50", "53")) == [("50", 50), ("51", 51), ("52", 52)]
+        assert [key for key, _ in storage.scan(start="9", reverse=True, limit=3)] == ["98", "97", "96"]
+        assert [key for key, _ in storage.scan(end="11", reverse=True)] == ["10", "1"]
+        assert [key for key, _ in storage.scan(prefix="2", reverse=True, limit=2)] == ["29", "28"]
+        storage.close()
+        del storage, snapshot
+
+        # the number of entries is persisted
+        storage = AutoDbDict(path, backend)
+        assert len(storage) == 98
+        storage.close()
+        del storage
+
+        if backend == "leveldb":
+            # Bloom filter of keys is rebuilt when it is missing or full
+            os.remove(path + ".bloom")
+            storage = AutoDbDict(path, backend)
+            storage._bloom_capacity = 10
+            storage._build_bloom()
+            storage.update({str(key): key for key in range(90, 120)})
+            storage["5"] = 5
+            assert len(storage) == 119 and storage._bloom.capacity >= 119
+            storage.close()
+            del storage
+            os.remove(path + ".bloom")
+        shutil.rmtree(path)
+
+
+def _deserialize_bytes(value):
+    assert type(value) is bytes
+    return value
+
+
+def test_db_dict_blobs():
+    import sqlite3
+    from nhkv.dbdict.sqlitedbdict import SqliteDbDict
+
+    db_path = "temp_db_dict_blobs.db"
+    # incremental blob I/O is available since Python 3.11, the fallback is tested everywhere
+    for supports_blobs in ([True, False] if hasattr(sqlite3.Connection, "blobopen") else [False]):
+        storage = SqliteDbDict(
+            db_path, key_type=str, blob_threshold=1000, overflow_threshold=100000,
+            serializer=lambda value: value, deserializer=_deserialize_bytes
+        )
+        if not supports_blobs:
+            storage._supports_blobs = lambda: False
+        storage._blob_chunk = 300
+        values = {"small": b"s" * 10, "blob": bytes(range(256)) * 20, "file": b"f" * 200000}
+        for key, value in values.items():
+            storage[key] = value
+        assert {key: storage[key] for key in values} == values
+        assert storage.get_many(values) == values
+        assert len(os.listdir(db_path + ".overflow")) == 1
+
+        with storage.open_reader("blob") as reader:
+            reader.seek(256)
+            assert reader.read(256) == bytes(range(256))
+
+        with storage.open_writer("streamed", 1000) as writer:
+            for _ in range(10):
+                writer.write(b"0123456789" * 10)
+        assert storage["streamed"] == b"0123456789" * 100
+
+        # value that moves from a side file into the database, the file is removed after commit
+        storage["file"] = b"f"
+        assert storage["file"] == b"f"
+        assert len(os.listdir(db_path + ".overflow")) == 1
+        storage.save()
+        assert len(os.listdir(db_path + ".overflow")) == 0
+        storage.update([("file", b"f" * 100000)])
+        with storage.open_reader("file") as reader:
+            assert len(reader.read()) == 100000
+        del storage["file"]
+        storage.save()
+        assert len(os.listdir(db_path + ".overflow")) == 0
+
+        # uncommitted values do not overwrite files of committed ones
+        storage["file"] = b"f" * 100000
+        storage.save()
+        storage.update([("file", b"g" * 100000), ("file", b"h" * 100000)])
+        storage["file"] = b"i" * 100000
+        assert storage["file"] == b"i" * 100000
+        other = SqliteDbDict(db_path, key_type=str, serializer=lambda value: value, deserializer=_deserialize_bytes)
+        assert other["file"] == b"f" * 100000
+        other.close()
+        storage.save()
+        assert len(os.listdir(db_path + ".overflow")) == 1
+
+        # files of a failed batch are removed
+        try:
+            storage.update([("other", b"o" * 100000), (1, b"o" * 100000)])
+            assert False, "Exception is not caught"
+        except TypeError:
+            pass
+        storage.save()
+        assert len(os.listdir(db_path + ".overflow")) == 1
+
+        storage.close()
+        del storage
+        os.remove(db_path)
+        shutil.rmtree(db_path + ".overflow")
+
+
+def test_thread_safe_access():
+    import threading
+    from nhkv import KVStore
+    from nhkv.dbdict.sqlitedbdict import SqliteDbDict
+
+    storage_path = "temp_thread_safe_storage"
+    # descriptors are evicted from the cache while other threads read with them
+    storage = KVStore(storage_path, shard_size=2**12, read_engine="pread", max_opened_shards=2, thread_safe=True)
+    for key in range(500):
+        storage[key] = str(key)
+    storage.save()
+
+    db_path = "temp_thread_safe_db_dict.db"
+    db_dict = SqliteDbDict(db_path, key_type=int, thread_safe=True)
+    db_dict.update((key, str(key)) for key in range(500))
+    db_dict.save()
+
+    errors = []
+
+    def read():
+        try:
+            for _ in range(3):
+                for key in range(500):
+                    assert storage[key] == str(key) or storage[key] == "new"
+                    assert db_dict[key] == str(key)
+        except Exception as e:
+            errors.append(e)
+
+    def write():
+        try:
+            for key in range(500, 700):
+                storage[key] = str(key)
+                db_dict[key] = str(key)
+            for key in range(0, 500, 7):
+                storage[key] = "new"
+            storage.save()
+            db_dict.save()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in range(4)] + [threading.Thread(target=write)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+
+    assert len(storage) == 700 and storage[699] == "699" and storage[7] == "new"
+    assert db_dict[699] == "699"
+
+    # uncommitted writes are visible to the writing thread and to the readers
+    storage[700] = "700"
+    db_dict[700] = "700"
+    assert len(storage) == 701 and storage[700] == "700" and list(storage.items())[-1] == (700, "700")
+    assert len(db_dict) == 701 and db_dict[700] == "700" and db_dict.keys()[-1] == 700
+    found = []
+    reader = threading.Thread(target=lambda: found.extend([storage[700], db_dict[700], len(db_dict)]))
+    reader.start()
+    reader.join()
+    assert found == ["700", "700", 701]
+
+    try:
+        KVStore("temp_thread_safe_shelve", index_backend="shelve", thread_safe=True)
+        assert False, "Exception is not caught"
+    except ValueError:
+        pass
+
+    storage.close()
+    db_dict.close()
+    del storage, db_dict
+    shutil.rmtree(storage_path)
+    shutil.rmtree("temp_thread_safe_shelve", ignore_errors=True)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.isfile(db_path + suffix):
+            os.remove(db_path + suffix)
+
+
+def test_db_dict_iteration():
+    import sqlite3
+    from nhkv.dbdict.sqlitedbdict import SqliteDbDict
+
+    db_path = "temp_db_dict_iteration.db"
+    storage = SqliteDbDict(db_path, key_type=int)
+    storage.update((key, str(key)) for key in range(100))
+    storage[5] = "five"  # replaced keys are not counted twice
+    del storage[7]
+    del storage[1000]
+    assert len(storage) == 99
+
+    keys = storage.iterkeys()
+    assert not isinstance(keys, list) and next(keys) == 0
+    assert list(storage.iterkeys()) == storage.keys() == [key for key in range(100) if key != 7]
+    items = dict(storage.iteritems())
+    assert len(items) == 99 and items[5] == "five" and items[99] == "99"
+    assert sorted(storage.itervalues()) == sorted(items.values())
+    storage.close()
+    del storage, keys
+
+    # databases created without the counter are counted once
+    connection = sqlite3.connect(db_path)
+    connection.executescript(
+        "DROP TABLE [mydict_count]; DROP TRIGGER [mydict_replace]; DROP TRIGGER [mydict_insert]; "
+        "DROP TRIGGER [mydict_delete]"
+    )
+    connection.close()
+    storage = SqliteDbDict(db_path, key_type=int)
+    assert len(storage) == 99
+    storage[100] = "100"
+    assert len(storage) == 100
+    storage.close()
+    del storage
+    os.remove(db_path)
+
+
+def test_db_dict_scan():
+    from nhkv.dbdict.abstractdbdict import AbstractDbDict
+    from nhkv.dbdict.sqlitedbdict import SqliteDbDict
+
+    db_path = "temp_db_dict_scan.db"
+    storage = SqliteDbDict(db_path, key_type=str)
+    keys = ["2024-01-03", "2024-01-01", "2024-02-01", "2023-12-31", "2024-01-02", "2024-01\U0010ffff", "b"]
+    storage.update((key, i) for i, key in enumerate(keys))
+
+    for scan in (storage.scan, lambda *args, **kwargs: AbstractDbDict.scan(storage, *args, **kwargs)):
+        assert [key for key, _ in scan()] == sorted(keys)
+        assert list(scan("2024-01-01", "2024-01-03")) == [("2024-01-01", 1), ("2024-01-02", 4)]
+        january = ["2024-01-01", "2024-01-02", "2024-01-03", "2024-01\U0010ffff"]
+        assert [key for key, _ in scan(prefix="2024-01")] == january
+        assert [key for key, _ in scan(prefix="2024-01", reverse=True, limit=2)] == january[:1:-1]
+        assert [key for key, _ in scan(start="2024-01-02", prefix="2024")] == january[1:] + ["2024-02-01"]
+        assert [key for key, _ in scan(end="2024", reverse=True)] == ["2023-12-31"]
+        assert list(scan(prefix="c")) == []
+
+    try:
+        list(storage.scan(start=1))
+        assert False, "Exception is not caught"
+    except TypeError:
+        pass
+    storage.close()
+    del storage
+    os.remove(db_path)
+
+    storage = SqliteDbDict(db_path, key_type=int)
+    storage.update((key, str(key)) for key in range(0, 100, 3))
+    assert list(storage.scan(10, 20)) == [(12, "12"), (15, "15"), (18, "18")]
+    assert list(storage.scan(start=90, reverse=True)) == [(99, "99"), (96, "96"), (93, "93"), (90, "90")]
+    try:
+        list(storage.scan(prefix="1"))
+        assert False, "Exception is not caught"
+    except TypeError:
+        pass
+    storage.close()
+    del storage
+    os.remove(db_path)
+
+
+def test_nhkv_db_dict():
+    from nhkv import AutoDbDict, CompactKeyValueStore
+    from nhkv.dbdict.nhkvdbdict import NhkvDbDict
+
+    storage_path = "temp_nhkv_db_dict"
+    storage = AutoDbDict(storage_path, backend="nhkv", key_type=str, shard_size=2**12)
+    assert isinstance(storage, NhkvDbDict)
+    storage["1"] = 2
+    storage["0"] = 1
+    storage.update({"3": 4, "4": [5] * 1000})
+    del storage["0"]
+    del storage["missing"]
+    assert len(storage) == 3 and storage.keys() == ["1", "3", "4"]
+    assert dict(storage.iteritems()) == {"1": 2, "3": 4, "4": [5] * 1000}
+    assert list(storage.scan(prefix="3")) == [("3", 4)]
+
+    try:
+        # noinspection PyUnusedLocal
+        test = storage["0"]
+        assert False, "Exception is not caught"
+    except KeyError:
+        pass
+
+    try:
+        storage[3] = 4
+        assert False, "Exception is not caught"
+    except TypeError:
+        pass
+
+    storage["0"] = "back"
+    storage.close()
+    del storage
+
+    storage = AutoDbDict(storage_path, backend="nhkv", key_type=str)
+    assert len(storage) == 4 and storage["0"] == "back" and storage["4"] == [5] * 1000
+    del storage["4"]
+    storage.close()
+    del storage
+    shutil.rmtree(storage_path)
+
+    # deleted shared records are released
+    store = CompactKeyValueStore(storage_path, deduplicate=True)
+    store["a"] = store["b"] = "same"
+    del store["a"]
+    assert "a" not in store and "b" in store and len(store) == 1 and store.keys() == ["b"]
+    store["c"] = "same"
+    del store["b"], store["c"]
+    assert len(store) == 0 and not store._value_hashes
+    store.close()
+    shutil.rmtree(storage_path)
+
+    # overwriting a deleted key does not release refcounts of the record at (0, 0)
+    store = CompactKeyValueStore(storage_path, deduplicate=True)
+    store["a"] = store["b"] = "X"
+    store["c"] = "Y"
+    del store["c"]
+    store["c"] = "Z"
+    store["a"] = "W"
+    assert store["b"] == "X" and store["a"] == "W" and store["c"] == "Z" and len(store) == 3
+    store.close()
+    shutil.rmtree(storage_path)
+
+    # KVStore removes deleted keys from the index
+    from nhkv import KVStore
+    for backend, options, keys in [
+        ("sqlite", {}, list(range(2000))),
+        ("sqlite_str", {}, [str(key) for key in range(2000)]),
+        ("hashfile", {}, list(range(2000))),
+        ("hashfile", {"key_type": str}, [str(key) for key in range(2000)]),
+        ("shelve", {}, [str(key) for key in range(200)]),
+    ]:
+        store = KVStore(storage_path, index_backend=backend, index_options=options, deduplicate=True)
+        for key in keys:
+            store[key] = key
+        store[keys[1]] = keys[0]
+        store.save()
+        for key in keys[::3]:
+            del store[key]
+        try:
+            del store[keys[0]]
+            assert False, "Exception is not caught"
+        except KeyError:
+            pass
+        deleted = set(keys[::3])
+        assert len(store) == len(keys) - len(deleted) and sorted(store.keys()) == sorted(set(keys) - deleted)
+        assert all((key in store) == (key not in deleted) for key in keys)
+        assert all(store[key] == (keys[0] if key == keys[1] else key) for key in keys if key not in deleted)
+        assert store.get(keys[3], None) is None and dict(store.items())[keys[1]] == keys[0]
+        store[keys[3]] = "back"
+        store.save()
+        store.close()
+
+        store = KVStore.load(storage_path)
+        assert len(store) == len(keys) - len(deleted) + 1 and store[keys[3]] == "back" and keys[6] not in store
+        store.close()
+        shutil.rmtree(storage_path)
+
+    # keys of a probe sequence stay reachable when a colliding key is deleted
+    from nhkv.DbOffsetStorage import HashedKeyOffsetStorage
+    index_path = "temp_collision_index.db"
+    index = HashedKeyOffsetStorage(index_path)
+    index._hash_key = lambda key: 10 if key.startswith("a") else 11
+    for key in ["a0", "b0", "a1", "a2", "b1"]:
+        index[key] = (0, 0, len(key))
+    del index["a0"]
+    del index["a2"]
+    assert index.keys() and sorted(index.keys()) == ["a1", "b0", "b1"]
+    assert all(index.get(key, None) is not None for key in ["a1", "b0", "b1"]) and "a0" not in index
+    index.close()
+    os.remove(index_path)
+    os.remove(index_path + ".bloom")
+
+    from nhkv.HashFileIndex import HashFileIndex
+    index = HashFileIndex("temp_collision_index")
+    index._hash = lambda key: 1023 if key < 3 else 1
+    for key in range(6):
+        index[key] = (0, key, 1)
+    del index[0]
+    del index[4]
+    assert len(index) == 4 and all(index[key] == (0, key, 1) for key in [1, 2, 3, 5]) and 0 not in index
+    index.close()
+    os.remove("temp_collision_index")
+    os.remove("temp_collision_index.keys")
+
+    # deletions stay invisible to reading threads until they are committed
+    import threading
+    store = KVStore(storage_path, thread_safe=True)
+    store[1] = "value"
+    store.save()
+    del store[1]
+    found = []
+    reader = threading.Thread(target=lambda: found.append(1 in store or store.get(1, None) is not None))
+    reader.start()
+    reader.join()
+    assert found == [False]
+    store.close()
+    shutil.rmtree(storage_path)